@@ -0,0 +1,94 @@
+import asyncio
+import re
+from functools import lru_cache
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+PLACEHOLDER_PATTERN = re.compile(r'%\((\w+)\)s|%%')
+
+
+@lru_cache(maxsize=1024)
+def positional_sql(sql):
+    """Converts the %(name)s placeholders of the queries to asyncpg's $n placeholders.
+
+    Returns the SQL and the parameter names in the order of their positions.
+    """
+    names = []
+
+    def placeholder(match):
+        name = match.group(1)
+        if name is None:
+            return '%'
+        if name not in names:
+            names.append(name)
+        return '${}'.format(names.index(name) + 1)
+    return PLACEHOLDER_PATTERN.sub(placeholder, sql), tuple(names)
+
+
+class Results:
+    """Rows of a query as dicts like the results of a queries session."""
+
+    def __init__(self, records):
+        self.rows = [dict(record) for record in records]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return self.rows[index]
+
+    def count(self):
+        return len(self.rows)
+
+    def free(self):
+        # The connection is back in the pool as soon as the rows are fetched
+        self.rows = []
+
+
+class AsyncpgSession:
+    """Runs the queries of Database on an asyncpg connection pool.
+
+    asyncpg uses the binary protocol and prepares the statements of each pooled connection itself, so
+    the statement cache is disabled when the server must not prepare statements.
+    """
+
+    def __init__(self, connection_uri, prepare_statements=True, min_size=2, max_size=20):
+        if not asyncpg:
+            raise RuntimeError("ERROR: Trying to use asyncpg database driver but asyncpg is not installed! "
+                               "Try for example: 'pip install asyncpg'")
+        self.connection_uri = connection_uri
+        self.statement_cache_size = 1024 if prepare_statements else 0
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        self._pool_lock = asyncio.Lock()
+
+    async def _get_pool(self):
+        # The pool is created in the event loop of the server when it is first needed
+        if self.pool is None:
+            async with self._pool_lock:
+                if self.pool is None:
+                    self.pool = await asyncpg.create_pool(
+                        self.connection_uri, min_size=self.min_size, max_size=self.max_size,
+                        statement_cache_size=self.statement_cache_size)
+        return self.pool
+
+    async def query(self, sql, parameters=None):
+        arguments = []
+        # Like psycopg2, the % characters of a query without parameters are not placeholders
+        if parameters is not None:
+            sql, names = positional_sql(sql)
+            arguments = [parameters[name] for name in names]
+        pool = await self._get_pool()
+        return Results(await pool.fetch(sql, *arguments))
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
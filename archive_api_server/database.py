@@ -1,14 +1,31 @@
 import datetime
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 import urllib.parse
-import queries
+import asyncpg_session
 import sql_queries
 
+try:
+    import queries
+    from psycopg2 import errors as pg_errors
+except ImportError:
+    queries = None
+    pg_errors = None
+
+try:
+    from test_archiver import log_tiering
+except ImportError:
+    log_tiering = None
+
+
+# Attempts to find or prepare a statement on a pooled connection before executing it unprepared
+PREPARE_ATTEMPTS = 3
+
 
 class Database:
 
-    def __init__(self, host, dbname, user, password):
+    def __init__(self, host, dbname, user, password, rehydrated_runs=32, prepare_statements=True,
+                 driver='queries'):
         # Escape password as it may contain special characters.
         # Strip whitespace from other parameters.
         # Strip trailing '/' from host.
@@ -18,7 +35,22 @@ class Database:
             host=host.strip().rstrip('/'),
             dbname=dbname.strip(),
         )
-        self.session = queries.TornadoSession(connection_uri)
+        # Log messages of the recently requested test runs that were moved to cold storage
+        self.rehydrated_logs = OrderedDict()
+        self.rehydrated_runs = rehydrated_runs
+        if driver == 'asyncpg':
+            # asyncpg prepares the statements itself, unless told not to
+            self.session = asyncpg_session.AsyncpgSession(connection_uri, prepare_statements)
+            self.prepare_statements = False
+        elif driver == 'queries':
+            if not queries:
+                raise RuntimeError("ERROR: Trying to use queries database driver but queries is not installed! "
+                                   "Try for example: 'pip install queries'")
+            self.session = queries.TornadoSession(connection_uri)
+            # Connection poolers in transaction mode do not keep prepared statements
+            self.prepare_statements = prepare_statements
+        else:
+            raise ValueError("Unsupported database driver: {}".format(driver))
 
     def test_series(self):
         return self.session.query(sql_queries.TEST_SERIES), list_of_dicts
@@ -46,21 +78,32 @@ class Database:
         sql = "SELECT * FROM test_run ORDER BY id DESC LIMIT 1"
         return self.session.query(sql), single_dict
         
+    def archive_state(self):
+        # Changes whenever test runs are archived, deleted or ignored
+        sql = """SELECT max(id) as last_test_run, count(*) as test_runs,
+                        md5(string_agg(id::text, ',' ORDER BY id) FILTER (WHERE ignored)) as ignored_test_runs
+                 FROM test_run"""
+        return self.session.query(sql), single_dict
+
     def db_type(self):
         sql = "SELECT generator, archived_using FROM test_run ORDER BY id DESC LIMIT 1"
         return self.session.query(sql), single_dict
 
-    def builds(self, series, build, last, offset):
-        return self.session.query(sql_queries.builds(series, build, last, offset)), list_of_dicts
+    def builds(self, series, build, last, offset, before_build=None, after_build=None):
+        sql = sql_queries.builds(series, build, last, offset, before_build, after_build)
+        return self.session.query(sql), list_of_dicts
 
-    def builds_by_time(self, series, build, last, offset, searchTimeStart, searchTimeEnd):
-        return self.session.query(sql_queries.builds_by_time(series, build, last, offset, searchTimeStart, searchTimeEnd)), list_of_dicts
+    def builds_by_time(self, series, build, last, offset, searchTimeStart, searchTimeEnd, before_build=None,
+                       after_build=None):
+        sql = sql_queries.builds_by_time(series, build, last, offset, searchTimeStart, searchTimeEnd,
+                                         before_build, after_build)
+        return self.session.query(sql, {'start_time': searchTimeStart, 'end_time': searchTimeEnd}), list_of_dicts
 
-    def build_results(self, series, build_num):
-        return self.session.query(sql_queries.build_results(series, build_num)), list_of_dicts
+    def builds_results(self, series, build_numbers):
+        return self.session.query(sql_queries.builds_results(series, build_numbers)), results_by_build
 
     def test_run_results(self, test_run_id):
-        return self.session.query(sql_queries.test_run_results(test_run_id)), list_of_dicts
+        return self.session.query(sql_queries.test_run_results(test_run_id)), results_without_build
 
     def test_run_data(self, test_run_id):
         return self.session.query(sql_queries.test_run_data(test_run_id)), single_dict
@@ -79,18 +122,91 @@ class Database:
     def parent_suite_results(self, test_run_id, test_id):
         return self.session.query(sql_queries.parent_suite_results(test_run_id, test_id)), list_of_dicts
 
-    def log_message_map(self, test_run_id):
+    def log_message_map(self, test_run_id, keys=None):
+        """Log messages of the test run by (suite_id, test_id), only those of the given keys if keys are given."""
+        test_run_id = int(test_run_id)
+        rehydrated = self.rehydrated_log_messages(test_run_id)
+        wanted = set(keys) if keys is not None else None
+
         def log_message_mapper(rows):
             messages = list_of_dicts(rows)
+            if rehydrated is None:
+                archived = self._rehydrate_logs(test_run_id, messages)
+            else:
+                archived = rehydrated
+            if wanted is not None:
+                archived = [message for message in archived
+                            if (message['suite_id'], message['test_id']) in wanted]
+            if archived:
+                # Messages archived after the run was moved to cold storage are mixed in by time
+                messages = sorted(archived + messages, key=lambda message: (message['timestamp'] is None,
+                                                                            message['timestamp'] or ''))
             message_map = defaultdict(lambda: [])
             for message in messages:
                 key = (message['suite_id'], message['test_id'])
                 message_map[key].append(message)
             return message_map
-        return self.session.query(sql_queries.log_messages(test_run_id)), log_message_mapper
+        if rehydrated is not None:
+            # Segments do not change so only the messages archived after it are queried
+            return self.session.query(sql_queries.log_messages(test_run_id, keys)), log_message_mapper
+        return self.session.query(sql_queries.log_messages_with_segment(test_run_id, keys)), log_message_mapper
 
-    def build_metadata(self, series, build_num):
-        return self.session.query(sql_queries.build_metadata(series, build_num)), metadata_dict
+    def log_message_page(self, test_run_id, suite_id, test_id, after_id, limit):
+        def page(rows):
+            messages = list_of_dicts(rows)
+            next_id = messages[limit - 1]['id'] if len(messages) > limit else None
+            return messages[:limit], next_id
+        sql = sql_queries.log_message_page(test_run_id, suite_id, test_id, after_id, limit)
+        return self.session.query(sql), page
+
+    def log_segment(self, test_run_id):
+        """Log messages of the test run in cold storage, an empty list if the run has no segment."""
+        test_run_id = int(test_run_id)
+
+        def segment_messages(rows):
+            rows = list(rows)
+            if not rows:
+                return []
+            return self._cache_segment(test_run_id, rows[0]['segment'], rows[0]['compression'])
+        return self.session.query(sql_queries.LOG_SEGMENT, {'test_run_id': test_run_id}), segment_messages
+
+    def rehydrated_log_messages(self, test_run_id):
+        """Cached log messages of the test run from cold storage or None when they are not cached."""
+        rehydrated = self.rehydrated_logs.get(int(test_run_id))
+        if rehydrated is not None:
+            self.rehydrated_logs.move_to_end(int(test_run_id))
+            return [dict(message) for message in rehydrated]
+        return None
+
+    def _rehydrate_logs(self, test_run_id, messages):
+        """Removes the segment row from messages and returns the log messages decoded from it."""
+        segment_rows = [message for message in messages if message['segment'] is not None]
+        for message in segment_rows:
+            messages.remove(message)
+        for message in messages:
+            for key in ('id', 'segment', 'compression'):
+                del message[key]
+        if not segment_rows:
+            return []
+        return self._cache_segment(test_run_id, segment_rows[0]['segment'], segment_rows[0]['compression'])
+
+    def _cache_segment(self, test_run_id, segment, compression):
+        if log_tiering is None:
+            raise RuntimeError("ERROR: Log messages moved to cold storage require TestArchiver to be "
+                               "installed! Try for example: 'pip install testarchiver'")
+        archived = [
+            {'test_run_id': test_run_id, 'test_id': message['test_id'], 'suite_id': message['suite_id'],
+             'timestamp': message['timestamp'], 'log_level': message['log_level'],
+             'message': message['message']}
+            for message in log_tiering.decode_segment(segment, compression)
+        ]
+        self.rehydrated_logs[test_run_id] = archived
+        while len(self.rehydrated_logs) > self.rehydrated_runs:
+            self.rehydrated_logs.popitem(last=False)
+        return [dict(message) for message in archived]
+
+    def builds_metadata(self, series, build_numbers):
+        return self.session.query(sql_queries.builds_metadata(series, build_numbers)), metadata_dict
 
     def test_run_metadata(self, test_run_id):
         return self.session.query(sql_queries.test_run_metadata(test_run_id)), metadata_dict
@@ -99,39 +215,65 @@ class Database:
         return self.session.query(sql_queries.included_in_builds(test_run_id)), list_of_dicts
 
     def suite_result_statistics(self, series, last, offset, build_num):
-        sql = sql_queries.status_ratios('suite', series, last, offset, build_num, per_build=False)
-        return self.session.query(sql), single_dict
+        statement = sql_queries.status_ratios('suite', series, last, offset, build_num, per_build=False)
+        return self.execute_prepared(*statement), single_dict
 
     def test_result_statistics(self, series, last, offset, build_num):
-        sql = sql_queries.status_ratios('test', series, last, offset, build_num, per_build=False)
-        return self.session.query(sql), single_dict
+        statement = sql_queries.status_ratios('test', series, last, offset, build_num, per_build=False)
+        return self.execute_prepared(*statement), single_dict
 
     def suite_result_statistics_per_build(self, series, last, offset, build_num):
-        sql = sql_queries.status_ratios('suite', series, last, offset, build_num, per_build=True)
-        return self.session.query(sql), list_of_dicts
+        statement = sql_queries.status_ratios('suite', series, last, offset, build_num, per_build=True)
+        return self.execute_prepared(*statement), list_of_dicts
 
     def test_result_statistics_per_build(self, series, last, offset, build_num):
-        sql = sql_queries.status_ratios('test', series, last, offset, build_num, per_build=True)
-        return self.session.query(sql), list_of_dicts
+        statement = sql_queries.status_ratios('test', series, last, offset, build_num, per_build=True)
+        return self.execute_prepared(*statement), list_of_dicts
 
     def recently_failing_tests(self, top, series, build_num, last, offset):
-        sql = sql_queries.recently_failing_tests(top, series, build_num, last, offset)
-        return self.session.query(sql), list_of_dicts
+        statement = sql_queries.recently_failing_tests(top, series, build_num, last, offset)
+        return self.execute_prepared(*statement), list_of_dicts
 
     def recently_failing_suites(self, top, series, build_num, last, offset):
-        sql = sql_queries.recently_failing_suites(top, series, build_num, last, offset)
-        return self.session.query(sql), list_of_dicts
+        statement = sql_queries.recently_failing_suites(top, series, build_num, last, offset)
+        return self.execute_prepared(*statement), list_of_dicts
 
     def keyword_tree(self, fingerprint):
         sql = "SELECT * FROM keyword_tree WHERE fingerprint=%(fingerprint)s"
         return self.session.query(sql, {'fingerprint': fingerprint}), single_dict
 
-    def subtrees(self, fingerprint):
-        return self.session.query(sql_queries.SUBTREES, {'fingerprint': fingerprint}), list_of_dicts
+    def keyword_trees(self, fingerprints, max_depth=None, max_nodes=None):
+        params = {
+            'fingerprints': list(fingerprints),
+            'max_depth': int(max_depth) if max_depth is not None else None,
+            'max_nodes': int(max_nodes) if max_nodes is not None else None,
+        }
+        return self.session.query(sql_queries.KEYWORD_TREES, params), keyword_tree_dicts
 
     def tree_execution_measures(self, fingerprint, series_id, build_num, last, offset):
-        sql = sql_queries.tree_execution_measures(fingerprint, series_id, build_num, last, offset)
-        return self.session.query(sql), single_dict
+        statement = sql_queries.tree_execution_measures(fingerprint, series_id, build_num, last, offset)
+        return self.execute_prepared(*statement), single_dict
+
+    async def execute_prepared(self, statement, parameters):
+        """Executes the statement prepared on the pooled connection that runs it.
+
+        The session picks any pooled connection for a query, so a statement that is not yet prepared
+        on that connection is prepared and executed in the same query.
+        """
+        if not self.prepare_statements:
+            return await self.session.query(statement.sql, parameters)
+        sql = statement.execute_sql()
+        for _ in range(PREPARE_ATTEMPTS):
+            try:
+                return await self.session.query(sql, parameters)
+            except pg_errors.InvalidSqlStatementName:
+                sql = statement.prepare_sql() + ';\n' + statement.execute_sql()
+            except pg_errors.DuplicatePreparedStatement:
+                sql = statement.execute_sql()
+        return await self.session.query(statement.sql, parameters)
+
+    def test_trends(self, series_id, days, test_id):
+        return self.session.query(sql_queries.test_trends(series_id, days, test_id)), list_of_dicts
 
 
 def single_dict(rows):
@@ -148,6 +290,41 @@ def list_of_dicts(rows):
     return results
 
 
+def results_by_build(rows):
+    # The times are left for the JSON encoder instead of walking every value of the large results
+    builds = defaultdict(list)
+    for row in rows:
+        builds[row.pop('build_number')].append(row)
+    return builds
+
+
+def results_without_build(rows):
+    return [result for results in results_by_build(rows).values() for result in results]
+
+
+def keyword_tree_dicts(rows):
+    """Assembles the rows of KEYWORD_TREES into keyword trees by their root fingerprint.
+
+    All the calls of the same subtree share the same list of children.
+    """
+    roots = {}
+    children = defaultdict(list)
+    for row in rows:
+        parent = row.pop('parent')
+        if parent is None:
+            del row['call_index']
+            roots[row['fingerprint']] = row
+        else:
+            children[parent].append(row)
+    for fingerprint, root in roots.items():
+        root['children'] = children.get(fingerprint, [])
+    for calls in children.values():
+        for call in calls:
+            if call['fingerprint'] in children:
+                call['children'] = children[call['fingerprint']]
+    return roots
+
+
 def metadata_dict(rows):
     metadata = defaultdict(lambda: {})
     for row in rows:
@@ -0,0 +1,133 @@
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from test_archiver import configs, daemon, database, output_parser
+except ImportError:
+    configs = None
+
+KEPT_FINISHED_JOBS = 1000
+
+
+def archiver_config(config):
+    """Resolves the TestArchiver configuration from the server configuration."""
+    archiver_configuration = configs.Config()
+    archiver_configuration.resolve(file_config={
+        'db_engine': config.get('db_engine', 'postgresql'),
+        'database': config['db_name'],
+        'host': config['db_host'],
+        'user': config['db_user'],
+        'password': config['db_password'],
+        'port': config.get('db_port', 5432),
+        'require_ssl': config.get('db_require_ssl', True),
+        'commit_every_files': 1,
+    })
+    return archiver_configuration
+
+
+class IngestQueue:
+    """Bounded pool of workers archiving uploaded result files with TestArchiver.
+
+    A slot is reserved when an upload starts so that uploads are rejected before their body is
+    received when all the workers are busy and the queue is full. Each worker thread keeps its
+    own database connection.
+    """
+
+    def __init__(self, config, spool_dir, workers=2, queue_size=10):
+        if configs is None:
+            raise RuntimeError("ERROR: Result ingest requires TestArchiver to be installed! "
+                               "Try for example: 'pip install testarchiver'")
+        self.config = archiver_config(config)
+        self.spool_dir = spool_dir
+        self.workers = workers
+        self.capacity = workers + queue_size
+        os.makedirs(spool_dir, exist_ok=True)
+        # The schema is checked once so that the workers can just connect
+        database.get_connection_and_check_schema(self.config).close()
+
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest-worker')
+        self._lock = threading.Lock()
+        self._reserved = 0
+        self._jobs = OrderedDict()
+        self._average_duration = 10.0
+
+    def reserve(self):
+        with self._lock:
+            if self._reserved >= self.capacity:
+                return False
+            self._reserved += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._reserved -= 1
+
+    def retry_after(self):
+        """Estimated seconds until a slot is free."""
+        with self._lock:
+            queued = max(self._reserved - self.workers + 1, 1)
+            return max(int(self._average_duration * queued / self.workers), 1)
+
+    def spool_file(self):
+        return tempfile.NamedTemporaryFile(dir=self.spool_dir, prefix='upload-', suffix='.xml',
+                                           delete=False)
+
+    def submit(self, upload_file, output_format, metadata):
+        """Queues a spooled upload for archiving. Requires a reserved slot."""
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = {'id': job_id, 'status': 'queued', 'format': output_format}
+        self._executor.submit(self._archive, job_id, upload_file, output_format, metadata)
+        return job_id
+
+    def job(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def _update_job(self, job_id, **values):
+        with self._lock:
+            self._jobs[job_id].update(values)
+            if values.get('status') not in ('queued', 'running'):
+                self._forget_finished_jobs()
+
+    def _forget_finished_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job['status'] not in ('queued', 'running')]
+        for job_id in finished[:max(len(finished) - KEPT_FINISHED_JOBS, 0)]:
+            del self._jobs[job_id]
+
+    def _connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = database.get_connection(self.config)
+        return self._local.connection
+
+    def _archive(self, job_id, upload_file, output_format, metadata):
+        start = time.monotonic()
+        self._update_job(job_id, status='running')
+        try:
+            connection = self._connection()
+            batch = output_parser.IngestBatch(connection)
+            batch.archive(upload_file, output_parser.parse_xml, upload_file, output_format, connection,
+                          daemon.file_config(self.config, metadata), commit=False)
+            if batch.failed:
+                self._update_job(job_id, status='failed')
+            elif batch.skipped:
+                self._update_job(job_id, status='skipped')
+            else:
+                self._update_job(job_id, status='archived')
+        except Exception as error: # pylint: disable=broad-except
+            # The connection is not usable anymore and is replaced for the next job
+            self._local.connection = None
+            self._update_job(job_id, status='failed', error=str(error))
+        finally:
+            os.remove(upload_file)
+            duration = time.monotonic() - start
+            with self._lock:
+                self._average_duration = 0.8 * self._average_duration + 0.2 * duration
+            self.release()
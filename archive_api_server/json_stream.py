@@ -0,0 +1,27 @@
+import datetime
+import json
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Encoded response bytes written before the response is flushed to the client
+FLUSH_SIZE = 64 * 1024
+
+
+def _default(value):
+    # Times are served in the same format as list_of_dicts produces
+    if isinstance(value, (datetime.time, datetime.date, datetime.datetime, datetime.timedelta)):
+        return str(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def dumps(value):
+    """Encodes the value to JSON bytes with orjson when it is installed."""
+    if orjson:
+        return orjson.dumps(value, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(value, default=_default, separators=(',', ':')).encode('utf-8')
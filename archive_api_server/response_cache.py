@@ -0,0 +1,59 @@
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """Bounded LRU cache of query results that is cleared whenever the archive changes.
+
+    The archive state is a cheap summary of the test_run table that changes whenever test runs are
+    archived, deleted or ignored. Results of queries that were started before an invalidation are
+    not stored. The cached results are shared between requests and must not be modified.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.archive_state = None
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Returns (found, results) for the key and marks it recently used."""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, self.entries[key]
+        self.misses += 1
+        return False, None
+
+    def put(self, key, results, generation):
+        if generation != self.generation:
+            return
+        self.entries[key] = results
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self):
+        self.entries.clear()
+        self.generation += 1
+        self.invalidations += 1
+
+    def update_archive_state(self, archive_state):
+        """Clears the cache if the archive state has changed. None means that the state is unknown."""
+        changed = self.archive_state is not None and archive_state != self.archive_state
+        self.archive_state = archive_state
+        if changed or archive_state is None:
+            self.invalidate()
+
+    def metrics(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0,
+            'invalidations': self.invalidations,
+        }
@@ -1,4 +1,6 @@
 import argparse
+import asyncio
+import hashlib
 import json
 import os
 import sys
@@ -7,14 +9,17 @@ import time
 
 
 import database as db
+import ingest
+import json_stream
+import response_cache
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
-from tornado import gen
 
 APP_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
 STATIC_DIRECTORY = os.path.abspath(os.path.join(APP_DIRECTORY, 'static'))
 TEMPLATES_DIRECTORY = os.path.abspath(os.path.join(APP_DIRECTORY, 'templates'))
+MAX_LOG_PAGE_SIZE = 10000
 
 
 def load_config_file(config_file):
@@ -39,6 +44,7 @@ class Application(tornado.web.Application):
             (r"/data/test_run/(?P<test_run_id>[0-9]+)/ignore/", IgnoreTestRunHandler),
             (r"/data/test_run/(?P<test_run_id>[0-9]+)/results/", TestRunResultsDataHandler),
             (r"/data/test_run/(?P<test_run_id>[0-9]+)/test_case/(?P<test_id>[0-9]+)/", TestCaseResultsDataHandler),
+            (r"/data/test_run/(?P<test_run_id>[0-9]+)/log_messages/", LogMessagesDataHandler),
             (r"/data/keyword_tree/(?P<fingerprint>[0-9a-f]{40})/", KeywordTreeDataHandler),
             (r"/data/keyword_tree/(?P<fingerprint>[0-9a-f]{40})/stats", KeywordTreeStatsDataHandler),
 
@@ -52,6 +58,13 @@ class Application(tornado.web.Application):
             (r"/data/series/(?P<series_id>[0-9]+)/build/(?P<build>[0-9]+)/suite_status_statistics/", SuiteStatusStatsDataHandler),
             (r"/data/suite_status_statistics/", SuiteStatusStatsDataHandler),
 
+            (r"/data/series/(?P<series_id>[0-9]+)/test_trends/", TestTrendsDataHandler),
+
+            (r"/data/ingest/", IngestUploadHandler),
+            (r"/data/ingest/(?P<job_id>[0-9a-f]{32})/", IngestJobHandler),
+
+            (r"/data/cache/", CacheMetricsHandler),
+
             # For query testing purposes only
             (r"/data/foo/", FooDataHandler),
         ]
@@ -60,125 +73,207 @@ class Application(tornado.web.Application):
             template_path=TEMPLATES_DIRECTORY,
             static_path=STATIC_DIRECTORY,
             debug=True,
+            # Gzip when the client accepts it, also the streamed responses
+            compress_response=True,
         )
         self.database = database
+        self.ingest = None
+        if config.get('ingest_spool_dir'):
+            self.ingest = ingest.IngestQueue(
+                config,
+                config['ingest_spool_dir'],
+                workers=int(config.get('ingest_workers', 2)),
+                queue_size=int(config.get('ingest_queue_size', 10)),
+            )
+        self.max_upload_size = int(config.get('ingest_max_upload_mb', 1024)) * 1024 * 1024
+        self.cache = None
+        cache_size = int(config.get('cache_size', 256))
+        if cache_size > 0:
+            self.cache = response_cache.ResponseCache(cache_size)
+        # The archive state is the version of the archive for the response cache and the ETags
+        self.archive_state = None
+        tornado.ioloop.IOLoop.current().add_callback(self.check_archive_state)
+        # PeriodicCallback does not run coroutines so each check is scheduled on the IOLoop
+        tornado.ioloop.PeriodicCallback(
+            lambda: tornado.ioloop.IOLoop.current().add_callback(self.check_archive_state),
+            float(config.get('cache_check_interval', 5)) * 1000,
+        ).start()
         tornado.web.Application.__init__(self, handlers, **settings)
 
+    async def check_archive_state(self):
+        rows, formatter = self.database.archive_state()
+        try:
+            rows = await rows
+            archive_state = formatter(rows)
+            rows.free()
+        except Exception as error:  # pylint: disable=broad-except
+            print("Checking the archive state failed: {}".format(error))
+            archive_state = None
+        self.archive_state = archive_state
+        if self.cache:
+            self.cache.update_archive_state(archive_state)
+
 
 class BaseHandler(tornado.web.RequestHandler):
+    # Responses that are determined by the archive state and the request are answered to
+    # If-None-Match before running any queries
+    conditional_get = True
+
     @property
     def database(self):
         return self.application.database
 
-    @gen.coroutine
-    def async_query(self, querer, *args, **kwargs):
+    def prepare(self):
+        if self.request.method != 'GET' or not self.conditional_get:
+            return
+        etag = self.request_etag()
+        if etag:
+            self.set_header('Etag', etag)
+            if self.check_etag_header():
+                self.set_status(304)
+                self.finish()
+
+    def request_etag(self):
+        archive_state = self.application.archive_state
+        if not archive_state:
+            return None
+        arguments = sorted((name, [value.decode('utf-8', 'replace') for value in values])
+                           for name, values in self.request.query_arguments.items())
+        inputs = [archive_state, self.request.path, arguments, self.etag_inputs()]
+        return '"{}"'.format(hashlib.sha1(json.dumps(inputs, default=str).encode('utf-8')).hexdigest())
+
+    def etag_inputs(self):
+        """Inputs of the response other than the archive state and the request."""
+        return None
+
+    async def async_query(self, querer, *args, **kwargs):
         rows, formatter = querer(*args, **kwargs)
-        rows = yield rows
+        rows = await rows
         results = formatter(rows)
-        if isinstance(rows, list):
-            for connection in rows:
-                connection.free()
-        else:
-            rows.free()
+        rows.free()
         return results
 
-    @gen.coroutine
-    def keyword_tree(self, fingerprint):
-        if not fingerprint:
-            return None
-        keyword_tree = yield self.async_query(self.database.keyword_tree, fingerprint)
-        if keyword_tree:
-            keyword_tree['children'] = []
-            keyword_tree = yield self.child_trees(keyword_tree)
-            return keyword_tree
-        else:
-            return None
+    async def cached_query(self, querer, *args):
+        """Like async_query but the results are kept in the response cache until the archive changes."""
+        cache = self.application.cache
+        if not cache:
+            results = await self.async_query(querer, *args)
+            return results
+        # Arguments are normalized so that the defaults and the same values given as arguments match
+        key = (querer.__name__,) + tuple(None if arg is None else str(arg) for arg in args)
+        found, results = cache.get(key)
+        if not found:
+            generation = cache.generation
+            results = await self.async_query(querer, *args)
+            cache.put(key, results, generation)
+        return results
+
+    def write_json(self, value):
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(json_stream.dumps(value))
+
+    async def write_json_list(self, key, items, extra=None):
+        """Writes {key: [items], **extra} encoding the items one by one and flushing as the response grows."""
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(b'{' + json_stream.dumps(key) + b':[')
+        unflushed = 0
+        for index, item in enumerate(items):
+            chunk = json_stream.dumps(item)
+            self.write(b',' + chunk if index else chunk)
+            unflushed += len(chunk)
+            if unflushed >= json_stream.FLUSH_SIZE:
+                await self.flush()
+                unflushed = 0
+        self.write(b']')
+        for name, value in (extra or {}).items():
+            self.write(b',' + json_stream.dumps(name) + b':' + json_stream.dumps(value))
+        self.write(b'}')
+
+    def build_cursor_arguments(self):
+        """Keyset pagination of builds: the builds before or after the given build number."""
+        before_build = self.get_argument('before_build', None)
+        after_build = self.get_argument('after_build', None)
+        return (int(before_build) if before_build is not None else None,
+                int(after_build) if after_build is not None else None)
+
+    async def write_build_results(self, series_id, builds):
+        # The results and metadata of all the builds are fetched with two concurrent queries
+        results, metadata = {}, {}
+        if builds:
+            build_numbers = [build['build_number'] for build in builds]
+            results, metadata = await asyncio.gather(
+                self.async_query(self.database.builds_results, series_id, build_numbers),
+                self.async_query(self.database.builds_metadata, series_id, build_numbers),
+            )
+
+        def builds_with_suites():
+            # Each build is assembled only when it is encoded and its rows are released after that
+            for build in builds:
+                yield dict(build, suites=_suites_with_tests(results.pop(build['build_number'], []), metadata))
+
+        await self.write_json_list('builds', builds_with_suites(), _build_cursors(builds))
+
+    async def keyword_trees(self, fingerprints):
+        fingerprints = {fingerprint for fingerprint in fingerprints if fingerprint}
+        if not fingerprints:
+            return {}
+        max_depth = self.get_argument('max_depth', None)
+        max_nodes = self.get_argument('max_nodes', None)
+        keyword_trees = await self.async_query(self.database.keyword_trees, fingerprints, max_depth, max_nodes)
+        return keyword_trees
+
+    async def keyword_tree(self, fingerprint):
+        keyword_trees = await self.keyword_trees([fingerprint])
+        return keyword_trees.get(fingerprint)
 
-    @gen.coroutine
-    def child_trees(self, keyword_tree):
-        children = yield self.async_query(self.database.subtrees, keyword_tree['fingerprint'])
-        for child in children:
-            child_tree = yield self.child_trees(child)
-            if 'children' not in keyword_tree:
-                keyword_tree['children'] = []
-            keyword_tree['children'].append(child_tree)
-        return keyword_tree
 
 class LastDataHandler(BaseHandler):
-    @gen.coroutine
-    def get(self):
-        last = yield self.async_query(self.database.last_update)
+    async def get(self):
+        last = await self.async_query(self.database.last_update)
         self.write({'last': last})
 
 class SeriesDataHandler(BaseHandler):
-    @gen.coroutine
-    def get(self):
-        series = yield self.async_query(self.database.test_series)
+    async def get(self):
+        series = await self.cached_query(self.database.test_series)
         self.write({'series': series})
 
 
 class TeamsDataHandler(BaseHandler):
-    @gen.coroutine
-    def get(self):
-        teams = yield self.async_query(self.database.teams)
+    async def get(self):
+        teams = await self.cached_query(self.database.teams)
         self.write({'teams': teams})
 
 class TypeDataHandler(BaseHandler):
-    @gen.coroutine
-    def get(self):
-        db_type = yield self.async_query(self.database.db_type)
+    async def get(self):
+        db_type = await self.async_query(self.database.db_type)
         self.write({'db_type': db_type})
 
 class BuildsDataHandler(BaseHandler):
-    @gen.coroutine
-    def get(self, series_id):
+    async def get(self, series_id):
         last = self.get_argument('last', 10)
         offset = self.get_argument('offset', 0)
         build = self.get_argument('build', None)
-        builds = yield self.async_query(self.database.builds, series_id, build, last, offset)
-        self.write({'builds': builds})
+        before_build, after_build = self.build_cursor_arguments()
+        builds = await self.async_query(self.database.builds, series_id, build, last, offset,
+                                        before_build, after_build)
+        self.write(dict(builds=builds, **_build_cursors(builds)))
 
 
 class BuildResultsDataHandler(BaseHandler):
 
-    @gen.coroutine
-    def get(self, series_id, build=None):
+    async def get(self, series_id, build=None):
         last = self.get_argument('last', 10)
         offset = self.get_argument('offset', 0)
         build = build if build else self.get_argument('build', None)
-        builds = yield self.async_query(self.database.builds, series_id, build, last, offset)
-
-        for build in builds:
-            results, metadata = yield [
-                self.async_query(self.database.build_results, series_id, build['build_number']),
-                self.async_query(self.database.build_metadata, series_id, build['build_number']),
-            ]
-            previous_suite_id = None
-            suite = None
-            build['suites'] = []
-            for result in results:
-                if previous_suite_id != result['suite_id']:
-                    if previous_suite_id:
-                        build['suites'].append(suite)
-                    suite = {key[6:]: result[key] for key in result if key.startswith('suite_')}
-                    relevant_metadata = metadata[(suite['id'], suite['test_run_id'])]
-                    suite['metadata'] = [{'name': name, 'value': relevant_metadata[name]} for name in relevant_metadata]
-                    suite['tests'] = []
-
-                if result['id']:
-                    test = {key: result[key] for key in result if not key.startswith('suite_')}
-                    suite['tests'].append(test)
-
-                previous_suite_id = result['suite_id']
-            if suite:
-                build['suites'].append(suite)
-
-        self.write({'builds': builds})
+        before_build, after_build = self.build_cursor_arguments()
+        builds = await self.async_query(self.database.builds, series_id, build, last, offset,
+                                        before_build, after_build)
+
+        await self.write_build_results(series_id, builds)
 
 class BuildResultsByTimeDataHandler1(BaseHandler):
     
-    @gen.coroutine
-    def get(self, series_id, start, end=None, build=None):
+    async def get(self, series_id, start, end=None, build=None):
         startInt = int(start)
         searchTimeStart = datetime.datetime.fromtimestamp(startInt)
         if end:
@@ -189,39 +284,15 @@ class BuildResultsByTimeDataHandler1(BaseHandler):
         last = self.get_argument('last', 100)
         offset = self.get_argument('offset', 0)
         build = build if build else self.get_argument('build', None)
-        builds = yield self.async_query(self.database.builds_by_time, series_id, build, last, offset, searchTimeStart, searchTimeEnd)
-
-        for build in builds:
-            results, metadata = yield [
-                self.async_query(self.database.build_results, series_id, build['build_number']),
-                self.async_query(self.database.build_metadata, series_id, build['build_number']),
-            ]
-            previous_suite_id = None
-            suite = None
-            build['suites'] = []
-            for result in results:
-                if previous_suite_id != result['suite_id']:
-                    if previous_suite_id:
-                        build['suites'].append(suite)
-                    suite = {key[6:]: result[key] for key in result if key.startswith('suite_')}
-                    relevant_metadata = metadata[(suite['id'], suite['test_run_id'])]
-                    suite['metadata'] = [{'name': name, 'value': relevant_metadata[name]} for name in relevant_metadata]
-                    suite['tests'] = []
-
-                if result['id']:
-                    test = {key: result[key] for key in result if not key.startswith('suite_')}
-                    suite['tests'].append(test)
-
-                previous_suite_id = result['suite_id']
-            if suite:
-                build['suites'].append(suite)
-
-        self.write({'builds': builds})
+        before_build, after_build = self.build_cursor_arguments()
+        builds = await self.async_query(self.database.builds_by_time, series_id, build, last, offset, searchTimeStart, searchTimeEnd,
+                                        before_build, after_build)
+
+        await self.write_build_results(series_id, builds)
 
 class BuildResultsByTimeDataHandler(BaseHandler):
 
-    @gen.coroutine
-    def get(self, series_id, startyear, startmonth, startday, starthour, startminute, endyear=None, endmonth=None, endday=None, endhour=None, endminute=None, build=None):
+    async def get(self, series_id, startyear, startmonth, startday, starthour, startminute, endyear=None, endmonth=None, endday=None, endhour=None, endminute=None, build=None):
         searchTimeStart = datetime.datetime(int(startyear), int(startmonth), int(startday), int(starthour), int(startminute))
         if endyear:
             searchTimeEnd = datetime.datetime(int(endyear), int(endmonth), int(endday), int(endhour), int(endminute))
@@ -230,109 +301,76 @@ class BuildResultsByTimeDataHandler(BaseHandler):
         last = self.get_argument('last', 10)
         offset = self.get_argument('offset', 0)
         build = build if build else self.get_argument('build', None)
-        builds = yield self.async_query(self.database.builds_by_time, series_id, build, last, offset, searchTimeStart, searchTimeEnd)
-
-        for build in builds:
-            results, metadata = yield [
-                self.async_query(self.database.build_results, series_id, build['build_number']),
-                self.async_query(self.database.build_metadata, series_id, build['build_number']),
-            ]
-            previous_suite_id = None
-            suite = None
-            build['suites'] = []
-            for result in results:
-                if previous_suite_id != result['suite_id']:
-                    if previous_suite_id:
-                        build['suites'].append(suite)
-                    suite = {key[6:]: result[key] for key in result if key.startswith('suite_')}
-                    relevant_metadata = metadata[(suite['id'], suite['test_run_id'])]
-                    suite['metadata'] = [{'name': name, 'value': relevant_metadata[name]} for name in relevant_metadata]
-                    suite['tests'] = []
-
-                if result['id']:
-                    test = {key: result[key] for key in result if not key.startswith('suite_')}
-                    suite['tests'].append(test)
-
-                previous_suite_id = result['suite_id']
-            if suite:
-                build['suites'].append(suite)
-
-        self.write({'builds': builds})
+        before_build, after_build = self.build_cursor_arguments()
+        builds = await self.async_query(self.database.builds_by_time, series_id, build, last, offset, searchTimeStart, searchTimeEnd,
+                                        before_build, after_build)
+
+        await self.write_build_results(series_id, builds)
 
 
 class TestRunDataHandler(BaseHandler):
 
-    @gen.coroutine
-    def get(self, test_run_id):
-        data = yield self.async_query(self.database.test_run_data, test_run_id)
+    async def get(self, test_run_id):
+        data = await self.async_query(self.database.test_run_data, test_run_id)
         self.write(data)
 
 class IgnoreTestRunHandler(BaseHandler):
 
-    @gen.coroutine
-    def post(self, test_run_id):
-        data = yield self.async_query(self.database.ignore_test_run, test_run_id)
+    async def post(self, test_run_id):
+        data = await self.async_query(self.database.ignore_test_run, test_run_id)
+        await self.application.check_archive_state()
         self.write(data)
 
 
 class TestRunResultsDataHandler(BaseHandler):
 
-    @gen.coroutine
-    def get(self, test_run_id):
-        results, metadata, builds = yield [
+    async def get(self, test_run_id):
+        results, metadata, builds = await asyncio.gather(
             self.async_query(self.database.test_run_results, test_run_id),
             self.async_query(self.database.test_run_metadata, test_run_id),
             self.async_query(self.database.included_in_builds, test_run_id),
-        ]
-        previous_suite_id = None
-        suite = None
-        test_run = {'suites': []}
-        for result in results:
-            if previous_suite_id != result['suite_id']:
-                if previous_suite_id:
-                    test_run['suites'].append(suite)
-                suite = {key[6:]: result[key] for key in result if key.startswith('suite_')}
-                relevant_metadata = metadata[(suite['id'], suite['test_run_id'])]
-                suite['metadata'] = [{'name': name, 'value': relevant_metadata[name]} for name in relevant_metadata]
-                suite['tests'] = []
-
-            if result['id']:
-                test = {key: result[key] for key in result if not key.startswith('suite_')}
-                suite['tests'].append(test)
-
-            previous_suite_id = result['suite_id']
-        if suite:
-            test_run['suites'].append(suite)
+        )
+        test_run = {'suites': _suites_with_tests(results, metadata)}
         test_run['included_in_builds'] = builds
-        self.write(test_run)
+        self.write_json(test_run)
 
 class TestCaseResultsDataHandler(BaseHandler):
 
-    @gen.coroutine
-    def get(self, test_run_id, test_id):
+    async def get(self, test_run_id, test_id):
         suites = []
-        parent_suite_results, test_results, metadata, log_message_map = yield [
+        parent_suite_results, test_results, metadata = await asyncio.gather(
                 self.async_query(self.database.parent_suite_results, test_run_id, test_id),
                 self.async_query(self.database.single_test_case_results, test_run_id, test_id),
                 self.async_query(self.database.test_run_metadata, test_run_id),
-                self.async_query(self.database.log_message_map, test_run_id),
-            ]
+            )
+        # All the keyword trees of the request are fetched with one query
+        fingerprints = [results['suite_{}_fingerprint'.format(phase)]
+                        for results in parent_suite_results + [test_results]
+                        for phase in ('setup', 'teardown')]
+        fingerprints += [test_results['{}_fingerprint'.format(phase)] for phase in ('setup', 'execution', 'teardown')]
+        # Only the log messages of the suites themselves and the test are read, not the whole run
+        log_keys = [(results['suite_id'], None) for results in parent_suite_results + [test_results]]
+        log_keys.append((test_results['suite_id'], test_results['id']))
+        keyword_trees, log_message_map = await asyncio.gather(
+            self.keyword_trees(fingerprints),
+            self.async_query(self.database.log_message_map, test_run_id, log_keys),
+        )
         for results in parent_suite_results:
             suite = _suite_related_values(results)
-            suite['setup'] = yield self.keyword_tree(suite['setup_fingerprint'])
-            suite['teardown'] = yield self.keyword_tree(suite['teardown_fingerprint'])
+            suite['setup'] = keyword_trees.get(suite['setup_fingerprint'])
+            suite['teardown'] = keyword_trees.get(suite['teardown_fingerprint'])
             relevant_metadata = metadata[(suite['id'], suite['test_run_id'])]
             suite['metadata'] = [{'name': name, 'value': relevant_metadata[name]} for name in relevant_metadata]
             suite['log_messages'] = log_message_map[(suite['id'], None)]
             suites.append(suite)
         suite = _suite_related_values(test_results)
-        suite['setup'] = yield self.keyword_tree(suite['setup_fingerprint'])
-        suite['teardown'] = yield self.keyword_tree(suite['teardown_fingerprint'])
+        suite['setup'] = keyword_trees.get(suite['setup_fingerprint'])
+        suite['teardown'] = keyword_trees.get(suite['teardown_fingerprint'])
         suite['log_messages'] = log_message_map[(suite['id'], None)]
         test = _non_suite_related_values(test_results)
-        test['setup'] = yield self.keyword_tree(test['setup_fingerprint'])
-        test['execution'] = yield self.keyword_tree(test['execution_fingerprint'])
-        test['teardown'] = yield self.keyword_tree(test['teardown_fingerprint'])
+        test['setup'] = keyword_trees.get(test['setup_fingerprint'])
+        test['execution'] = keyword_trees.get(test['execution_fingerprint'])
+        test['teardown'] = keyword_trees.get(test['teardown_fingerprint'])
         test['log_messages'] = log_message_map[(suite['id'], test['id'])]
         suite['tests'] = [test]
         relevant_metadata = metadata[(suite['id'], suite['test_run_id'])]
@@ -341,25 +379,61 @@ class TestCaseResultsDataHandler(BaseHandler):
         self.write({'suites': suites})
 
 
+class LogMessagesDataHandler(BaseHandler):
+    """Pages of the log messages of a test run, optionally of one suite or test.
+
+    The messages in cold storage come first and they are paged by their position in the segment,
+    the rest are paged by their ids. The next page is requested with the returned next value.
+    """
+
+    async def get(self, test_run_id):
+        suite_id = self.get_argument('suite', None)
+        test_id = self.get_argument('test', None)
+        limit = max(1, min(int(self.get_argument('limit', 1000)), MAX_LOG_PAGE_SIZE))
+        after = self.get_argument('after', None)
+        if after is None or after.startswith('a'):
+            archived = self.database.rehydrated_log_messages(test_run_id)
+            if archived is None:
+                archived = await self.async_query(self.database.log_segment, test_run_id)
+            archived = [message for message in archived
+                        if (suite_id is None or message['suite_id'] == int(suite_id))
+                        and (test_id is None or message['test_id'] == int(test_id))]
+            position = int(after[1:]) if after else 0
+            if position < len(archived):
+                end = position + limit
+                self.write({'log_messages': archived[position:end],
+                            'next': 'a{}'.format(end) if end < len(archived) else '0'})
+                return
+            after = '0'
+        messages, next_id = await self.async_query(self.database.log_message_page, test_run_id,
+                                                   suite_id, test_id, int(after), limit)
+        self.write({'log_messages': messages, 'next': str(next_id) if next_id is not None else None})
+
+
 class TestStatusStatsDataHandler(BaseHandler):
-    @gen.coroutine
-    def get(self, series_id=None, build=None):
+    async def get(self, series_id=None, build=None):
         series_id = series_id if series_id else self.get_argument('series', None)
         build = build if build else self.get_argument('build', None)
         last = self.get_argument('last', 10)
         offset = self.get_argument('offset', 0)
-        total, per_build = yield [
-            self.async_query(self.database.test_result_statistics, series_id, last, offset, build),
-            self.async_query(self.database.test_result_statistics_per_build, series_id, last, offset, build),
-        ]
+        total, per_build = await asyncio.gather(
+            self.cached_query(self.database.test_result_statistics, series_id, last, offset, build),
+            self.cached_query(self.database.test_result_statistics_per_build, series_id, last, offset, build),
+        )
         self.write({'total': total, 'per_build': per_build})
 
 
 class KeywordTreeDataHandler(BaseHandler):
-    @gen.coroutine
-    def get(self, fingerprint):
-        keyword_tree = yield self.keyword_tree(fingerprint)
+
+    def request_etag(self):
+        # Keyword trees are content addressed so the same url is always the same tree
+        arguments = sorted(self.request.query_arguments.items())
+        return '"{}"'.format(hashlib.sha1(repr([self.request.path, arguments]).encode('utf-8')).hexdigest())
+
+    async def get(self, fingerprint):
+        keyword_tree = await self.keyword_tree(fingerprint)
         if keyword_tree:
+            self.set_header('Cache-Control', 'public, max-age=31536000, immutable')
             self.write(keyword_tree)
         else:
             self.set_status(404)
@@ -368,13 +442,12 @@ class KeywordTreeDataHandler(BaseHandler):
 
 
 class KeywordTreeStatsDataHandler(BaseHandler):
-    @gen.coroutine
-    def get(self, fingerprint):
+    async def get(self, fingerprint):
         series = self.get_argument('series', None)
         build = self.get_argument('build', None)
         last = self.get_argument('last', None)
         offset = self.get_argument('offset', 0)
-        stats = yield self.async_query(self.database.tree_execution_measures, fingerprint,
+        stats = await self.async_query(self.database.tree_execution_measures, fingerprint,
                                        series, build, last, offset)
         if stats:
             self.write(stats)
@@ -384,48 +457,178 @@ class KeywordTreeStatsDataHandler(BaseHandler):
 
 
 class SuiteStatusStatsDataHandler(BaseHandler):
-    @gen.coroutine
-    def get(self, series_id=None, build=None):
+    async def get(self, series_id=None, build=None):
         series_id = series_id if series_id else self.get_argument('series', None)
         build = build if build else self.get_argument('build', None)
         last = self.get_argument('last', 10)
         offset = self.get_argument('offset', 0)
-        total, per_build = yield [
-            self.async_query(self.database.suite_result_statistics, series_id, last, offset, build),
-            self.async_query(self.database.suite_result_statistics_per_build, series_id, last, offset, build)
-        ]
+        total, per_build = await asyncio.gather(
+            self.cached_query(self.database.suite_result_statistics, series_id, last, offset, build),
+            self.cached_query(self.database.suite_result_statistics_per_build, series_id, last, offset, build)
+        )
         self.write({'total': total, 'per_build': per_build})
 
 
+class TestTrendsDataHandler(BaseHandler):
+
+    def etag_inputs(self):
+        # The days are counted back from today
+        return datetime.date.today().isoformat()
+
+    async def get(self, series_id):
+        days = self.get_argument('days', 365)
+        test_id = self.get_argument('test', None)
+        trends = await self.async_query(self.database.test_trends, series_id, days, test_id)
+        self.write({'days': trends})
+
+
 class RecentlyFailingTestsDataHandler(BaseHandler):
-    @gen.coroutine
-    def get(self, series_id=None, build=None):
+    async def get(self, series_id=None, build=None):
         series_id = series_id if series_id else self.get_argument('series', None)
         build = build if build else self.get_argument('build', None)
         top = self.get_argument('top', 10)
         last = self.get_argument('last', 10)
         offset = self.get_argument('offset', 0)
-        tests = yield self.async_query(self.database.recently_failing_tests, top, series_id, build, last, offset)
+        tests = await self.cached_query(self.database.recently_failing_tests, top, series_id, build, last, offset)
         self.write({'tests': tests})
 
 
 class RecentlyFailingSuitesDataHandler(BaseHandler):
-    @gen.coroutine
-    def get(self, series_id=None, build=None):
+    async def get(self, series_id=None, build=None):
         series_id = series_id if series_id else self.get_argument('series', None)
         build = build if build else self.get_argument('build', None)
         top = self.get_argument('top', 10)
         last = self.get_argument('last', 10)
         offset = self.get_argument('offset', 0)
-        suites = yield self.async_query(self.database.recently_failing_suites, top, series_id, build, last, offset)
+        suites = await self.cached_query(self.database.recently_failing_suites, top, series_id, build, last, offset)
         self.write({'suites': suites})
 
 
-class FooDataHandler(BaseHandler):
-    @gen.coroutine
+class CacheMetricsHandler(BaseHandler):
+    conditional_get = False
+
     def get(self):
+        if self.application.cache:
+            self.write(self.application.cache.metrics())
+        else:
+            self.set_status(404)
+            self.write({'Error': "Response cache is disabled"})
+
+
+@tornado.web.stream_request_body
+class IngestUploadHandler(BaseHandler):
+    """Receives a result file upload and queues it for archiving.
+
+    The request body is the result file, gzip encoded uploads are decompressed by the server.
+    The body is written to the spool directory as it is received instead of buffering it in memory.
+    """
+
+    def prepare(self):
+        self.upload = None
+        self.reserved = False
+        ingest_queue = self.application.ingest
+        if not ingest_queue:
+            self.set_status(404)
+            self.finish({'Error': "Result ingest is not enabled!"})
+            return
+        self.output_format = self.get_argument('format', 'robotframework').lower()
+        if self.output_format not in ingest.output_parser.SUPPORTED_OUTPUT_FORMATS:
+            self.set_status(400)
+            self.finish({'Error': "Unsupported format!", 'format': self.output_format})
+            return
+        if not ingest_queue.reserve():
+            self.set_status(429)
+            self.set_header('Retry-After', str(ingest_queue.retry_after()))
+            self.finish({'Error': "Too many queued uploads!"})
+            return
+        self.reserved = True
+        self.request.connection.set_max_body_size(self.application.max_upload_size)
+        self.upload = ingest_queue.spool_file()
+
+    def data_received(self, chunk):
+        self.upload.write(chunk)
+
+    def post(self):
+        self.upload.close()
+        metadata = {}
+        for name in ('team', 'repository'):
+            value = self.get_argument(name, None)
+            if value is not None:
+                metadata[name] = value
+        series = self.get_arguments('series')
+        if series:
+            metadata['series'] = series
+        metadata['metadata'] = self.get_arguments('metadata')
+        job_id = self.application.ingest.submit(self.upload.name, self.output_format, metadata)
+        # The slot is released by the worker when the job is done
+        self.reserved = False
+        self.upload = None
+        self.set_status(202)
+        self.set_header('Location', '/data/ingest/{}/'.format(job_id))
+        self.write({'job_id': job_id, 'status': 'queued'})
+
+    def on_finish(self):
+        self._discard_upload()
+
+    def on_connection_close(self):
+        self._discard_upload()
+
+    def _discard_upload(self):
+        if self.upload:
+            self.upload.close()
+            os.remove(self.upload.name)
+            self.upload = None
+        if self.reserved:
+            self.application.ingest.release()
+            self.reserved = False
+
+
+class IngestJobHandler(BaseHandler):
+    conditional_get = False
+
+    def get(self, job_id):
+        job = self.application.ingest.job(job_id) if self.application.ingest else None
+        if job:
+            self.write(job)
+        else:
+            self.set_status(404)
+            self.write({'Error': "Not found!", 'job_id': job_id})
+
+
+class FooDataHandler(BaseHandler):
+    async def get(self):
         self.write({'suites': []})
 
+def _build_cursors(builds):
+    # Cursors for requesting the older and the newer builds next to this page
+    build_numbers = [build['build_number'] for build in builds]
+    return {
+        'before_build': min(build_numbers) if build_numbers else None,
+        'after_build': max(build_numbers) if build_numbers else None,
+    }
+
+def _suites_with_tests(results, metadata):
+    previous_suite_id = None
+    suite = None
+    suites = []
+    for result in results:
+        if previous_suite_id != result['suite_id']:
+            if previous_suite_id:
+                suites.append(suite)
+            suite = {key[6:]: result[key] for key in result if key.startswith('suite_')}
+            relevant_metadata = metadata[(suite['id'], suite['test_run_id'])]
+            suite['metadata'] = [{'name': name, 'value': relevant_metadata[name]} for name in relevant_metadata]
+            suite['tests'] = []
+
+        if result['id']:
+            test = {key: result[key] for key in result if not key.startswith('suite_')}
+            suite['tests'].append(test)
+
+        previous_suite_id = result['suite_id']
+    if suite:
+        suites.append(suite)
+    return suites
+
 def _suite_related_values(result):
     return {key[6:]: result[key] for key in result if key.startswith('suite_')}
 
@@ -441,6 +644,22 @@ if __name__ == "__main__":
     parser.add_argument('--user', help='database user')
     parser.add_argument('--pw', '--password', help='database password')
     parser.add_argument('--port', help='database port (default: 5432)', default=5432, type=int)
+    parser.add_argument('--ingest-spool-dir', default=None,
+                        help='Enables result uploads to /data/ingest/ spooled to given directory')
+    parser.add_argument('--ingest-workers', default=2, type=int,
+                        help='number of workers archiving the uploaded results (default: 2)')
+    parser.add_argument('--ingest-queue-size', default=10, type=int,
+                        help='number of uploads queued before responding 429 (default: 10)')
+    parser.add_argument('--rehydrated-log-runs', default=32, type=int,
+                        help='number of test runs whose logs from cold storage are kept in memory (default: 32)')
+    parser.add_argument('--cache-size', default=256, type=int,
+                        help='number of cached series, statistics and failing test responses, 0 disables (default: 256)')
+    parser.add_argument('--cache-check-interval', default=5, type=float,
+                        help='seconds between checks whether the archive has changed (default: 5)')
+    parser.add_argument('--no-prepared-statements', dest='prepared_statements', action='store_false',
+                        help='do not prepare the statistics queries, e.g. behind a transaction mode connection pooler')
+    parser.add_argument('--db-driver', default='queries', choices=('queries', 'asyncpg'),
+                        help='database driver: psycopg2 through queries or the asyncpg connection pool (default: queries)')
     args = parser.parse_args()
 
     if args.config_file:
@@ -452,6 +671,14 @@ if __name__ == "__main__":
             'db_password': args.pw,
             'db_host': args.host,
             'port': args.port,
+            'ingest_spool_dir': args.ingest_spool_dir,
+            'ingest_workers': args.ingest_workers,
+            'ingest_queue_size': args.ingest_queue_size,
+            'rehydrated_log_runs': args.rehydrated_log_runs,
+            'cache_size': args.cache_size,
+            'cache_check_interval': args.cache_check_interval,
+            'prepared_statements': args.prepared_statements,
+            'db_driver': args.db_driver,
         }
 
     httpserver = tornado.httpserver.HTTPServer(
@@ -460,9 +687,14 @@ if __name__ == "__main__":
                 config['db_host'],
                 config['db_name'],
                 config['db_user'],
-                config['db_password']
+                config['db_password'],
+                rehydrated_runs=int(config.get('rehydrated_log_runs', 32)),
+                prepare_statements=config.get('prepared_statements', True),
+                driver=config.get('db_driver', 'queries'),
             ), config
-        )
+        ),
+        # Gzip encoded uploads are decompressed while they are streamed
+        decompress_request=True,
     )
     httpserver.listen(int(config['port']))
     print("Server listening port {}".format(config['port']))
@@ -44,12 +44,37 @@ GROUP BY id, name, team
 ORDER BY team, last_generated DESC, last_started DESC, last_imported DESC;
 """
 
-SUBTREES = """
-SELECT keyword_tree.fingerprint, keyword, library, status, arguments, call_index
+# All the calls in the keyword trees of the given root fingerprints in one round trip. Each subtree is
+# expanded once per depth it is reached at. The depth of a subtree is counted along its shallowest path
+# and the node limit keeps the shallowest subtrees. The roots have NULL parent.
+KEYWORD_TREES = """
+WITH RECURSIVE reachable(fingerprint, depth) AS (
+    SELECT fingerprint, 0
+    FROM keyword_tree
+    WHERE fingerprint = ANY(%(fingerprints)s)
+  UNION
+    SELECT tree_hierarchy.subtree, reachable.depth + 1
+    FROM reachable
+    JOIN tree_hierarchy ON tree_hierarchy.fingerprint=reachable.fingerprint
+    WHERE %(max_depth)s::int IS NULL OR reachable.depth < %(max_depth)s
+), nodes AS (
+    SELECT fingerprint, min(depth) as depth
+    FROM reachable
+    GROUP BY fingerprint
+    ORDER BY min(depth), fingerprint
+    LIMIT %(max_nodes)s
+)
+SELECT NULL as parent, NULL::int as call_index, keyword_tree.*
 FROM keyword_tree
-JOIN tree_hierarchy ON tree_hierarchy.subtree=keyword_tree.fingerprint
-WHERE tree_hierarchy.fingerprint=%(fingerprint)s
-ORDER BY call_index;
+WHERE fingerprint = ANY(%(fingerprints)s)
+UNION ALL
+SELECT tree_hierarchy.fingerprint, tree_hierarchy.call_index, keyword_tree.*
+FROM nodes
+JOIN tree_hierarchy ON tree_hierarchy.fingerprint=nodes.fingerprint
+JOIN nodes as child ON child.fingerprint=tree_hierarchy.subtree
+JOIN keyword_tree ON keyword_tree.fingerprint=tree_hierarchy.subtree
+WHERE %(max_depth)s::int IS NULL OR nodes.depth < %(max_depth)s
+ORDER BY parent NULLS FIRST, call_index;
 """
 
 METADATA = """
@@ -62,8 +87,9 @@ ORDER BY suite_id, test_run_id;
 """
 
 
-def build_metadata(series, build_num):
-    return METADATA.format(test_run_ids=test_run_ids(series, build_num))
+def builds_metadata(series, build_numbers):
+    return METADATA.format(
+        test_run_ids="SELECT test_run_id FROM ({}) AS build_runs".format(build_runs(series, build_numbers)))
 
 
 def test_run_metadata(test_run_id):
@@ -80,13 +106,36 @@ WHERE test_run.id={}
 GROUP BY test_run.id, imported_at, archived_using, generator, generated, rpa, dryrun, ignored
 """.format(int(test_run_id))
 
-def builds(series, build_num, last, offset):
+def build_page(series, build_num, last, offset, before_build=None, after_build=None, suite_result_filter=''):
+    # Build numbers of one page of builds, sought from series_build_index instead of aggregating and
+    # skipping all the newer builds. A page after a build is sought upwards from it.
+    filters = []
     if build_num:
-        build_number_filter = "AND build_number={}".format(int(build_num))
-        last_limits = ""
-    else:
-        build_number_filter = ""
-        last_limits = "LIMIT {last} OFFSET {offset}".format(last=int(last), offset=int(offset))
+        filters.append("AND build_number={}".format(int(build_num)))
+    if before_build is not None:
+        filters.append("AND build_number < {}".format(int(before_build)))
+    if after_build is not None:
+        filters.append("AND build_number > {}".format(int(after_build)))
+    return """
+SELECT DISTINCT build_number
+FROM test_series_mapping as tsm
+JOIN test_run ON test_run.id=tsm.test_run_id
+WHERE series={series} AND NOT ignored
+    {filters}
+    AND EXISTS (SELECT 1 FROM suite_result
+                WHERE suite_result.test_run_id=tsm.test_run_id {suite_result_filter})
+ORDER BY build_number {direction}
+{limits}
+""".format(
+        series=int(series),
+        filters=' '.join(filters),
+        suite_result_filter=suite_result_filter,
+        direction='ASC' if after_build is not None and before_build is None else 'DESC',
+        limits='' if build_num else "LIMIT {} OFFSET {}".format(int(last), int(offset)),
+    )
+
+
+def builds(series, build_num, last, offset, before_build=None, after_build=None):
     return """
 SELECT build_number, array_agg(test_run_id) as test_run_ids,
         min(started_at) as started_at
@@ -96,39 +145,86 @@ FROM (
     JOIN suite_result ON suite_result.test_run_id=tsm.test_run_id
     JOIN test_run ON test_run.id=tsm.test_run_id
     WHERE series={series} AND NOT ignored
-        {build_number_filter}
+        AND build_number IN ({build_page})
     GROUP BY build_number, tsm.test_run_id
 ) as test_runs
 GROUP BY build_number
 ORDER BY build_number DESC
-{last_limits}
-""".format(series=int(series), build_number_filter=build_number_filter, last_limits=last_limits)
+""".format(series=int(series),
+           build_page=build_page(series, build_num, last, offset, before_build, after_build))
 
 
-def latest_build_numbers(series, last, offset):
+def latest_build_numbers():
     return """
 SELECT build_number
 FROM test_series_mapping as tsm
 JOIN test_run ON test_run.id=tsm.test_run_id
-WHERE series={series}
+WHERE series=%(series)s
   AND NOT ignored
 ORDER BY build_number DESC
-LIMIT {last} OFFSET {offset}
-""".format(
-        series=int(series),
-        last=int(last),
-        offset=int(offset),
-    )
+LIMIT %(last)s OFFSET %(offset)s
+"""
+
+
+class PreparedStatement:
+    """Statement with %(name)s placeholders that is prepared on the server when it is first executed.
+
+    All the statements take the same typed parameters in STATEMENT_PARAMETERS, so the statements differ
+    only by the SQL that depends on the shape of the request, e.g. whether a series is given or not.
+    """
 
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
 
-def test_run_ids(series=None, build_num=None, last=None, offset=None):
+    def prepare_sql(self):
+        sql = self.sql
+        for index, (parameter, _) in enumerate(STATEMENT_PARAMETERS, 1):
+            sql = sql.replace('%({})s'.format(parameter), '${}'.format(index))
+        types = ', '.join(parameter_type for _, parameter_type in STATEMENT_PARAMETERS)
+        return 'PREPARE {}({}) AS {}'.format(self.name, types, sql)
+
+    def execute_sql(self):
+        parameters = ', '.join('%({})s'.format(parameter) for parameter, _ in STATEMENT_PARAMETERS)
+        return 'EXECUTE {}({})'.format(self.name, parameters)
+
+
+STATEMENT_PARAMETERS = (
+    ('series', 'int'),
+    ('build_num', 'int'),
+    ('last', 'int'),
+    ('offset', 'int'),
+    ('top', 'int'),
+    ('fingerprint', 'text'),
+)
+
+
+def statement_parameters(series=None, build_num=None, last=None, offset=None, top=None, fingerprint=None):
+    return {
+        'series': int(series) if series else None,
+        'build_num': int(build_num) if build_num else None,
+        'last': int(last) if last else None,
+        'offset': int(offset) if offset else 0,
+        'top': int(top) if top else None,
+        'fingerprint': fingerprint,
+    }
+
+
+def _statement(name, sql, parameters):
+    # The shape of the filters is part of the name so each name always has the same SQL
+    shape = ''.join(flag for flag, parameter in (('s', 'series'), ('b', 'build_num'), ('l', 'last'))
+                    if parameters[parameter] is not None)
+    return PreparedStatement('{}_{}'.format(name, shape) if shape else name, sql), parameters
+
+
+def test_run_ids(parameters):
     filters = []
-    if series:
-        filters.append("series={series_id}".format(series_id=int(series)))
-        if build_num:
-            filters.append("build_number={}".format(int(build_num)))
-        elif last:
-            filters.append("build_number IN ({})".format(latest_build_numbers(series, last, offset)))
+    if parameters['series'] is not None:
+        filters.append("series=%(series)s")
+        if parameters['build_num'] is not None:
+            filters.append("build_number=%(build_num)s")
+        elif parameters['last'] is not None:
+            filters.append("build_number IN ({})".format(latest_build_numbers()))
 
     return """
 SELECT test_run_id
@@ -140,9 +236,15 @@ ORDER BY build_number, test_run_id
 """.format(filters='AND ' + ' AND '.join(filters) if filters else '')
 
 
+# Results of the test runs of builds, build_runs selects the (build_number, test_run_id) pairs.
+# The results of each build are collected separately so that builds sharing test runs are possible.
 RESULTS_QUERY = """
+WITH build_runs AS (
+{build_runs}
+)
 SELECT * FROM (
-    SELECT DISTINCT ON (suite.id, test_results.id)
+    SELECT DISTINCT ON (build_runs.build_number, suite.id, test_results.id)
+        build_runs.build_number as build_number,
         suite.id as suite_id, suite.name as suite_name, suite.full_name as suite_full_name,
         suite.repository as suite_repository,
         suite_result.test_run_id as suite_test_run_id,
@@ -176,38 +278,51 @@ SELECT * FROM (
         test_results.execution_elapsed as execution_elapsed,
         test_results.teardown_elapsed as teardown_elapsed,
         CASE WHEN tags IS NULL THEN '{array_literal}' ELSE tags END as tags
-    FROM suite_result
+    FROM build_runs
+    JOIN suite_result ON suite_result.test_run_id=build_runs.test_run_id
     JOIN suite ON suite.id=suite_result.suite_id
     JOIN test_run ON test_run.id=suite_result.test_run_id
     LEFT OUTER JOIN (
-        SELECT DISTINCT ON (test_case.id) *
-        FROM test_result
+        SELECT DISTINCT ON (build_runs.build_number, test_case.id) build_runs.build_number, test_result.*, test_case.*
+        FROM build_runs
+        JOIN test_result ON test_result.test_run_id=build_runs.test_run_id
         JOIN test_case ON test_case.id=test_result.test_id
-        WHERE test_run_id IN ({test_run_ids})
-        ORDER BY test_case.id, start_time DESC, test_run_id DESC
+        ORDER BY build_runs.build_number, test_case.id, test_result.start_time DESC, test_result.test_run_id DESC
     ) as test_results ON test_results.suite_id=suite.id
                      AND test_results.test_run_id=suite_result.test_run_id
+                     AND test_results.build_number IS NOT DISTINCT FROM build_runs.build_number
     LEFT OUTER JOIN (
         SELECT array_agg(tag ORDER BY tag) as tags, test_id, test_run_id
         FROM test_tag
-        WHERE test_run_id IN ({test_run_ids})
+        WHERE test_run_id IN (SELECT test_run_id FROM build_runs)
         GROUP BY test_id, test_run_id
     ) as test_tags ON test_tags.test_id=test_results.test_id
                   AND test_tags.test_run_id=test_results.test_run_id
-    WHERE suite_result.test_run_id IN ({test_run_ids})
-      AND NOT ignored
-    ORDER BY suite_id, test_results.id, suite_start_time DESC, suite_test_run_id DESC
+    WHERE NOT ignored
+    ORDER BY build_runs.build_number, suite_id, test_results.id, suite_start_time DESC, suite_test_run_id DESC
 ) AS results
-ORDER BY suite_full_name, start_time NULLS LAST, full_name
+ORDER BY build_number DESC, suite_full_name, start_time NULLS LAST, full_name
 """
 
 
-def build_results(series, build_num):
-    return RESULTS_QUERY.format(array_literal='{}', test_run_ids=test_run_ids(series, build_num))
+def build_runs(series, build_numbers):
+    return """
+SELECT build_number, tsm.test_run_id
+FROM test_series_mapping as tsm
+JOIN test_run ON test_run.id=tsm.test_run_id
+WHERE series={series}
+  AND build_number IN ({build_numbers})
+  AND NOT ignored
+""".format(series=int(series), build_numbers=', '.join(str(int(build_num)) for build_num in build_numbers))
+
+
+def builds_results(series, build_numbers):
+    return RESULTS_QUERY.format(array_literal='{}', build_runs=build_runs(series, build_numbers))
 
 
 def test_run_results(test_run_id):
-    return RESULTS_QUERY.format(array_literal='{}', test_run_ids=int(test_run_id))
+    runs = "SELECT NULL::int as build_number, {} as test_run_id".format(int(test_run_id))
+    return RESULTS_QUERY.format(array_literal='{}', build_runs=runs)
 
 
 def single_test_result(test_run_id, test_id):
@@ -319,12 +434,14 @@ ORDER BY team, name, test_series_mapping.build_number DESC
 
 
 def status_ratios(object_type, series, last, offset, build_num, per_build):
+    # Build based like the other statistics, so results compacted into test_result_daily are not included
+    parameters = statement_parameters(series, build_num, last, offset)
     filters = []
-    if series:
-        filters.append(" tsm.series={} ".format(int(series)))
+    if parameters['series'] is not None:
+        filters.append(" tsm.series=%(series)s ")
         filters.append(
             " tsm.test_run_id IN ({test_run_ids})".format(
-                test_run_ids=test_run_ids(series, build_num, last, offset),
+                test_run_ids=test_run_ids(parameters),
                 )
         )
     target_table = ''
@@ -333,7 +450,7 @@ def status_ratios(object_type, series, last, offset, build_num, per_build):
     elif object_type == 'suite':
         target_table = ("FROM suite_result as result JOIN suite ON suite.id=result.suite_id "
                         "AND suite.id IN (SELECT suite_id FROM test_case)")
-    return """
+    sql = """
 SELECT max(build_number) as build, series,
     count(*) as total,
     count(nullif(status<>'PASS', true)) as passed,
@@ -352,10 +469,14 @@ WHERE NOT ignored {filters}
         grouping="GROUP BY series, build_number" if per_build else "GROUP BY series",
         ordering="ORDER BY series, build_number DESC" if per_build else "ORDER BY series",
     )
+    name = 'status_ratios_{}{}'.format(object_type, '_per_build' if per_build else '')
+    return _statement(name, sql, parameters)
 
 
 def recently_failing_tests(top, series_id, build_num, last, offset):
-    return """
+    parameters = statement_parameters(series_id, build_num, last, offset, top=top)
+    name = 'recently_failing_tests'
+    sql = """
 SELECT id, name, full_name, suite_id,
     count(nullif(status, 'PASS')) as fails,
     sum(failiness) as failiness
@@ -370,20 +491,19 @@ FROM (
     FROM test_result as result
     JOIN test_series_mapping as tsm ON tsm.test_run_id=result.test_run_id
     JOIN test_case ON test_case.id=result.test_id
-    WHERE tsm.series={series_id}
+    WHERE tsm.series=%(series)s
         AND result.test_run_id IN ({test_run_ids})
 ) AS failinesses
 GROUP BY id, name, full_name, suite_id
-ORDER BY failiness DESC LIMIT {top};
-""".format(
-        test_run_ids=test_run_ids(series_id, build_num, last, offset),
-        series_id=int(series_id),
-        top=int(top),
-    )
+ORDER BY failiness DESC LIMIT %(top)s;
+""".format(test_run_ids=test_run_ids(parameters))
+    return _statement(name, sql, parameters)
 
 
 def recently_failing_suites(top, series_id, build_num, last, offset):
-    return """
+    parameters = statement_parameters(series_id, build_num, last, offset, top=top)
+    name = 'recently_failing_suites'
+    sql = """
 SELECT id, name, full_name,
     count(nullif(status, 'PASS')) as fails,
     sum(failiness) as failiness
@@ -398,21 +518,19 @@ FROM (
     FROM suite_result as result
     JOIN test_series_mapping as tsm ON tsm.test_run_id=result.test_run_id
     JOIN suite ON suite.id=result.suite_id
-    WHERE tsm.series={series_id}
+    WHERE tsm.series=%(series)s
         AND result.test_run_id IN ({test_run_ids})
         AND suite.id IN (SELECT suite_id FROM test_case)
 ) AS failinesses
 GROUP BY id, name, full_name
-ORDER BY failiness DESC LIMIT {top};
-""".format(
-        test_run_ids=test_run_ids(series_id, build_num, last, offset),
-        series_id=int(series_id),
-        top=int(top),
-    )
+ORDER BY failiness DESC LIMIT %(top)s;
+""".format(test_run_ids=test_run_ids(parameters))
+    return _statement(name, sql, parameters)
 
 
 def tree_execution_measures(fingerprint, series_id, build_num, last, offset):
-    return """
+    parameters = statement_parameters(series_id, build_num, last, offset, fingerprint=fingerprint)
+    sql = """
 SELECT sum(calls) as calls,
        max(max_execution_time) as max_elapsed,
        min(min_execution_time) as min_elapsed,
@@ -420,33 +538,112 @@ SELECT sum(calls) as calls,
        max(max_call_depth) as max_call_depth
 FROM keyword_statistics as stats
 JOIN keyword_tree as kw ON kw.fingerprint=stats.fingerprint
-WHERE test_run_id IN ({test_run_ids}) AND stats.fingerprint='{fingerprint}'
+WHERE test_run_id IN ({test_run_ids}) AND stats.fingerprint=%(fingerprint)s
 GROUP BY keyword
 ORDER BY calls desc;
-""".format(
-        test_run_ids=test_run_ids(series_id, build_num, last, offset),
-        fingerprint=fingerprint,
-    )
-
-def log_messages(test_run_id):
+""".format(test_run_ids=test_run_ids(parameters))
+    return _statement('tree_execution_measures', sql, parameters)
+
+def _log_message_filter(keys):
+    # Messages of the given (suite_id, test_id) pairs, test_id None for the messages of the suite itself.
+    # The conditions match the test_log_message_index on (test_run_id, suite_id, test_id).
+    if keys is None:
+        return ''
+    conditions = [
+        "(suite_id={} AND test_id{})".format(
+            int(suite_id), ' IS NULL' if test_id is None else '={}'.format(int(test_id)))
+        for suite_id, test_id in sorted(set(keys), key=str)
+    ]
+    return "AND ({})".format(' OR '.join(conditions) if conditions else 'false')
+
+def log_messages(test_run_id, keys=None):
     return """
 SELECT test_run_id, test_id, suite_id,
        timestamp, log_level, message
 FROM log_message
+WHERE test_run_id={test_run_id} {key_filter}
+ORDER BY timestamp, id
+""".format(test_run_id=int(test_run_id), key_filter=_log_message_filter(keys))
+
+def log_messages_with_segment(test_run_id, keys=None):
+    # One statement so that a run moved to cold storage meanwhile is seen either before or after
+    return """
+SELECT test_run_id, test_id, suite_id, timestamp, log_level, message,
+       id, NULL::bytea AS segment, NULL::text AS compression
+FROM log_message
+WHERE test_run_id={test_run_id} {key_filter}
+UNION ALL
+SELECT test_run_id, NULL, NULL, NULL, NULL, NULL, NULL, segment, compression
+FROM log_archive
 WHERE test_run_id={test_run_id}
 ORDER BY timestamp, id
-""".format(test_run_id=int(test_run_id))
+""".format(test_run_id=int(test_run_id), key_filter=_log_message_filter(keys))
+
+def log_message_page(test_run_id, suite_id, test_id, after_id, limit):
+    # Keyset paging in archiving order, one extra row tells whether there is a next page
+    filters = []
+    if suite_id is not None:
+        filters.append("AND suite_id={}".format(int(suite_id)))
+    if test_id is not None:
+        filters.append("AND test_id={}".format(int(test_id)))
+    return """
+SELECT id, test_run_id, test_id, suite_id, timestamp, log_level, message
+FROM log_message
+WHERE test_run_id={test_run_id} {filters}
+  AND id > {after_id}
+ORDER BY id
+LIMIT {limit}
+""".format(test_run_id=int(test_run_id), filters=' '.join(filters), after_id=int(after_id), limit=int(limit) + 1)
+
+LOG_SEGMENT = """
+SELECT segment, compression FROM log_archive WHERE test_run_id=%(test_run_id)s
+"""
+
+def test_trends(series_id, days, test_id=None):
+    # Compacted history comes from test_result_daily and the rest is rolled up from the live results
+    return """
+SELECT day, sum(runs) as runs, sum(passes) as passes, sum(fails) as fails, sum(skips) as skips,
+       min(min_elapsed) as min_elapsed,
+       sum(avg_elapsed * elapsed_count) / nullif(sum(elapsed_count), 0) as avg_elapsed,
+       max(max_elapsed) as max_elapsed,
+       max(p95_elapsed) as p95_elapsed
+FROM (
+    SELECT day, runs, passes, fails, skips, elapsed_count, min_elapsed, avg_elapsed, max_elapsed, p95_elapsed
+    FROM test_result_daily
+    WHERE series={series_id} AND day >= current_date - {days} {daily_test_filter}
+    UNION ALL
+    SELECT coalesce(result.start_time, test_run.imported_at)::date as day,
+           count(*) as runs,
+           count(nullif(result.status<>'PASS', true)) as passes,
+           count(nullif(result.status<>'FAIL', true)) as fails,
+           count(nullif(result.status NOT IN ('SKIP', 'SKIPPED'), true)) as skips,
+           count(result.elapsed) as elapsed_count,
+           min(result.elapsed) as min_elapsed,
+           avg(result.elapsed) as avg_elapsed,
+           max(result.elapsed) as max_elapsed,
+           percentile_disc(0.95) WITHIN GROUP (ORDER BY result.elapsed) as p95_elapsed
+    FROM test_result as result
+    JOIN test_series_mapping as tsm ON tsm.test_run_id=result.test_run_id
+    JOIN test_run ON test_run.id=result.test_run_id
+    WHERE tsm.series={series_id} AND NOT test_run.ignored {result_test_filter}
+        AND coalesce(result.start_time, test_run.imported_at) >= current_date - {days}
+    GROUP BY 1, result.test_id
+) AS daily
+GROUP BY day
+ORDER BY day;
+""".format(
+        series_id=int(series_id),
+        days=int(days),
+        daily_test_filter="AND test_id={}".format(int(test_id)) if test_id else '',
+        result_test_filter="AND result.test_id={}".format(int(test_id)) if test_id else '',
+    )
 
 if __name__ == '__main__':
-    print(status_ratios('test', 8, 40, 10, 0, True))
+    print(status_ratios('test', 8, 40, 10, 0, True)[0].prepare_sql())
 
-def builds_by_time(series, build_num, last, offset, searchTimeStart, searchTimeEnd):
-    if build_num:
-        build_number_filter = "AND build_number={}".format(int(build_num))
-        last_limits = ""
-    else:
-        build_number_filter = ""
-        last_limits = "LIMIT {last} OFFSET {offset}".format(last=int(last), offset=int(offset))
+def builds_by_time(series, build_num, last, offset, searchTimeStart, searchTimeEnd, before_build=None,
+                   after_build=None):
+    time_filter = "AND suite_result.start_time BETWEEN %(start_time)s AND %(end_time)s"
     return """
 SELECT build_number, array_agg(test_run_id) as test_run_ids,
         min(started_at) as started_at
@@ -455,11 +652,11 @@ FROM (
     FROM test_series_mapping as tsm
     JOIN suite_result ON suite_result.test_run_id=tsm.test_run_id
     JOIN test_run ON test_run.id=tsm.test_run_id
-    WHERE series={series} AND suite_result.start_time BETWEEN '{searchTimeStart}' AND '{searchTimeEnd}' AND NOT ignored
-        {build_number_filter}
+    WHERE series={series} {time_filter} AND NOT ignored
+        AND build_number IN ({build_page})
     GROUP BY build_number, tsm.test_run_id
 ) as test_runs
 GROUP BY build_number
 ORDER BY build_number DESC
-{last_limits}
-""".format(series=int(series), build_number_filter=build_number_filter, last_limits=last_limits, searchTimeStart=searchTimeStart, searchTimeEnd=searchTimeEnd)
+""".format(series=int(series), time_filter=time_filter,
+           build_page=build_page(series, build_num, last, offset, before_build, after_build, time_filter))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import argparse
+import statistics
+import time
+import urllib.request
+
+DESCRIPTION = """
+Benchmark for the response latencies of the archive API server statistics endpoints.
+Requests each endpoint repeatedly from a running server and reports the p50 and p99
+latencies. Compare the prepared statements with a server started with
+--no-prepared-statements and --cache-size 0 so that the queries are run for every request.
+"""
+
+USAGE_EXAMPLE = """
+Example usage: python helpers/benchmark_api_latency.py --url http://localhost:8888 --series 2
+"""
+
+STATISTICS_ENDPOINTS = (
+    '/data/series/{series}/test_status_statistics/',
+    '/data/series/{series}/suite_status_statistics/',
+    '/data/series/{series}/recently_failing_tests/',
+    '/data/series/{series}/recently_failing_suites/',
+    '/data/test_status_statistics/',
+)
+
+
+def main():
+    args = argument_parser().parse_args()
+
+    print(f"{'endpoint':<56} {'p50 ms':>10} {'p99 ms':>10}")
+    for endpoint in args.endpoints or STATISTICS_ENDPOINTS:
+        path = endpoint.format(series=args.series)
+        latencies = benchmark(args.url.rstrip('/') + path, args)
+        print(f"{path:<56} {percentile(latencies, 0.5):>10.1f} {percentile(latencies, 0.99):>10.1f}")
+
+
+def benchmark(url, args):
+    for _ in range(args.warmup):
+        request(url)
+    latencies = []
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        request(url)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def request(url):
+    # No If-None-Match so that the server never answers from the ETag alone
+    with urllib.request.urlopen(url) as response:
+        response.read()
+
+
+def percentile(values, fraction):
+    if fraction == 0.5:
+        return statistics.median(values)
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description=DESCRIPTION, epilog=USAGE_EXAMPLE)
+    parser.add_argument('--url', default='http://localhost:8888', help='Address of the archive API server')
+    parser.add_argument('--series', type=int, default=1, help='Series id used in the endpoints')
+    parser.add_argument('--requests', type=int, default=200, help='Number of measured requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=10, help='Number of unmeasured requests per endpoint')
+    parser.add_argument('--endpoints', nargs='+', default=None,
+                        help='Endpoints to benchmark, {series} is replaced with the series id')
+    return parser
+
+
+if __name__ == '__main__':
+    main()
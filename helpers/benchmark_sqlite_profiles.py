@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import tempfile
+import time
+
+from test_archiver import archiver, configs, database
+
+DESCRIPTION = """
+Benchmark for comparing the archiving speed of the SQLite tuning profiles.
+Archives synthetic test runs into a fresh SQLite archive with each profile
+and reports the number of rows written per second.
+"""
+
+USAGE_EXAMPLE = """
+Example usage: PYTHONPATH=src python helpers/benchmark_sqlite_profiles.py --runs 20
+"""
+
+ARCHIVED_TABLES = ('test_run', 'suite_result', 'test_result', 'log_message', 'test_tag',
+                   'suite_metadata', 'keyword_tree', 'tree_hierarchy', 'keyword_statistics',
+                   'test_series_mapping')
+
+
+def main():
+    args = argument_parser().parse_args()
+
+    print(f"{'profile':<32} {'rows':>10} {'seconds':>10} {'rows/s':>12}")
+    for profile in args.profiles:
+        for defer_foreign_keys in (False, True):
+            rows, elapsed = benchmark(profile, defer_foreign_keys, args)
+            name = profile + (' (deferred foreign keys)' if defer_foreign_keys else '')
+            print(f"{name:<32} {rows:>10} {elapsed:>10.2f} {rows/elapsed:>12.0f}")
+
+
+def benchmark(profile, defer_foreign_keys, args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = configs.Config()
+        config.resolve(file_config={
+            'database': os.path.join(temp_dir, 'benchmark.db'),
+            'sqlite_profile': profile,
+            'sqlite_defer_foreign_keys': defer_foreign_keys,
+            'series': ['Benchmark'],
+            })
+        connection = database.get_connection_and_check_schema(config)
+        start = time.perf_counter()
+        for run in range(args.runs):
+            archive_synthetic_run(connection, config, run, args)
+        elapsed = time.perf_counter() - start
+        rows = sum(connection.get_row_count(table) for table in ARCHIVED_TABLES)
+    return rows, elapsed
+
+
+def archive_synthetic_run(connection, config, run, args):
+    test_archiver = archiver.Archiver(connection, config)
+    test_archiver.begin_test_run('benchmark', None, 'benchmark', False, False)
+    test_archiver.begin_suite('Benchmark')
+    for suite in range(args.suites):
+        test_archiver.begin_suite(f'Suite {suite}')
+        test_archiver.begin_status('PASS', f'2024-01-01 00:{suite % 60:02}:{run % 60:02}.000')
+        test_archiver.metadata('run', str(run))
+        for test in range(args.tests):
+            test_archiver.begin_test(f'Test {test}')
+            test_archiver.update_tags('benchmark')
+            for keyword in range(args.keywords):
+                test_archiver.begin_keyword(f'Keyword {keyword}', 'BuiltIn', 'kw', [str(run)])
+                test_archiver.log_message('INFO', f'Message from run {run} keyword {keyword}',
+                                          '2024-01-01 00:00:00.000')
+                test_archiver.update_status('PASS')
+                test_archiver.end_keyword()
+            test_archiver.end_test()
+        test_archiver.end_suite()
+    test_archiver.end_suite()
+    test_archiver.end_test_run()
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description=DESCRIPTION, epilog=USAGE_EXAMPLE)
+    parser.add_argument('--profiles', nargs='+', default=configs.SQLITE_PROFILE_OPTIONS,
+                        choices=configs.SQLITE_PROFILE_OPTIONS, help='Profiles to benchmark')
+    parser.add_argument('--runs', type=int, default=10, help='Number of archived test runs')
+    parser.add_argument('--suites', type=int, default=10, help='Number of suites in each run')
+    parser.add_argument('--tests', type=int, default=10, help='Number of tests in each suite')
+    parser.add_argument('--keywords', type=int, default=10, help='Number of keywords in each test')
+    return parser
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import argparse
+import asyncio
+import time
+from collections import defaultdict
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+DESCRIPTION = """
+Side by side load test of archive API servers. Each server is loaded in turn by concurrent clients
+that request the endpoints round robin for the given duration, and the requests per second and the
+p50 and p99 latencies are reported per server and endpoint. Start the servers against the same local
+PostgreSQL archive, e.g. one with --db-driver queries and one with --db-driver asyncpg, both with
+--cache-size 0 so that every request runs its queries. Requires tornado like the API server.
+"""
+
+USAGE_EXAMPLE = """
+Example usage: python helpers/load_test_api.py --series 2
+    --targets queries=http://localhost:8888 asyncpg=http://localhost:8889
+"""
+
+ENDPOINTS = (
+    '/data/series/',
+    '/data/series/{series}/builds/',
+    '/data/series/{series}/results/?last=1',
+    '/data/series/{series}/test_status_statistics/',
+    '/data/series/{series}/recently_failing_tests/',
+)
+
+
+def main():
+    args = argument_parser().parse_args()
+    paths = [endpoint.format(series=args.series) for endpoint in args.endpoints or ENDPOINTS]
+    results = []
+    for target in args.targets:
+        name, _, url = target.rpartition('=')
+        url = url.rstrip('/')
+        print(f"Loading {name or url} with {args.concurrency} clients for {args.duration} s")
+        asyncio.run(load(url, paths, args.concurrency, args.warmup))
+        results.append((name or url, asyncio.run(load(url, paths, args.concurrency, args.duration))))
+
+    print(f"\n{'server':<12} {'endpoint':<48} {'requests/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for name, (latencies, errors, elapsed) in results:
+        everything = [latency for path in paths for latency in latencies[path]]
+        print(f"{name:<12} {'all':<48} {len(everything) / elapsed:>10.1f} {percentile(everything, 0.5):>8.1f} "
+              f"{percentile(everything, 0.99):>8.1f} {sum(errors.values()):>7}")
+        for path in paths:
+            print(f"{'':<12} {path:<48} {len(latencies[path]) / elapsed:>10.1f} "
+                  f"{percentile(latencies[path], 0.5):>8.1f} {percentile(latencies[path], 0.99):>8.1f} "
+                  f"{errors[path]:>7}")
+
+
+async def load(url, paths, concurrency, duration):
+    """Returns the latencies and errors per path and the elapsed seconds."""
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    deadline = time.monotonic() + duration
+
+    async def client_loop(position):
+        while time.monotonic() < deadline:
+            path = paths[position % len(paths)]
+            position += 1
+            start = time.perf_counter()
+            try:
+                # No If-None-Match so that the server never answers from the ETag alone
+                await client.fetch(url + path, request_timeout=60)
+            except (HTTPClientError, OSError):
+                errors[path] += 1
+                continue
+            latencies[path].append((time.perf_counter() - start) * 1000)
+
+    started = time.monotonic()
+    await asyncio.gather(*(client_loop(index) for index in range(concurrency)))
+    elapsed = time.monotonic() - started
+    client.close()
+    return latencies, errors, elapsed
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description=DESCRIPTION, epilog=USAGE_EXAMPLE)
+    parser.add_argument('--targets', nargs='+', default=['http://localhost:8888'],
+                        help='Servers to load in turn as [name=]url')
+    parser.add_argument('--series', type=int, default=1, help='Series id used in the endpoints')
+    parser.add_argument('--concurrency', type=int, default=200, help='Number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=30, help='Measured seconds per server')
+    parser.add_argument('--warmup', type=float, default=5, help='Unmeasured seconds per server before measuring')
+    parser.add_argument('--endpoints', nargs='+', default=None,
+                        help='Endpoints to request, {series} is replaced with the series id')
+    return parser
+
+
+if __name__ == '__main__':
+    main()
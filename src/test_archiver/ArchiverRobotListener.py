@@ -89,3 +89,4 @@ class ArchiverRobotListener:
 
     def close(self):
         self.archiver.end_test_run()
+        self.archiver.db.close()
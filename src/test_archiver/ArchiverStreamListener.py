@@ -0,0 +1,28 @@
+# pylint: disable=C0103
+# Module name "ArchiverStreamListener" doesn't conform to snake_case naming style (invalid-name)
+# Because Robot Framework needs it to have the same name as the listener class
+
+from . import event_stream
+from .ArchiverRobotListener import ArchiverRobotListener
+
+
+class ArchiverStreamListener(ArchiverRobotListener):
+    """Streams the results to testarchive_daemon instead of writing them to the database.
+
+    The address is 'host:port' of the daemon or the path of its Unix socket. No database driver or
+    credentials are needed on the test machine.
+    """
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, address, team=None, series=None, repository=None):
+        header = {key: value for key, value in (('team', team), ('series', series),
+                                                ('repository', repository)) if value}
+        self.archiver = event_stream.EventStreamClient(address, header)
+        self.archiver.test_type = "Robot Framework"
+        self.rpa = False
+        self.dry_run = False
+        self.generator = None
+
+    def close(self):
+        self.archiver.end_test_run()
+        self.archiver.close()
@@ -1,6 +1,5 @@
 # pylint: disable=invalid-name,too-many-positional-arguments
 
-import sys
 import time
 from hashlib import sha1
 from datetime import datetime, timedelta
@@ -66,6 +65,13 @@ class TestItem:
 
 
 class FingerprintedItem(TestItem):
+    # Values calculated when the item is finished. Recorded to event journals so that replaying a
+    # journal does not need to calculate them again.
+    COMPUTED_FIELDS = ('status', 'setup_status', 'execution_status', 'teardown_status',
+                       'elapsed_time', 'elapsed_time_setup', 'elapsed_time_execution',
+                       'elapsed_time_teardown', 'fingerprint', 'setup_fingerprint',
+                       'execution_fingerprint', 'teardown_fingerprint', 'kw_type', '_execution_path')
+
     def __init__(self, archiver, name, class_name=None):
         super().__init__(archiver)
         self.name = name
@@ -135,22 +141,29 @@ class FingerprintedItem(TestItem):
     def _hashing_name(self):
         return self.full_name
 
-    def finish(self):
+    def finish(self, computed_values=None):
         self.execution_path() # Make sure this is called before exiting any item
-        self.handle_child_statuses()
-        if not self.status:
-            if self.execution_status:
-                self.status = self.execution_status
-            else:
-                self.status = 'PASS'
-        if not self.elapsed_time:
-            self.elapsed_time = (self.elapsed_time_setup if self.elapsed_time_setup else 0
-                                 + self.elapsed_time_execution if self.elapsed_time_execution else 0
-                                 + self.elapsed_time_teardown if self.elapsed_time_teardown else 0)
-        self.calculate_fingerprints()
+        if computed_values:
+            for field, value in zip(self.COMPUTED_FIELDS, computed_values):
+                setattr(self, field, value)
+        else:
+            self.handle_child_statuses()
+            if not self.status:
+                if self.execution_status:
+                    self.status = self.execution_status
+                else:
+                    self.status = 'PASS'
+            if not self.elapsed_time:
+                self.elapsed_time = (self.elapsed_time_setup if self.elapsed_time_setup else 0
+                                     + self.elapsed_time_execution if self.elapsed_time_execution else 0
+                                     + self.elapsed_time_teardown if self.elapsed_time_teardown else 0)
+            self.calculate_fingerprints()
         self.propagate_fingerprints_status_and_elapsed_time()
         self.insert_results()
 
+    def computed_values(self):
+        return [getattr(self, field) for field in self.COMPUTED_FIELDS]
+
     def calculate_fingerprints(self):
         """Calculate identification fingerprints using sha1 hashing."""
         # sha1 is not considered secure anymore but in this use case
@@ -262,6 +275,8 @@ class TestRun(FingerprintedItem):
                 'rpa': rpa,
                 'dryrun': dryrun,
                 'schema_version': self.archiver.db.current_schema_version()}
+        # The keyword trees reused by this run must not be garbage collected before it is committed
+        self.archiver.db.hold_archiving_lock()
         try:
             self.id = self.archiver.db.insert_and_return_id('test_run', data)
         except database.IntegrityError as err:
@@ -294,10 +309,11 @@ class Suite(FingerprintedItem):
         data.update(self.status_and_fingerprint_values())
         if self.id not in self.parent_item.child_suite_ids:
             try:
-                self.archiver.db.insert('suite_result', data)
-            except database.IntegrityError:
-                print("ERROR: database.IntegrityError: these results have already been archived!")
-                sys.exit(1)
+                # Synced so that already archived results are detected here with every engine
+                self.archiver.db.insert('suite_result', data, sync=True)
+            except database.IntegrityError as err:
+                raise database.DuplicateResultsError(
+                    'ERROR: database.IntegrityError: these results have already been archived!') from err
             self.insert_metadata()
             if self.failed_by_teardown:
                 self.fail_children()
@@ -565,7 +581,7 @@ class Archiver:
         data = {'dryrun': self.output_from_dryrun}
         self.db.update('test_run', data, {'id': self.test_run_id})
 
-    def end_test_run(self):
+    def end_test_run(self, commit=True):
         for content in self.config.series:
             if '#' in content:
                 series_name, build_number = content.split('#')
@@ -580,7 +596,8 @@ class Archiver:
         if self.config.archive_keywords and self.config.archive_keyword_statistics:
             self.report_keyword_statistics()
 
-        self.db.commit()
+        if commit:
+            self.db.commit()
         for listener in self.listeners:
             listener.end_run()
 
@@ -626,12 +643,12 @@ class Archiver:
         self.stack.append(suite)
         return suite
 
-    def end_suite(self, attributes=None):
+    def end_suite(self, attributes=None, computed_values=None):
         if attributes:
             self.current_item(Suite).update_status(attributes['status'], attributes['starttime'],
                                                    attributes['endtime'])
             self.current_item(Suite).metadata = attributes['metadata']
-        self.current_item(Suite).finish()
+        self.current_item(Suite).finish(computed_values)
         suite = self.stack.pop()
         for listener in self.listeners:
             listener.suite_result(suite)
@@ -642,13 +659,13 @@ class Archiver:
         self.stack.append(test)
         return test
 
-    def end_test(self, attributes=None):
+    def end_test(self, attributes=None, computed_values=None):
         if attributes:
             critical = attributes['critical'] == 'yes' if 'critical' in attributes else None
             self.current_item(Test).update_status(attributes['status'], attributes['starttime'],
                                                   attributes['endtime'], critical=critical)
             self.current_item(Test).tags = attributes['tags']
-        self.current_item(Test).finish()
+        self.current_item(Test).finish(computed_values)
         test: Test = self.stack.pop()
         for listener in self.listeners:
             listener.test_result(test)
@@ -664,11 +681,11 @@ class Archiver:
         self.stack.append(keyword)
         return keyword
 
-    def end_keyword(self, attributes=None):
+    def end_keyword(self, attributes=None, computed_values=None):
         kw = self.current_item(Keyword)
         if attributes:
             kw.update_status(attributes['status'], attributes['starttime'], attributes['endtime'])
-        kw.finish()
+        kw.finish(computed_values)
         self.stack.pop()
 
     def keyword(self, name, library, kw_type, status, arguments=None):
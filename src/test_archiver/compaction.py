@@ -0,0 +1,125 @@
+# pylint: disable=protected-access
+
+import math
+from collections import defaultdict
+
+AGGREGATE_TABLE = 'test_result_daily'
+# Robot Framework results are skipped with SKIP and the results of the other formats with SKIPPED
+SKIP_STATUSES = ('SKIP', 'SKIPPED')
+
+# Functions for combining a new aggregate with an existing one of the same day
+LEAST = {'sqlite': 'min', 'postgres': 'least'}
+GREATEST = {'sqlite': 'max', 'postgres': 'greatest'}
+
+
+def result_day(timestamp):
+    """Day of a result start time as 'YYYY-MM-DD'.
+
+    SQLite archives may have Robot Framework style 'YYYYMMDD HH:MM:SS.mmm' timestamps.
+    """
+    if hasattr(timestamp, 'date'):
+        return timestamp.date().isoformat()
+    text = str(timestamp)
+    if text[4:5] == '-':
+        return text[:10]
+    return f'{text[:4]}-{text[4:6]}-{text[6:8]}'
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of the sorted values."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(fraction * len(sorted_values)) - 1, 0)]
+
+
+def daily_aggregates(rows):
+    """Rolls (series, test_id, start_time, status, elapsed) rows up into per test daily aggregates."""
+    groups = defaultdict(list)
+    for series, test_id, start_time, status, elapsed in rows:
+        groups[(series, test_id, result_day(start_time))].append((status, elapsed))
+    aggregates = []
+    for (series, test_id, day), results in sorted(groups.items()):
+        statuses = [status for status, _ in results]
+        elapsed = sorted(value for _, value in results if value is not None)
+        aggregates.append({
+            'series': series,
+            'test_id': test_id,
+            'day': day,
+            'runs': len(results),
+            'passes': statuses.count('PASS'),
+            'fails': statuses.count('FAIL'),
+            'skips': sum(statuses.count(status) for status in SKIP_STATUSES),
+            'elapsed_count': len(elapsed),
+            'min_elapsed': elapsed[0] if elapsed else None,
+            'avg_elapsed': sum(elapsed) / len(elapsed) if elapsed else None,
+            'max_elapsed': elapsed[-1] if elapsed else None,
+            'p95_elapsed': percentile(elapsed, 0.95),
+        })
+    return aggregates
+
+
+def combined_aggregates(connection):
+    """SET clause of an upsert that combines the excluded aggregates with the existing ones of the day."""
+    engine = connection._db_engine_identifier()
+    least = LEAST[engine]
+    greatest = GREATEST[engine]
+    return f"""
+        runs={AGGREGATE_TABLE}.runs + excluded.runs,
+        passes={AGGREGATE_TABLE}.passes + excluded.passes,
+        fails={AGGREGATE_TABLE}.fails + excluded.fails,
+        skips={AGGREGATE_TABLE}.skips + excluded.skips,
+        min_elapsed=coalesce({least}({AGGREGATE_TABLE}.min_elapsed, excluded.min_elapsed),
+                             {AGGREGATE_TABLE}.min_elapsed, excluded.min_elapsed),
+        avg_elapsed=coalesce(({AGGREGATE_TABLE}.avg_elapsed * {AGGREGATE_TABLE}.elapsed_count
+                              + excluded.avg_elapsed * excluded.elapsed_count)
+                             / ({AGGREGATE_TABLE}.elapsed_count + excluded.elapsed_count),
+                             {AGGREGATE_TABLE}.avg_elapsed, excluded.avg_elapsed),
+        elapsed_count={AGGREGATE_TABLE}.elapsed_count + excluded.elapsed_count,
+        max_elapsed=coalesce({greatest}({AGGREGATE_TABLE}.max_elapsed, excluded.max_elapsed),
+                             {AGGREGATE_TABLE}.max_elapsed, excluded.max_elapsed),
+        p95_elapsed=coalesce({greatest}({AGGREGATE_TABLE}.p95_elapsed, excluded.p95_elapsed),
+                             {AGGREGATE_TABLE}.p95_elapsed, excluded.p95_elapsed)
+    """
+
+
+class ResultCompactor:
+    """Rolls the test results of test runs about to be deleted up into test_result_daily.
+
+    The aggregates are per test, series and day of the result start time. When the same day is rolled
+    up in several batches the counts are added, the averages are weighted by the numbers of results with
+    an elapsed time and the larger 95th percentile is kept, so the percentile of a day compacted in
+    parts is an upper estimate.
+    Results of ignored test runs are not aggregated.
+    """
+
+    def __init__(self, connection):
+        self.db = connection
+        self._placeholder = connection._value_placeholder()
+        self._combined = combined_aggregates(connection)
+
+    def compact_queued_runs(self, last_test_run_id):
+        """Rolls up the results of the queued test runs up to last_test_run_id.
+
+        Meant to be run in the same transaction that deletes the test runs. Returns the number of
+        rolled up test results.
+        """
+        rows = self.db._execute_and_fetchall(f"""
+            SELECT tsm.series, result.test_id, coalesce(result.start_time, test_run.imported_at),
+                   result.status, result.elapsed
+            FROM history_cleaning_queue AS queue
+            JOIN test_run ON test_run.id=queue.test_run_id
+            JOIN test_result AS result ON result.test_run_id=queue.test_run_id
+            JOIN test_series_mapping AS tsm ON tsm.test_run_id=queue.test_run_id
+            WHERE queue.test_run_id<={self._placeholder} AND NOT test_run.ignored
+        """, [last_test_run_id])
+        for aggregate in daily_aggregates(rows):
+            self._upsert(aggregate)
+        return len(rows)
+
+    def _upsert(self, aggregate):
+        columns = list(aggregate)
+        self.db._execute(f"""
+            INSERT INTO {AGGREGATE_TABLE}({', '.join(columns)})
+            VALUES ({', '.join([self._placeholder] * len(columns))})
+            ON CONFLICT (series, test_id, day) DO UPDATE SET {self._combined}
+        """, [aggregate[column] for column in columns])
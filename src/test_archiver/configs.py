@@ -48,6 +48,8 @@ LOG_LEVEL_MAP["FAIL"] = 50
 
 LOG_LEVEL_CUT_OFF_OPTIONS = ('TRACE', 'DEBUG', 'INFO', 'WARN')
 
+SQLITE_PROFILE_OPTIONS = ('default', 'ingest')
+
 
 class Singleton(type):
     _instance = {}
@@ -87,6 +89,23 @@ class Config(metaclass=Singleton):
         self.port = self.resolve_option('port', default=5432, cast_as=int)
         self.db_engine = self.resolve_option('db_engine', default='sqlite')
         self.require_ssl = self.resolve_option('require_ssl', default=True, cast_as=bool)
+        self.sqlite_profile = self.resolve_option('sqlite_profile', default='default')
+        self.sqlite_busy_timeout = self.resolve_option('sqlite_busy_timeout', default=0, cast_as=int)
+        self.sqlite_defer_foreign_keys = self.resolve_option('sqlite_defer_foreign_keys', default=False,
+                                                             cast_as=bool)
+        self.sqlite_in_memory = self.resolve_option('sqlite_in_memory', default=False, cast_as=bool)
+
+        # Ingest ledger
+        self.force = self.resolve_option('force', default=False, cast_as=bool)
+        self.ledger_only = self.resolve_option('ledger_only', default=False, cast_as=bool)
+
+        # Event journal
+        self.journal_dir = self.resolve_option('journal_dir', default=None)
+        self.from_journal = self.resolve_option('from_journal', default=False, cast_as=bool)
+
+        # Transactions
+        self.commit_every_files = self.resolve_option('commit_every_files', default=1, cast_as=int)
+        self.commit_every_secs = self.resolve_option('commit_every_secs', default=0, cast_as=float)
 
         # Test metadata
         self.team = self.resolve_option('team')
@@ -110,6 +129,18 @@ class Config(metaclass=Singleton):
         self.clean_logs = self.resolve_option('clean_logs', default=False, cast_as=bool)
         self.clean_logs_below = self.resolve_option('clean_logs_below', default=None)
         self.clean_keyword_stats = self.resolve_option('clean_keyword_stats', default=False, cast_as=bool)
+        self.tier_logs = self.resolve_option('tier_logs', default=False, cast_as=bool)
+        self.compact_results = self.resolve_option('compact_results', default=False, cast_as=bool)
+        self.clean_batch_size = self.resolve_option('clean_batch_size', default=100, cast_as=int)
+        self.clean_batch_secs = self.resolve_option('clean_batch_secs', default=0, cast_as=float)
+
+        # Table partitioning
+        self.partition_tables = self.resolve_option('partition_tables', default=False, cast_as=bool)
+        self.partition_size = self.resolve_option('partition_size', default=1000, cast_as=int)
+
+        # Keyword tree garbage collection
+        self.gc_keyword_trees = self.resolve_option('gc_keyword_trees', default=False, cast_as=bool)
+        self.gc_batch_size = self.resolve_option('gc_batch_size', default=10000, cast_as=int)
 
         # Limit archived data
         self.archive_keywords = self.resolve_option('archive_keywords', default=True, cast_as=bool)
@@ -188,7 +219,7 @@ def base_argument_parser(description):
 
     group = parser.add_argument_group('Database connection')
     group.add_argument('--dbengine', dest='db_engine',
-                       help='Database engine, postgresql or sqlite (default)')
+                       help='Database engine, postgresql, postgres-pipeline or sqlite (default)')
     group.add_argument('--database', help='database name')
     group.add_argument('--host', help='database host name', default=None)
     group.add_argument('--user', help='database user')
@@ -196,6 +227,21 @@ def base_argument_parser(description):
     group.add_argument('--port', help='database port (default: 5432)')
     group.add_argument('--dont-require-ssl', dest='require_ssl', action='store_false', default=None,
                        help='Disable the default behavior to require ssl from the target database.')
+    group.add_argument('--sqlite-profile', default=None, choices=SQLITE_PROFILE_OPTIONS,
+                       help=('SQLite tuning profile. default: rollback journal and full syncing. '
+                             'ingest: WAL journal, synchronous=NORMAL, bigger page cache and memory '
+                             'mapped IO for faster archiving of large archives.'))
+    group.add_argument('--sqlite-busy-timeout', default=None,
+                       help=('Milliseconds SQLite waits for a lock held by a concurrent reader or writer '
+                             'before failing. By default fails immediately.'))
+    group.add_argument('--sqlite-defer-foreign-keys', action='store_true', default=None,
+                       help=('Do not check SQLite foreign key constraints for each insert but check them '
+                             'all at once with PRAGMA foreign_key_check before committing the results.'))
+    group.add_argument('--sqlite-in-memory', action='store_true', default=None,
+                       help=('Build the SQLite archive in memory and write it to the database file only '
+                             'when done. The existing archive is first loaded to memory and the file is '
+                             'replaced atomically so an interrupted run never leaves a partially '
+                             'written archive.'))
 
     group = parser.add_argument_group('Schema updates')
     group.add_argument('--allow-minor-schema-updates', action='store_true', default=None,
@@ -236,6 +282,21 @@ def base_argument_parser(description):
     group.add_argument('--clean-keyword-stats', action='store_true', default=None,
                        help=('Delete oldest keyword statistics data but not test results or runs. '
                              'Use this with --keep-X options. Otherwise will delete entire log history'))
+    group.add_argument('--tier-logs', action='store_true', default=None,
+                       help=('Move oldest log messages to compressed per test run segments in the '
+                             'log_archive table instead of deleting them. The API server still serves them. '
+                             'Use this with --keep-X options. Otherwise will move entire log history'))
+    group.add_argument('--compact-results', action='store_true', default=None,
+                       help=('Roll the test results of the deleted test runs up into daily aggregates per '
+                             'test and series before deleting them. Requires --keep-X options or '
+                             '--clean-team and cannot be combined with --clean-logs, --clean-logs-below, '
+                             '--clean-keyword-stats or --tier-logs.'))
+    group.add_argument('--clean-batch-size', default=None,
+                       help=('Number of test runs deleted and committed in one batch (default: 100). '
+                             'An interrupted cleaning of test runs is continued by the next cleaning.'))
+    group.add_argument('--clean-batch-secs', default=None,
+                       help=('Adjust the batch size so that each batch takes about given number of '
+                             'seconds. By default the batch size is fixed.'))
 
 
     group = parser.add_argument_group('Limit archived data')
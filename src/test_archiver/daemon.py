@@ -0,0 +1,446 @@
+import copy
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from pathlib import Path
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+from . import configs, database, event_stream, output_parser
+
+SIDECAR_SUFFIX = '.json'
+EVENTS_FORMAT = 'events'
+DONE_DIR = 'done'
+FAILED_DIR = 'failed'
+JOURNAL_DIR = '.journal'
+# Seconds between the checks for partitions of the upcoming test runs
+PARTITION_CHECK_INTERVAL = 60
+RECONNECT_DELAY_MIN = 1
+RECONNECT_DELAY_MAX = 60
+
+
+def read_sidecar(sidecar_file):
+    with open(sidecar_file, 'r', encoding='utf-8') as file:
+        metadata = json.load(file)
+    if not isinstance(metadata, dict):
+        raise ValueError(f"Sidecar file '{sidecar_file}' should contain a JSON object")
+    return metadata
+
+
+def file_config(config, metadata):
+    """Copy of the configuration with the archiving options of the sidecar metadata applied."""
+    archive_config = copy.copy(config)
+    series = metadata.get('series', config.series)
+    archive_config.series = [series] if isinstance(series, str) else list(series)
+    archive_config.team = metadata.get('team', config.team)
+    archive_config.repository = metadata.get('repository', config.repository)
+    archive_config.metadata = {**config.metadata,
+                               **configs.parse_key_value_pairs(metadata.get('metadata', {}))}
+    return archive_config
+
+
+class IngestDaemon:
+    """Archives result files dropped into a spool directory.
+
+    A result file is picked up once its sidecar metadata file (result file name + '.json') appears
+    in the spool directory, so the sidecar should be written only after the result file is
+    complete. The sidecar is a JSON object with optional 'format', 'team', 'series', 'repository'
+    and 'metadata' keys. The files are archived by a pool of worker threads that each keep their
+    own database connection for the lifetime of the daemon. Archived files are moved to the 'done'
+    directory and files that could not be archived to the 'failed' directory of the spool.
+
+    Output files are journaled into the '.journal' directory while they are parsed. If the daemon
+    is stopped after a file was parsed but before it was committed, the file is archived from its
+    journal after a restart without parsing it again.
+    """
+
+    def __init__(self, config, spool_dir, workers=1, poll_interval=2.0, default_format='robotframework'):
+        self.config = config
+        self.spool_dir = Path(spool_dir)
+        self.done_dir = self.spool_dir / DONE_DIR
+        self.failed_dir = self.spool_dir / FAILED_DIR
+        self.journal_dir = self.spool_dir / JOURNAL_DIR
+        self.workers = max(workers, 1)
+        self.poll_interval = poll_interval
+        self.default_format = default_format
+
+        self._queue = queue.Queue()
+        self._in_progress = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = []
+        self.archived = 0
+        self.failed = 0
+        self._partitions_checked = time.monotonic()
+
+    def pending_files(self):
+        files = []
+        for sidecar in sorted(self.spool_dir.glob('*' + SIDECAR_SUFFIX)):
+            result_file = sidecar.with_name(sidecar.name[:-len(SIDECAR_SUFFIX)])
+            if not sidecar.name.startswith('.') and result_file.is_file():
+                files.append(result_file)
+        return files
+
+    def start(self):
+        self.done_dir.mkdir(parents=True, exist_ok=True)
+        self.failed_dir.mkdir(parents=True, exist_ok=True)
+        self.journal_dir.mkdir(parents=True, exist_ok=True)
+        # The schema is checked once here so the workers can just connect
+        database.get_connection_and_check_schema(self.config).close()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'archiver-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def request_stop(self):
+        self._stopping.set()
+
+    def stop(self):
+        self._stopping.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def enqueue_pending(self):
+        queued = 0
+        for result_file in self.pending_files():
+            with self._lock:
+                if result_file in self._in_progress:
+                    continue
+                self._in_progress.add(result_file)
+            self._queue.put(result_file)
+            queued += 1
+        return queued
+
+    def run_once(self):
+        """Archives the files currently in the spool directory and returns when they are done."""
+        self.start()
+        self.enqueue_pending()
+        self._queue.join()
+        self.stop()
+
+    def run(self):
+        self.start()
+        print(f"Watching spool directory '{self.spool_dir}' with {self.workers} workers")
+        try:
+            if inotify_simple:
+                self._watch_with_inotify()
+            else:
+                self._watch_with_polling()
+        finally:
+            self.stop()
+            print(f"Archived {self.archived} files and failed to archive {self.failed} files")
+
+    def _create_upcoming_partitions(self):
+        # The workers keep their connections open so partitions for the upcoming test runs are
+        # created from here between their transactions
+        if time.monotonic() - self._partitions_checked < PARTITION_CHECK_INTERVAL:
+            return
+        self._partitions_checked = time.monotonic()
+        try:
+            connection = database.get_connection(self.config)
+            try:
+                connection.create_upcoming_partitions()
+            finally:
+                connection.close()
+        except Exception as error: # pylint: disable=broad-except
+            print(f"ERROR: Failed to create partitions for upcoming test runs: {error}")
+
+    def _watch_with_polling(self):
+        while not self._stopping.is_set():
+            self._create_upcoming_partitions()
+            self.enqueue_pending()
+            self._stopping.wait(self.poll_interval)
+
+    def _watch_with_inotify(self):
+        flags = inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO
+        with inotify_simple.INotify() as inotify:
+            inotify.add_watch(self.spool_dir, flags)
+            while not self._stopping.is_set():
+                # The whole directory is rescanned also on timeout so no event can be missed
+                self._create_upcoming_partitions()
+                self.enqueue_pending()
+                inotify.read(timeout=int(self.poll_interval * 1000))
+
+    def _worker(self):
+        try:
+            connection = database.get_connection(self.config)
+        except Exception as error: # pylint: disable=broad-except
+            print(f"ERROR: Archiving worker failed to connect to the test archive: {error}")
+            self.request_stop()
+            connection = None
+        reconnect_delay = RECONNECT_DELAY_MIN
+        try:
+            while True:
+                result_file = self._queue.get()
+                try:
+                    if result_file is None:
+                        return
+                    if not connection and not self._stopping.is_set():
+                        # Waiting before each attempt backs off while the archive stays unreachable
+                        if not self._stopping.wait(reconnect_delay):
+                            connection, reconnect_delay = self._reconnect(reconnect_delay)
+                    if not connection:
+                        # Left in the spool directory to be archived later or after a restart
+                        self._release(result_file)
+                        continue
+                    try:
+                        self._archive(connection, result_file)
+                    except connection.ConnectionErrors as error:
+                        print(f"ERROR: Lost the connection to the test archive while archiving "
+                              f"'{result_file}': {error}")
+                        self._release(result_file)
+                        _close_quietly(connection)
+                        connection = None
+                        reconnect_delay = RECONNECT_DELAY_MIN
+                    except Exception as error: # pylint: disable=broad-except
+                        # E.g. a failing commit or a file that can't be moved must not stop the worker
+                        print(f"ERROR: Failed to archive '{result_file}': {error}")
+                        self._fail(connection, result_file)
+                finally:
+                    self._queue.task_done()
+        finally:
+            if connection:
+                _close_quietly(connection)
+
+    def _reconnect(self, reconnect_delay):
+        try:
+            connection = database.get_connection(self.config)
+        except Exception as error: # pylint: disable=broad-except
+            print(f"ERROR: Archiving worker failed to reconnect to the test archive: {error}")
+            return None, min(reconnect_delay * 2, RECONNECT_DELAY_MAX)
+        print("Archiving worker reconnected to the test archive")
+        return connection, RECONNECT_DELAY_MIN
+
+    def _fail(self, connection, result_file):
+        try:
+            connection.rollback()
+        except Exception as error: # pylint: disable=broad-except
+            print(f"ERROR: Failed to roll back the archiving of '{result_file}': {error}")
+        sidecar = result_file.with_name(result_file.name + SIDECAR_SUFFIX)
+        with self._lock:
+            # The file is already gone if it was moved before the error
+            if result_file.exists():
+                self.failed += 1
+                try:
+                    _move_with_sidecar(result_file, sidecar, self.failed_dir)
+                except OSError as error:
+                    print(f"ERROR: Failed to move '{result_file}' to '{self.failed_dir}': {error}")
+            self._in_progress.discard(result_file)
+
+    def _release(self, result_file):
+        with self._lock:
+            self._in_progress.discard(result_file)
+
+    def _archive(self, connection, result_file):
+        sidecar = result_file.with_name(result_file.name + SIDECAR_SUFFIX)
+        # A journal is complete only when the file was parsed but its archiving was interrupted
+        journal_file = self.journal_dir / event_stream.journal_name(result_file)
+        batch = output_parser.IngestBatch(connection)
+        try:
+            metadata = read_sidecar(sidecar)
+            archive_config = file_config(self.config, metadata)
+            output_format = metadata.get('format', self.default_format).lower()
+        except (OSError, ValueError) as error:
+            print(f"ERROR: Invalid sidecar metadata for '{result_file}': {error}")
+            batch.failed.append(result_file)
+        else:
+            if output_format == EVENTS_FORMAT:
+                print(f"Replaying: '{result_file}'")
+                batch.archive(result_file, event_stream.replay_journal, str(result_file), connection,
+                              archive_config, commit=False)
+            elif journal_file.exists():
+                print(f"Recovering: '{result_file}' from the journal of an interrupted run")
+                batch.archive(result_file, event_stream.replay_journal, str(journal_file), connection,
+                              archive_config, commit=False)
+            else:
+                print(f"Parsing: '{result_file}'")
+                batch.archive(result_file, output_parser.parse_xml, str(result_file), output_format,
+                              connection, archive_config, commit=False, journal_file=journal_file)
+        target_dir = self.failed_dir if batch.failed else self.done_dir
+        with self._lock:
+            _move_with_sidecar(result_file, sidecar, target_dir)
+            if batch.failed:
+                self.failed += 1
+            else:
+                self.archived += 1
+            self._in_progress.discard(result_file)
+        if journal_file.exists():
+            journal_file.unlink()
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except Exception: # pylint: disable=broad-except
+        pass
+
+
+def _move_with_sidecar(result_file, sidecar, target_dir):
+    # Earlier files with the same name are not overwritten
+    target = target_dir / result_file.name
+    index = 1
+    while target.exists():
+        target = target_dir / f'{result_file.stem}.{index}{result_file.suffix}'
+        index += 1
+    os.replace(sidecar, target.with_name(target.name + SIDECAR_SUFFIX))
+    os.replace(result_file, target)
+
+
+def receive_event_stream(stream, target_file):
+    """Copies an event stream to the target file frame by frame without decoding the events.
+
+    Returns the header of the stream. Raises EventStreamError if the stream ends before the end of
+    the test run.
+    """
+    end_code = event_stream.EVENT_CODES['end_test_run']
+    header = None
+    with open(target_file, 'wb') as file:
+        payload = event_stream.read_frame(stream)
+        while payload is not None:
+            if header is None:
+                event, args = event_stream.EventDecoder().decode(payload)
+                if event != 'header' or not isinstance(args[0], dict):
+                    raise event_stream.EventStreamError('The stream does not start with a header')
+                header = args[0]
+            file.write(event_stream.frame_bytes(payload))
+            if event_stream.event_code(payload) == end_code:
+                file.flush()
+                os.fsync(file.fileno())
+                return header
+            payload = event_stream.read_frame(stream)
+    raise event_stream.EventStreamError('The stream ended before the end of the test run')
+
+
+class _EventStreamHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.receive(self.rfile, self.wfile)
+
+
+class _ThreadingUnixStreamServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class EventStreamReceiver:
+    """Receives test runs streamed by ArchiverStreamListener into the spool directory.
+
+    Each connection streams one test run. The stream is written to the spool as a '.events' file and
+    its sidecar is written from the stream header once the whole test run has been received. Only
+    then the run is acknowledged to the client and queued for the archiving workers. Incomplete
+    streams are moved to the 'failed' directory.
+    """
+
+    def __init__(self, ingest_daemon, address):
+        self.daemon = ingest_daemon
+        family, self.address = event_stream.parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            self.server = _ThreadingUnixStreamServer(self.address, _EventStreamHandler)
+        else:
+            self.server = _ThreadingTCPServer(self.address, _EventStreamHandler)
+        self.server.receive = self.receive
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='event-stream-receiver',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def receive(self, stream, response):
+        spool_dir = self.daemon.spool_dir
+        result_file = spool_dir / (uuid.uuid4().hex + event_stream.JOURNAL_SUFFIX)
+        partial_file = spool_dir / f'.{result_file.name}.part'
+        try:
+            header = receive_event_stream(stream, partial_file)
+        except (OSError, ValueError, IndexError, event_stream.EventStreamError) as error:
+            print(f"ERROR: Failed to receive a streamed test run: {error}")
+            if partial_file.exists():
+                os.replace(partial_file, self.daemon.failed_dir / result_file.name)
+            return
+        metadata = {key: header[key] for key in ('team', 'series', 'repository', 'metadata') if key in header}
+        partial_sidecar = spool_dir / f'.{result_file.name}{SIDECAR_SUFFIX}'
+        with open(partial_sidecar, 'w', encoding='utf-8') as sidecar:
+            json.dump({'format': EVENTS_FORMAT, **metadata}, sidecar)
+        os.replace(partial_file, result_file)
+        os.replace(partial_sidecar, result_file.with_name(result_file.name + SIDECAR_SUFFIX))
+        response.write(b'\x01')
+        self.daemon.enqueue_pending()
+
+
+def argument_parser():
+    parser = configs.base_argument_parser('Archive test results dropped into a spool directory.')
+    parser.add_argument('spool_dir', help='Directory watched for result files and their sidecar metadata')
+    parser.add_argument('--workers', type=int, default=1,
+                        help=('Number of archiving workers each with their own database connection '
+                              '(default: 1). With SQLite use --sqlite-busy-timeout with multiple workers.'))
+    parser.add_argument('--poll-interval', type=float, default=2.0,
+                        help=('Seconds between scans of the spool directory (default: 2). Used as the '
+                              'rescan interval when inotify is available.'))
+    parser.add_argument('--format', default='robotframework', choices=output_parser.SUPPORTED_OUTPUT_FORMATS,
+                        type=str.lower, help='Default output format for sidecars that do not specify one')
+    parser.add_argument('--once', action='store_true',
+                        help='Archive the files currently in the spool directory and exit')
+    parser.add_argument('--listen', metavar='ADDRESS', default=None,
+                        help=("Receive test runs streamed by ArchiverStreamListener. Either 'HOST:PORT' "
+                              "or the path of a Unix socket."))
+    parser.add_argument('--repository', default=None, help='Default repository of the test cases')
+    parser.add_argument('--team', default=None, help='Default team name for the test series')
+    parser.add_argument('--series', action='append', help='Default test series')
+    return parser
+
+
+def main():
+    config, args = configs.configuration(argument_parser)
+    daemon = IngestDaemon(config, args.spool_dir, workers=args.workers, poll_interval=args.poll_interval,
+                          default_format=args.format)
+    if args.once:
+        daemon.run_once()
+        print(f"Archived {daemon.archived} files and failed to archive {daemon.failed} files")
+        return
+
+    def handle_signal(signum, frame): # pylint: disable=unused-argument
+        print("Stopping after the files in progress are archived")
+        daemon.request_stop()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    receiver = None
+    if args.listen:
+        # The spool directories need to exist before the first stream is received
+        daemon.failed_dir.mkdir(parents=True, exist_ok=True)
+        receiver = EventStreamReceiver(daemon, args.listen)
+        receiver.start()
+        print(f"Receiving streamed test runs at '{args.listen}'")
+    try:
+        daemon.run()
+    finally:
+        if receiver:
+            receiver.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,25 @@
 # pylint: disable=E1101
 
 import os
+import re
 import sqlite3
+import tempfile
+import time
+from contextlib import ExitStack
 from pathlib import Path
 
 try:
     import psycopg2
+    import psycopg2.extras
 except ImportError:
     psycopg2 = None
 
-from . import version, configs
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
+
+from . import version, configs, compaction, keyword_gc, log_tiering, partitioning
 from .configs import LOG_LEVEL_MAP
 
 
@@ -18,13 +28,65 @@ SCHEMA_UPDATES = (
     (1, False, '0001-schema_update_table_and_log_message_index.sql'),
     (2, True, '0002-execution_paths.sql'),
     (3, True, '0003-test_run_mapping_cascade.sql'),
+    (4, True, '0004-ingest_ledger.sql'),
+    (5, True, '0005-history_cleaning_queue.sql'),
+    (6, True, '0006-log_archive.sql'),
+    (7, True, '0007-test_result_daily.sql'),
+    (8, True, '0008-series_build_index.sql'),
+    (9, True, '0009-api_query_indexes.sql'),
+    (10, True, '0010-test_result_daily_elapsed_count.sql'),
     # Updates are appended to the end
 )
 
 
+# Indexes built with CONCURRENTLY in the migration scripts, captures the index, table and columns
+CONCURRENT_INDEX_PATTERN = re.compile(r'CREATE INDEX CONCURRENTLY IF NOT EXISTS (\w+) ON (\w+)\s*\((.*)\)',
+                                      re.IGNORECASE | re.DOTALL)
+
+
+SQLITE_PROFILES = {
+    # Connection pragmas applied in the given order
+    'default': (),
+    'ingest': (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -65536), # Negative value is in KiB i.e. 64 MiB
+        ('mmap_size', 268435456), # 256 MiB
+        ('temp_store', 'MEMORY'),
+    ),
+}
+SQLITE_INCREMENTAL_VACUUM = 2 # Value of the auto_vacuum pragma
+
+
+# Test runs are deleted in batches of this many runs unless the batch size is configured
+DEFAULT_CLEAN_BATCH_SIZE = 100
+MAX_CLEAN_BATCH_SIZE = 10000
+
+# Tables whose rows are deleted when cleaning history
+CLEANED_TABLES = ('test_run', 'test_series', 'test_series_mapping', 'suite_result', 'test_result',
+                  'log_message', 'test_tag', 'suite_metadata', 'keyword_statistics', 'ingest_ledger',
+                  'log_archive')
+
+
+def next_clean_batch_size(batch_size, elapsed, batch_secs):
+    """Adjusts the batch size so that a batch takes about batch_secs seconds."""
+    if not batch_secs:
+        return batch_size
+    if elapsed > batch_secs:
+        return max(int(batch_size * batch_secs / elapsed), 1)
+    if elapsed < batch_secs / 2:
+        return min(batch_size * 2, MAX_CLEAN_BATCH_SIZE)
+    return batch_size
+
+
 class IntegrityError(Exception):
     """Exception for uniformly communicating a database integrity error"""
 
+
+class DuplicateResultsError(IntegrityError):
+    """Exception for communicating that the results have already been archived"""
+
+
 class ArchiverSchemaException(Exception):
     """Exception for communicating a mismatch with database schema and TestArchiver version"""
 
@@ -60,6 +122,7 @@ WHERE keep_build
 class BaseDatabase:
 
     UndefinedTableError = None
+    ConnectionErrors = ()
 
     def __init__(self, config):
         self._schema_updates = SCHEMA_UPDATES
@@ -89,6 +152,33 @@ class BaseDatabase:
     def commit(self):
         self._connection.commit()
 
+    def rollback(self):
+        self._connection.rollback()
+
+    def close(self):
+        self._connection.close()
+
+    def hold_archiving_lock(self):
+        """Keeps the keyword tree garbage collection from sweeping until this transaction ends."""
+
+    def exclude_archiving(self):
+        """Keeps new archiving transactions out until this transaction ends.
+
+        Returns False if archiving transactions are running. Does not wait for them so that the new
+        archiving transactions are not queued behind this one.
+        """
+        raise NotImplementedError()
+
+    def savepoint(self, name):
+        self._execute(f"SAVEPOINT {name}")
+
+    def release_savepoint(self, name):
+        self._execute(f"RELEASE SAVEPOINT {name}")
+
+    def rollback_to_savepoint(self, name):
+        self._execute(f"ROLLBACK TO SAVEPOINT {name}")
+        self._execute(f"RELEASE SAVEPOINT {name}")
+
     def _initialize_schema(self):
         raise NotImplementedError()
 
@@ -160,6 +250,19 @@ class BaseDatabase:
             cursor.close()
         return row
 
+    def _execute_and_fetchall(self, sql, values=None):
+        if values is None:
+            values = []
+        values = self._handle_values(values)
+        cursor = self._connection.cursor()
+        rows = []
+        try:
+            cursor.execute(sql, values)
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        return rows
+
     def _handle_values(self, values):
         raise NotImplementedError()
 
@@ -178,9 +281,25 @@ class BaseDatabase:
     def update(self, table, data, key_data):
         raise NotImplementedError()
 
-    def insert(self, table, data):
+    def insert(self, table, data, sync=False):
+        """Inserts a row. With sync an IntegrityError is raised already here also by the engines that
+        otherwise defer the errors of inserts to the next sync or commit."""
         raise NotImplementedError()
 
+    def insert_many(self, table, fields, rows):
+        sql = "INSERT INTO {table}({fields}) VALUES ({value_placeholders});"
+        sql = sql.format(
+            table=table,
+            fields=','.join(fields),
+            value_placeholders=','.join([self._value_placeholder() for _ in fields]),
+            )
+        cursor = self._connection.cursor()
+        try:
+            cursor.executemany(sql, [self._handle_values(row) for row in rows])
+            self._effected_rows = cursor.rowcount
+        finally:
+            cursor.close()
+
     def max_value(self, table, column, where_data=None):
         raise NotImplementedError()
 
@@ -214,20 +333,40 @@ class BaseDatabase:
         """
 
     def clean_orphan_test_series(self):
-        # Delete records of test series that have no associated test results
+        # Delete records of test series that have no associated test results or daily aggregates
         self.delete('test_series',
-                    where_query='WHERE id not IN (SELECT DISTINCT series FROM test_series_mapping)')
+                    where_query=('WHERE NOT EXISTS (SELECT 1 FROM test_series_mapping '
+                                 'WHERE test_series_mapping.series=test_series.id) '
+                                 'AND NOT EXISTS (SELECT 1 FROM test_result_daily '
+                                 'WHERE test_result_daily.series=test_series.id)'))
         self.commit()
         print("Deleted orphan series")
 
-    def _targeted_cleaning(self, ids_query, values, logs, logs_below, kw_stats):
+    def vacuum(self):
+        """Releases the space of the deleted rows and updates the planner statistics."""
+        raise NotImplementedError()
+
+    def partition_tables(self, partition_size):
+        raise ArchiverSchemaException('ERROR: Table partitioning is supported only on PostgreSQL')
+
+    def create_upcoming_partitions(self, newest_test_run_id=None):
+        """Creates the partitions for the upcoming test runs if the result tables are partitioned."""
+        return 0
+
+    def _drop_cleaned_partitions(self):
+        return 0
+
+    def _targeted_cleaning(self, ids_query, values, logs, logs_below, kw_stats, batch_size, batch_secs,
+                           tier_logs=False):
         # pylint: disable=too-many-positional-arguments
+        # The runs are materialised first so that each batch deletes only from the given runs
+        run_ids = sorted({row[0] for row in self._execute_and_fetchall(ids_query, values)})
         if logs:
             print('Cleaning archived log messages from history')
-            self.delete('log_message', values, where_query=f'WHERE test_run_id IN ({ids_query})')
-            self.commit()
-            if self._effected_rows:
-                print(f"Deleted {self._effected_rows} log messages.")
+            deleted = self._delete_in_batches('log_message', '', run_ids, batch_size, batch_secs)
+            segments = self._delete_in_batches('log_archive', '', run_ids, batch_size, batch_secs)
+            if deleted or segments:
+                print(f"Deleted {deleted} log messages and {segments} log segments from cold storage.")
             else:
                 print("No log messages to delete with given parameters.")
         elif logs_below:
@@ -235,32 +374,118 @@ class BaseDatabase:
             lower_log_levels = ','.join([
                 f"'{level}'" for level in LOG_LEVEL_MAP
                 if LOG_LEVEL_MAP[level] < LOG_LEVEL_MAP[logs_below] and level])
-            where_query = f'WHERE log_level IN ({lower_log_levels}) AND test_run_id IN ({ids_query})'
-            self.delete('log_message', values, where_query=where_query)
-            self.commit()
-            if self._effected_rows:
-                print(f"Deleted {self._effected_rows} log messages.")
+            deleted = self._delete_in_batches('log_message', f'log_level IN ({lower_log_levels}) AND ',
+                                              run_ids, batch_size, batch_secs)
+            if deleted:
+                print(f"Deleted {deleted} log messages.")
             else:
                 print("No log messages to delete with given parameters.")
+        elif tier_logs:
+            print('Moving archived log messages from history to cold storage')
+            moved = self._tier_logs_in_batches(run_ids, batch_size, batch_secs)
+            if moved:
+                print(f"Moved {moved} log messages to cold storage.")
+            else:
+                print("No log messages to move with given parameters.")
 
         if kw_stats:
             print('Cleaning archived keyword statistics from history')
-            self.delete('keyword_statistics', values,
-                        where_query=f'WHERE test_run_id IN ({ids_query})')
-            self.commit()
-            if self._effected_rows:
-                print(f"Deleted {self._effected_rows} rows from keyword statistics.")
+            deleted = self._delete_in_batches('keyword_statistics', '', run_ids, batch_size, batch_secs)
+            if deleted:
+                print(f"Deleted {deleted} rows from keyword statistics.")
             else:
                 print("No keyword statistics to delete with given parameters.")
 
-    def delete_history(self, team, keep_builds, keep_months, keep_after, logs, logs_below, kw_stats):
+    def _delete_in_batches(self, table, condition, run_ids, batch_size, batch_secs):
+        # pylint: disable=too-many-positional-arguments
+        deleted = 0
+        position = 0
+        while position < len(run_ids):
+            start = time.monotonic()
+            batch = run_ids[position:position + batch_size]
+            placeholders = ','.join([self._value_placeholder()] * len(batch))
+            self.delete(table, batch, where_query=f'WHERE {condition}test_run_id IN ({placeholders})')
+            self.commit()
+            deleted += self._effected_rows or 0
+            position += len(batch)
+            print(f" - {table}: cleaned {position}/{len(run_ids)} test runs")
+            batch_size = next_clean_batch_size(batch_size, time.monotonic() - start, batch_secs)
+        return deleted
+
+    def _tier_logs_in_batches(self, run_ids, batch_size, batch_secs):
+        tierer = log_tiering.LogTierer(self)
+        moved = 0
+        position = 0
+        while position < len(run_ids):
+            start = time.monotonic()
+            batch = run_ids[position:position + batch_size]
+            for test_run_id in batch:
+                moved += tierer.tier_run(test_run_id)
+            self.commit()
+            position += len(batch)
+            print(f" - log_message: moved {position}/{len(run_ids)} test runs to cold storage")
+            batch_size = next_clean_batch_size(batch_size, time.monotonic() - start, batch_secs)
+        return moved
+
+    def _queue_test_runs_to_clean(self, ids_query, values):
+        self._execute(f"""
+            INSERT INTO history_cleaning_queue (test_run_id)
+            SELECT DISTINCT id FROM ({ids_query}) AS runs_to_clean
+            WHERE NOT EXISTS (SELECT 1 FROM history_cleaning_queue
+                              WHERE history_cleaning_queue.test_run_id=runs_to_clean.id)
+        """, values)
+        self.commit()
+
+    def _delete_queued_test_runs(self, batch_size, batch_secs, compact=False):
+        """Deletes the queued test runs in batches that are each committed and removed from the queue.
+
+        An interrupted cleaning is continued from the remaining queue by the next cleaning run.
+        With compact the test results of each batch are rolled up into daily aggregates in the same
+        transaction.
+        """
+        compactor = compaction.ResultCompactor(self) if compact else None
+        total = self.fetch_one_value('history_cleaning_queue', 'count(*)')
+        deleted = 0
+        started = time.monotonic()
+        while True:
+            start = time.monotonic()
+            last_id = self._execute_and_fetchone(f"""
+                SELECT max(test_run_id) FROM (
+                    SELECT test_run_id FROM history_cleaning_queue
+                    ORDER BY test_run_id LIMIT {int(batch_size)}
+                ) AS batch
+            """)[0]
+            if last_id is None:
+                break
+            if compactor:
+                compactor.compact_queued_runs(last_id)
+            placeholder = self._value_placeholder()
+            self.delete('test_run', [last_id], where_query=(
+                'WHERE id IN (SELECT test_run_id FROM history_cleaning_queue '
+                f'WHERE test_run_id<={placeholder})'))
+            self.delete('history_cleaning_queue', [last_id], where_query=f'WHERE test_run_id<={placeholder}')
+            self.commit()
+            deleted += min(batch_size, total - deleted)
+            print(f" - Deleted {deleted}/{total} test runs ({time.monotonic() - started:.1f} s)")
+            batch_size = next_clean_batch_size(batch_size, time.monotonic() - start, batch_secs)
+        return deleted
+
+    def delete_history(self, team, keep_builds, keep_months, keep_after, logs, logs_below, kw_stats,
+                       batch_size=DEFAULT_CLEAN_BATCH_SIZE, batch_secs=0, tier_logs=False, compact=False):
         # pylint: disable=too-many-positional-arguments
-        if not any((team, keep_builds, keep_months, keep_after, logs, logs_below, kw_stats)):
+        if compact and any((logs, logs_below, kw_stats, tier_logs)):
+            raise ValueError('Compacting results cleans whole test runs and cannot be combined with '
+                             'cleaning or tiering only logs or keyword statistics')
+        if compact and not any((team, keep_builds, keep_months, keep_after)):
+            # Otherwise every test run would be compacted and deleted
+            raise ValueError('Compacting results requires a --keep-X option or --clean-team')
+        if not any((team, keep_builds, keep_months, keep_after, logs, logs_below, kw_stats, tier_logs)):
             # If no cleaning options are selected skip cleaning history
             return
 
         ids_query = self._run_ids_to_clean_query(team, keep_builds, keep_months, keep_after)
         values = (team, team) if team else None
+        batch_size = max(batch_size or DEFAULT_CLEAN_BATCH_SIZE, 1)
 
         print('Cleaning archived data by the following parameters:')
         if keep_builds:
@@ -272,17 +497,29 @@ class BaseDatabase:
         if team:
             print(f" - Only cleaning results from team: '{team}'")
 
-        if any((logs, logs_below, kw_stats)):
-            self._targeted_cleaning(ids_query, values, logs, logs_below, kw_stats)
+        if any((logs, logs_below, kw_stats, tier_logs)):
+            self._targeted_cleaning(ids_query, values, logs, logs_below, kw_stats, batch_size, batch_secs,
+                                    tier_logs)
         else:
+            interrupted = self.fetch_one_value('history_cleaning_queue', 'count(*)')
+            if interrupted:
+                print(f'Resuming an interrupted cleaning of {interrupted} test runs')
             print('Cleaning test runs from history')
-            self.delete('test_run', values, where_query=f'WHERE id IN ({ids_query})')
-            self.commit()
-            if self._effected_rows:
-                print(f"Deleted the results for {self._effected_rows} test runs.")
+            self._queue_test_runs_to_clean(ids_query, values)
+            if compact:
+                print('Compacting the test results of the cleaned test runs into daily aggregates')
+            # The results of dropped partitions could not be compacted anymore
+            elif self._drop_cleaned_partitions():
+                print('Dropped the partitions of fully cleaned test run ranges')
+            deleted = self._delete_queued_test_runs(batch_size, batch_secs, compact)
+            if deleted:
+                print(f"Deleted the results for {deleted} test runs.")
             else:
                 print("No results to delete with given parameters.")
             self.clean_orphan_test_series()
+            if deleted:
+                print('Vacuuming the cleaned tables')
+                self.vacuum()
 
     def get_row_count(self, table_name: str) -> int:
         return self._execute_and_fetchone(f"SELECT COUNT(*) FROM {table_name}")[0]
@@ -296,6 +533,8 @@ class BaseDatabase:
 class PostgresqlDatabase(BaseDatabase):
 
     UndefinedTableError = psycopg2.errors.UndefinedTable if psycopg2 else None
+    IntegrityErrors = (psycopg2.errors.UniqueViolation, psycopg2.errors.NotNullViolation) if psycopg2 else ()
+    ConnectionErrors = (psycopg2.OperationalError, psycopg2.InterfaceError) if psycopg2 else ()
 
     def _db_engine_identifier(self):
         return 'postgres'
@@ -327,8 +566,76 @@ class PostgresqlDatabase(BaseDatabase):
 
     def _run_script(self, script_file):
         with open(script_file, 'r', encoding='utf-8') as file:
-            self._execute(file.read().format(applied_by=version.ARCHIVER_VERSION))
-            self.commit()
+            script = file.read().format(applied_by=version.ARCHIVER_VERSION)
+        if CONCURRENT_INDEX_PATTERN.search(script):
+            self._run_outside_transaction(self._concurrent_script_statements(script))
+        else:
+            self._execute_script(script)
+
+    def _execute_script(self, script):
+        self._execute(script)
+        self.commit()
+
+    def _concurrent_script_statements(self, script):
+        """Splits a script that builds indexes concurrently into separately run statements.
+
+        The script is applied statement by statement so the schema update is recorded only after all
+        the indexes are built and an interrupted update can be run again. Invalid indexes left behind
+        by an interrupted build are rebuilt.
+        """
+        partitioner = partitioning.TablePartitioner(self)
+        partitioned = partitioner.is_partitioned()
+        statements = []
+        for statement in script.split(';'):
+            statement = '\n'.join(line for line in statement.splitlines()
+                                  if not line.strip().startswith('--')).strip()
+            match = CONCURRENT_INDEX_PATTERN.fullmatch(statement)
+            if match and partitioned and match.group(2) in partitioning.PARTITIONED_TABLES:
+                statements.extend(partitioner.concurrent_index_statements(*match.groups()))
+            elif statement:
+                statements.append(statement)
+        rebuilt = []
+        for statement in statements:
+            match = CONCURRENT_INDEX_PATTERN.fullmatch(statement)
+            if match and self._is_invalid_index(match.group(1)):
+                rebuilt.append(f"DROP INDEX CONCURRENTLY IF EXISTS {match.group(1)}")
+            rebuilt.append(statement)
+        return rebuilt
+
+    def _is_invalid_index(self, index):
+        return self._execute_and_fetchone(
+            "SELECT NOT indisvalid FROM pg_index WHERE indexrelid=to_regclass(%s)", [index]) == (True, )
+
+    def _run_outside_transaction(self, statements):
+        # CREATE INDEX CONCURRENTLY can't be run inside a transaction
+        self.commit()
+        self._connection.autocommit = True
+        try:
+            for statement in statements:
+                self._execute(statement)
+        finally:
+            self._connection.autocommit = False
+
+    def check_and_update_schema(self):
+        super().check_and_update_schema()
+        # Done here because the partitions can't be created inside archiving transactions
+        self.create_upcoming_partitions()
+
+    def partition_tables(self, partition_size):
+        partitioning.TablePartitioner(self).partition_tables(partition_size)
+
+    def create_upcoming_partitions(self, newest_test_run_id=None):
+        return partitioning.TablePartitioner(self).create_upcoming_partitions(newest_test_run_id)
+
+    def _drop_cleaned_partitions(self):
+        return partitioning.TablePartitioner(self).drop_cleaned_partitions()
+
+    def hold_archiving_lock(self):
+        self._execute_and_fetchone("SELECT pg_advisory_xact_lock_shared(%s)", [keyword_gc.ARCHIVING_LOCK_ID])
+
+    def exclude_archiving(self):
+        return self._execute_and_fetchone("SELECT pg_try_advisory_xact_lock(%s)",
+                                          [keyword_gc.ARCHIVING_LOCK_ID])[0]
 
     def _value_placeholder(self):
         return '%s'
@@ -407,7 +714,7 @@ class PostgresqlDatabase(BaseDatabase):
         values.extend([key_data[key] for key in key_data])
         self._execute(sql, values)
 
-    def insert(self, table, data):
+    def insert(self, table, data, sync=False):
         sql = "INSERT INTO {table}({fields}) VALUES ({value_placeholders});"
         keys = list(data)
         sql = sql.format(
@@ -417,9 +724,18 @@ class PostgresqlDatabase(BaseDatabase):
             )
         try:
             self._execute(sql, [data[key] for key in keys])
-        except (psycopg2.errors.UniqueViolation, psycopg2.errors.NotNullViolation) as err:
+        except self.IntegrityErrors as err:
             raise IntegrityError() from err
 
+    def insert_many(self, table, fields, rows):
+        sql = "INSERT INTO {table}({fields}) VALUES %s;".format(table=table, fields=','.join(fields))
+        cursor = self._connection.cursor()
+        try:
+            psycopg2.extras.execute_values(cursor, sql, rows, page_size=1000)
+            self._effected_rows = cursor.rowcount
+        finally:
+            cursor.close()
+
     def max_value(self, table, column, where_data=None):
         where_data = where_data or {}
         where_filters = ' AND '.join([f'{col}=%s' for col in where_data])
@@ -458,19 +774,285 @@ class PostgresqlDatabase(BaseDatabase):
             return f"now() - '{months_ago} months'::interval"
         return ''
 
+    def vacuum(self):
+        # VACUUM can't be run inside a transaction
+        self.commit()
+        self._connection.autocommit = True
+        try:
+            self._execute(f"VACUUM (ANALYZE) {', '.join(CLEANED_TABLES)}")
+        finally:
+            self._connection.autocommit = False
+
+
+class PostgresqlPipelineDatabase(PostgresqlDatabase):
+    """PostgreSQL database using the pipeline mode of psycopg 3.
+
+    Statements that do not return anything are sent to the server without waiting for their
+    results. The pipeline is synced only when a result is actually needed (e.g. the id of a new
+    suite or test) and when committing. This saves a network round trip per statement which
+    matters when the archive is behind a high latency link.
+
+    NOTICE: because of the deferred results an integrity error of an insert is raised only when
+    the pipeline is synced next, not by the insert call itself.
+    """
+
+    UndefinedTableError = psycopg.errors.UndefinedTable if psycopg else None
+    IntegrityErrors = (psycopg.errors.IntegrityError, ) if psycopg else ()
+    ConnectionErrors = (psycopg.OperationalError, psycopg.InterfaceError) if psycopg else ()
+
+    def _connect(self):
+        if not psycopg:
+            raise RuntimeError(
+                "ERROR: Trying to use Postgresql pipeline database but psycopg (version 3) is not "
+                "installed! Try for example: 'pip install psycopg[binary]'")
+
+        self._connection = psycopg.connect(
+            host=self.host,
+            port=self.port,
+            dbname=self.database,
+            user=self.user,
+            password=self.password,
+            sslmode='require' if self.require_ssl else 'prefer',
+        )
+        self._pipeline = None
+        self._pipeline_context = ExitStack()
+        self._last_cursor = None
+
+    def _enter_pipeline(self):
+        if self._pipeline is None:
+            self._pipeline = self._pipeline_context.enter_context(self._connection.pipeline())
+
+    def _exit_pipeline(self):
+        if self._pipeline is not None:
+            self._sync()
+            self._pipeline_context.close()
+            self._pipeline = None
+
+    def _sync(self):
+        try:
+            self._pipeline.sync()
+        except self.IntegrityErrors as err:
+            raise IntegrityError() from err
+        if self._last_cursor is not None:
+            self._effected_rows = self._last_cursor.rowcount
+            self._last_cursor = None
+
+    def commit(self):
+        if self._pipeline is not None:
+            self._sync()
+        self._connection.commit()
+
+    def close(self):
+        self._exit_pipeline()
+        super().close()
+
+    def insert(self, table, data, sync=False):
+        super().insert(table, data)
+        if sync:
+            self._sync()
+
+    def release_savepoint(self, name):
+        super().release_savepoint(name)
+        # Sync so that errors of the queued statements are raised before the savepoint is gone
+        self._sync()
+
+    def rollback_to_savepoint(self, name):
+        try:
+            self._sync()
+        except IntegrityError:
+            pass
+        super().rollback_to_savepoint(name)
+        self._sync()
+
+    def vacuum(self):
+        # Not allowed in pipeline mode either
+        self._exit_pipeline()
+        super().vacuum()
+
+    def _initialize_schema(self):
+        if not self._execute_and_fetchone("SELECT to_regclass('test_run');")[0]:
+            schema_file = os.path.join(os.path.dirname(__file__), 'schemas/schema_postgres.sql')
+            self._run_script(schema_file)
+            return True
+        return False
+
+    def _execute_script(self, script):
+        # Scripts contain multiple statements that can't be sent in pipeline mode
+        self._exit_pipeline()
+        self._connection.execute(script)
+        self.commit()
+
+    def _run_outside_transaction(self, statements):
+        # Statements of a pipeline are run in an implicit transaction
+        self._exit_pipeline()
+        self.commit()
+        self._connection.autocommit = True
+        try:
+            for statement in statements:
+                self._connection.execute(statement)
+        finally:
+            self._connection.autocommit = False
+
+    def _execute(self, sql, values=None):
+        if values is None:
+            values = []
+        self._enter_pipeline()
+        self._last_cursor = self._connection.execute(sql, self._handle_values(values))
+        # Number of affected rows is known only after the next sync
+        self._effected_rows = None
+
+    def _execute_and_fetchone(self, sql, values=None):
+        if values is None:
+            values = []
+        self._enter_pipeline()
+        cursor = self._connection.execute(sql, self._handle_values(values))
+        try:
+            # Fetching forces the pipeline to send and receive everything queued so far
+            return cursor.fetchone()
+        except self.IntegrityErrors as err:
+            raise IntegrityError() from err
+
+    def _execute_and_fetchall(self, sql, values=None):
+        if values is None:
+            values = []
+        self._enter_pipeline()
+        cursor = self._connection.execute(sql, self._handle_values(values))
+        try:
+            return cursor.fetchall()
+        except self.IntegrityErrors as err:
+            raise IntegrityError() from err
+
+    def insert_many(self, table, fields, rows):
+        sql = "INSERT INTO {table}({fields}) VALUES ({value_placeholders});"
+        sql = sql.format(
+            table=table,
+            fields=','.join(fields),
+            value_placeholders=','.join(['%s' for _ in fields]),
+            )
+        self._enter_pipeline()
+        self._last_cursor = self._connection.cursor()
+        self._last_cursor.executemany(sql, rows)
+        self._effected_rows = None
+
 
 
 class SQLiteDatabase(BaseDatabase):
 
     UndefinedTableError = sqlite3.OperationalError
+    # Closed connections raise ProgrammingError and locks held past the busy timeout OperationalError
+    ConnectionErrors = (sqlite3.OperationalError, sqlite3.ProgrammingError)
+
+    def __init__(self, config):
+        if config.sqlite_profile not in SQLITE_PROFILES:
+            raise ValueError(f"Unsupported SQLite profile '{config.sqlite_profile}'")
+        self.profile = config.sqlite_profile
+        self.busy_timeout = config.sqlite_busy_timeout
+        self.defer_foreign_keys = config.sqlite_defer_foreign_keys
+        self.in_memory = config.sqlite_in_memory
+        super().__init__(config)
 
     def _db_engine_identifier(self):
         return 'sqlite'
 
     def _connect(self):
-        self._connection = sqlite3.connect(self.database)
-        # The Foreign key constraints are disabled by default so we enable them
+        if self.in_memory:
+            self._connection = sqlite3.connect(':memory:')
+            if os.path.exists(self.database):
+                print(f"Loading archive '{self.database}' to memory")
+                source = sqlite3.connect(self.database)
+                try:
+                    source.backup(self._connection)
+                finally:
+                    source.close()
+        else:
+            self._connection = sqlite3.connect(self.database)
+        for pragma, value in SQLITE_PROFILES[self.profile]:
+            self._execute(f"PRAGMA {pragma}={value}")
+        if self.busy_timeout:
+            self._execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        if not self.defer_foreign_keys:
+            # The Foreign key constraints are disabled by default so we enable them
+            self._execute("PRAGMA foreign_keys=ON")
+
+    def commit(self):
+        if self.defer_foreign_keys:
+            self._check_foreign_keys()
+        super().commit()
+
+    def _check_foreign_keys(self):
+        violations = self._foreign_key_violations()
+        if violations:
+            self._connection.rollback()
+            raise IntegrityError(f"{violations} The uncommitted results were rolled back.")
+
+    def _foreign_key_violations(self):
+        cursor = self._connection.cursor()
+        try:
+            cursor.execute("PRAGMA foreign_key_check")
+            violations = cursor.fetchall()
+        finally:
+            cursor.close()
+        if not violations:
+            return None
+        tables = sorted({table for table, _, _, _ in violations})
+        return f"ERROR: {len(violations)} foreign key violations in tables: {', '.join(tables)}."
+
+    def exclude_archiving(self):
+        # Only one transaction at a time writes to SQLite, the archiving ones included. The lock is
+        # waited for only up to the busy timeout.
+        self.commit()
+        try:
+            self._execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            return False
+        return True
+
+    def savepoint(self, name):
+        # A savepoint outside of a transaction would start one that is committed by its release.
+        # The write lock is taken immediately so that concurrent writers wait for the busy timeout
+        # instead of failing on a deadlock when upgrading their read locks.
+        if not self._connection.in_transaction:
+            self._execute("BEGIN IMMEDIATE")
+        super().savepoint(name)
+
+    def release_savepoint(self, name):
+        if self.defer_foreign_keys:
+            violations = self._foreign_key_violations()
+            if violations:
+                raise IntegrityError(violations)
+        super().release_savepoint(name)
+
+    def close(self):
+        if self.in_memory:
+            self.commit()
+            self._publish()
+        super().close()
+
+    def _publish(self):
+        # Write the in-memory archive to a temporary file next to the target and replace the
+        # target with it so that readers never see a partially written archive.
+        target = os.path.abspath(self.database)
+        file_descriptor, temp_file = tempfile.mkstemp(dir=os.path.dirname(target),
+                                                      prefix=os.path.basename(target) + '.',
+                                                      suffix='.tmp')
+        os.close(file_descriptor)
+        try:
+            destination = sqlite3.connect(temp_file)
+            try:
+                self._connection.backup(destination)
+            finally:
+                destination.close()
+            os.replace(temp_file, target)
+        except BaseException:
+            os.remove(temp_file)
+            raise
+        print(f"Archive written to '{self.database}'")
+
+    def _enable_foreign_keys(self):
+        # Cascading deletes need the foreign keys. The pragma can't be changed inside a transaction.
+        self.commit()
         self._execute("PRAGMA foreign_keys=ON")
+        self.defer_foreign_keys = False
 
     def _initialize_schema(self):
         query = "SELECT 1 FROM sqlite_master WHERE type='table' AND name='test_run';"
@@ -545,7 +1127,7 @@ class SQLiteDatabase(BaseDatabase):
         values.extend([key_data[key] for key in key_data])
         self._execute(sql, values)
 
-    def insert(self, table, data):
+    def insert(self, table, data, sync=False):
         sql = "INSERT INTO {table}({fields}) VALUES ({value_placeholders});"
         keys = list(data)
         sql = sql.format(
@@ -586,10 +1168,22 @@ class SQLiteDatabase(BaseDatabase):
         return None
 
     def delete(self, table, values=None, where_query=None):
+        if self.defer_foreign_keys:
+            self._enable_foreign_keys()
         sql = "DELETE FROM {table} {where_query}"
         sql = sql.format(table=table, where_query=where_query or '')
         self._execute(sql, values)
 
+    def vacuum(self):
+        self.commit()
+        if self._execute_and_fetchone("PRAGMA auto_vacuum")[0] == SQLITE_INCREMENTAL_VACUUM:
+            # Every page is freed only when all the results of the pragma are stepped through
+            self._execute_and_fetchall("PRAGMA incremental_vacuum")
+        else:
+            print("NOTICE: The deleted space is reused by SQLite but the archive file does not shrink "
+                  "without running VACUUM or enabling incremental auto_vacuum")
+        self._execute_and_fetchall("PRAGMA optimize")
+
     def _time_value(self, date_value=None, months_ago=None):
         if date_value:
             return f"date('{date_value}')"
@@ -602,6 +1196,8 @@ def get_connection(config) -> BaseDatabase:
     connection = None
     if config.db_engine in ('postgresql', 'postgres'):
         connection = PostgresqlDatabase(config)
+    elif config.db_engine in ('postgresql-pipeline', 'postgres-pipeline'):
+        connection = PostgresqlPipelineDatabase(config)
     elif config.db_engine in ('sqlite', 'sqlite3'):
         if config.host or config.user:
             raise ValueError("--host or --user options should not be used "
@@ -619,17 +1215,39 @@ def get_connection_and_check_schema(config) -> BaseDatabase:
 
 def argument_parser():
     parser = configs.base_argument_parser('Initialize and update test archive schema.')
+    group = parser.add_argument_group('Keyword tree garbage collection')
+    group.add_argument('--gc-keyword-trees', action='store_true', default=None,
+                       help=('Delete the keyword trees that no archived result refers to anymore, e.g. '
+                             'after cleaning history. Runs in batches so archiving can continue meanwhile.'))
+    group.add_argument('--gc-batch-size', default=None,
+                       help=('Number of test runs or fingerprints handled in one batch of the garbage '
+                             f'collection (default: {keyword_gc.DEFAULT_GC_BATCH_SIZE})'))
+    group = parser.add_argument_group('Table partitioning (PostgreSQL)')
+    group.add_argument('--partition-tables', action='store_true', default=None,
+                       help=('Convert log_message, test_result, suite_result and keyword_statistics to '
+                             'tables partitioned by test run. Copies all the results and locks the '
+                             'tables while doing so. Cleaning history drops whole partitions when possible.'))
+    group.add_argument('--partition-size', default=None,
+                       help=('Number of test runs in one partition '
+                             f'(default: {partitioning.DEFAULT_PARTITION_SIZE})'))
     return parser
 
 def run_history_cleaning(connection, config):
     connection.delete_history(config.clean_team, config.keep_builds, config.keep_months, config.keep_after,
-                              config.clean_logs, config.clean_logs_below, config.clean_keyword_stats)
+                              config.clean_logs, config.clean_logs_below, config.clean_keyword_stats,
+                              batch_size=config.clean_batch_size, batch_secs=config.clean_batch_secs,
+                              tier_logs=config.tier_logs, compact=config.compact_results)
 
 def main():
     config, _ = configs.configuration(argument_parser)
 
     connection = get_connection_and_check_schema(config)
+    if config.partition_tables:
+        connection.partition_tables(config.partition_size)
     run_history_cleaning(connection, config)
+    if config.gc_keyword_trees:
+        keyword_gc.KeywordTreeCollector(connection, config.gc_batch_size).collect()
+    connection.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,521 @@
+"""Compact binary stream of Archiver events.
+
+The events are the calls made to an Archiver. They are encoded as length prefixed frames so
+that they can be streamed over a socket or appended to a journal file and replayed later into an
+Archiver with a database connection. Journals written while parsing output files also record the
+values calculated when each item was finished so replaying them needs no fingerprint hashing.
+
+Frame: varint payload length + payload
+Payload: varint event code + varint argument count + encoded arguments
+Values are encoded with a one byte type tag. Short strings are interned: the first occurrence of
+a string is sent in full and later occurrences refer to it by its index, which keeps repeated
+keyword names, libraries and statuses cheap.
+"""
+
+import io
+import os
+import socket
+import struct
+from hashlib import sha1
+from pathlib import Path
+
+from . import archiver, database, ingest_ledger
+
+STREAM_VERSION = 1
+JOURNAL_SUFFIX = '.events'
+
+# The index of the event is its code on the wire. New events are appended to the end.
+EVENTS = (
+    'header',
+    'begin_test_run',
+    'end_test_run',
+    'begin_suite',
+    'end_suite',
+    'begin_test',
+    'end_test',
+    'begin_keyword',
+    'end_keyword',
+    'begin_log_message',
+    'end_log_message',
+    'begin_status',
+    'update_status',
+    'update_arguments',
+    'update_tags',
+    'begin_metadata',
+    'end_metadata',
+    'update_dryrun_status',
+    'set_test_type',
+    'source_file',
+)
+EVENT_CODES = {event: code for code, event in enumerate(EVENTS)}
+
+# Only the attributes the Archiver uses are streamed from the Robot Framework listener attributes
+STREAMED_ATTRIBUTES = {
+    'end_suite': ('status', 'starttime', 'endtime', 'metadata'),
+    'end_test': ('status', 'starttime', 'endtime', 'tags', 'critical'),
+    'end_keyword': ('status', 'starttime', 'endtime'),
+}
+
+TAG_NONE = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3
+TAG_FLOAT = 4
+TAG_NEW_STRING = 5
+TAG_STRING_REF = 6
+TAG_LIST = 7
+TAG_DICT = 8
+TAG_STRING = 9
+
+MAX_INTERNED_LENGTH = 128
+MAX_INTERNED_STRINGS = 65536
+
+FLOAT = struct.Struct('!d')
+
+
+class EventStreamError(Exception):
+    """Exception for communicating a malformed or incomplete event stream"""
+
+
+def _write_varint(buffer, value):
+    while value > 0x7f:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(data, position):
+    result = 0
+    shift = 0
+    while True:
+        try:
+            byte = data[position]
+        except IndexError as error:
+            raise EventStreamError('Truncated varint') from error
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+def _internable(encoded):
+    return len(encoded) <= MAX_INTERNED_LENGTH
+
+
+class EventEncoder:
+    def __init__(self):
+        self._strings = {}
+
+    def frame(self, event, args):
+        payload = bytearray()
+        _write_varint(payload, EVENT_CODES[event])
+        _write_varint(payload, len(args))
+        for value in args:
+            self._encode(payload, value)
+        frame = bytearray()
+        _write_varint(frame, len(payload))
+        frame += payload
+        return bytes(frame)
+
+    def _encode(self, buffer, value):
+        # pylint: disable=too-many-branches
+        if value is None:
+            buffer.append(TAG_NONE)
+        elif value is True:
+            buffer.append(TAG_TRUE)
+        elif value is False:
+            buffer.append(TAG_FALSE)
+        elif isinstance(value, int):
+            buffer.append(TAG_INT)
+            _write_varint(buffer, (value << 1) if value >= 0 else ((-value << 1) - 1))
+        elif isinstance(value, float):
+            buffer.append(TAG_FLOAT)
+            buffer += FLOAT.pack(value)
+        elif isinstance(value, str):
+            self._encode_string(buffer, value)
+        elif isinstance(value, (list, tuple)):
+            buffer.append(TAG_LIST)
+            _write_varint(buffer, len(value))
+            for item in value:
+                self._encode(buffer, item)
+        elif isinstance(value, dict):
+            buffer.append(TAG_DICT)
+            _write_varint(buffer, len(value))
+            for key, item in value.items():
+                self._encode(buffer, key)
+                self._encode(buffer, item)
+        else:
+            self._encode_string(buffer, str(value))
+
+    def _encode_string(self, buffer, value):
+        index = self._strings.get(value)
+        if index is not None:
+            buffer.append(TAG_STRING_REF)
+            _write_varint(buffer, index)
+            return
+        encoded = value.encode('utf-8')
+        if _internable(encoded) and len(self._strings) < MAX_INTERNED_STRINGS:
+            self._strings[value] = len(self._strings)
+            buffer.append(TAG_NEW_STRING)
+        else:
+            buffer.append(TAG_STRING)
+        _write_varint(buffer, len(encoded))
+        buffer += encoded
+
+
+class EventDecoder:
+    def __init__(self):
+        self._strings = []
+
+    def decode(self, payload):
+        code, position = _read_varint(payload, 0)
+        if code >= len(EVENTS):
+            raise EventStreamError(f'Unknown event code {code}')
+        count, position = _read_varint(payload, position)
+        args = []
+        for _ in range(count):
+            value, position = self._decode(payload, position)
+            args.append(value)
+        return EVENTS[code], args
+
+    def _decode(self, data, position):
+        # pylint: disable=too-many-return-statements
+        tag = data[position]
+        position += 1
+        if tag == TAG_NONE:
+            return None, position
+        if tag == TAG_FALSE:
+            return False, position
+        if tag == TAG_TRUE:
+            return True, position
+        if tag == TAG_INT:
+            value, position = _read_varint(data, position)
+            return (value >> 1) if not value & 1 else -((value + 1) >> 1), position
+        if tag == TAG_FLOAT:
+            return FLOAT.unpack_from(data, position)[0], position + FLOAT.size
+        if tag in (TAG_NEW_STRING, TAG_STRING):
+            length, position = _read_varint(data, position)
+            value = bytes(data[position:position + length]).decode('utf-8')
+            if tag == TAG_NEW_STRING:
+                self._strings.append(value)
+            return value, position + length
+        if tag == TAG_STRING_REF:
+            index, position = _read_varint(data, position)
+            return self._strings[index], position
+        if tag == TAG_LIST:
+            count, position = _read_varint(data, position)
+            items = []
+            for _ in range(count):
+                item, position = self._decode(data, position)
+                items.append(item)
+            return items, position
+        if tag == TAG_DICT:
+            count, position = _read_varint(data, position)
+            items = {}
+            for _ in range(count):
+                key, position = self._decode(data, position)
+                items[key], position = self._decode(data, position)
+            return items, position
+        raise EventStreamError(f'Unknown value tag {tag}')
+
+
+def read_frame(stream):
+    """Reads the payload of the next frame from a binary stream. Returns None at the end of the stream."""
+    length = 0
+    shift = 0
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            if shift:
+                raise EventStreamError('Stream ended in the middle of a frame')
+            return None
+        length |= (byte[0] & 0x7f) << shift
+        if not byte[0] & 0x80:
+            break
+        shift += 7
+    payload = stream.read(length)
+    if len(payload) != length:
+        raise EventStreamError('Stream ended in the middle of a frame')
+    return payload
+
+
+def frame_bytes(payload):
+    frame = bytearray()
+    _write_varint(frame, len(payload))
+    return bytes(frame) + payload
+
+
+def event_code(payload):
+    return _read_varint(payload, 0)[0]
+
+
+def read_events(stream):
+    decoder = EventDecoder()
+    payload = read_frame(stream)
+    while payload is not None:
+        yield decoder.decode(payload)
+        payload = read_frame(stream)
+
+
+class EventWriter:
+    """Writes Archiver events as frames to a binary stream."""
+
+    def __init__(self, stream, header=None):
+        self.stream = stream
+        self._encoder = EventEncoder()
+        self.write('header', {'version': STREAM_VERSION, **(header or {})})
+
+    def write(self, event, *args):
+        self.stream.write(self._encoder.frame(event, args))
+
+    def flush(self):
+        self.stream.flush()
+
+
+class EventRecorder:
+    """Stands in for an Archiver and records the calls made to it as events."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.test_run_id = None
+        self._test_type = None
+
+    @property
+    def test_type(self):
+        return self._test_type
+
+    @test_type.setter
+    def test_type(self, value):
+        self._test_type = value
+        self.writer.write('set_test_type', value)
+
+    def _record(self, event, *args):
+        if event in STREAMED_ATTRIBUTES and args and args[0]:
+            args = ({key: args[0][key] for key in STREAMED_ATTRIBUTES[event] if key in args[0]}, )
+        self.writer.write(event, *args)
+
+    def begin_test_run(self, archived_using, generated, generator, rpa, dryrun):
+        self._record('begin_test_run', archived_using, generated, generator, rpa, dryrun)
+        self.test_run_id = True
+
+    def end_test_run(self):
+        self._record('end_test_run')
+        self.writer.flush()
+
+    def __getattr__(self, name):
+        if name not in EVENT_CODES:
+            raise AttributeError(name)
+        return lambda *args: self._record(name, *args)
+
+
+class JournalingArchiver(archiver.Archiver):
+    """Archiver that also records the calls made to it and the calculated item values as events."""
+
+    def __init__(self, connection, configuration, writer, build_number_cache=None):
+        super().__init__(connection, configuration, build_number_cache=build_number_cache)
+        self.writer = writer
+
+    def begin_test_run(self, archived_using, generated, generator, rpa, dryrun):
+        self.writer.write('set_test_type', self.test_type)
+        self.writer.write('begin_test_run', archived_using, generated, generator, rpa, dryrun)
+        super().begin_test_run(archived_using, generated, generator, rpa, dryrun)
+
+    def update_dryrun_status(self):
+        self.writer.write('update_dryrun_status')
+        super().update_dryrun_status()
+
+    def source_file(self, entry):
+        """Records the ingest ledger entry of the parsed output file."""
+        self.writer.write('source_file', entry)
+
+    def end_test_run(self, commit=True):
+        self.writer.write('end_test_run')
+        self.writer.flush()
+        return super().end_test_run(commit=commit)
+
+    def begin_suite(self, name, execution_path=None):
+        self.writer.write('begin_suite', name, execution_path)
+        return super().begin_suite(name, execution_path)
+
+    def end_suite(self, attributes=None, computed_values=None):
+        suite = self.current_item()
+        super().end_suite(attributes, computed_values)
+        self.writer.write('end_suite', attributes, suite.computed_values())
+
+    def begin_test(self, name, class_name=None, execution_path=None):
+        self.writer.write('begin_test', name, class_name, execution_path)
+        return super().begin_test(name, class_name, execution_path)
+
+    def end_test(self, attributes=None, computed_values=None):
+        test = self.current_item()
+        super().end_test(attributes, computed_values)
+        self.writer.write('end_test', attributes, test.computed_values())
+
+    def begin_status(self, status, start_time=None, end_time=None, elapsed=None, critical=None):
+        self.writer.write('begin_status', status, start_time, end_time, elapsed, critical)
+        super().begin_status(status, start_time, end_time, elapsed, critical)
+
+    def update_status(self, status):
+        self.writer.write('update_status', status)
+        super().update_status(status)
+
+    def begin_keyword(self, name, library, kw_type, arguments=None):
+        self.writer.write('begin_keyword', name, library, kw_type, arguments)
+        return super().begin_keyword(name, library, kw_type, arguments)
+
+    def end_keyword(self, attributes=None, computed_values=None):
+        keyword = self.current_item()
+        super().end_keyword(attributes, computed_values)
+        self.writer.write('end_keyword', attributes, keyword.computed_values())
+
+    def update_arguments(self, argument):
+        self.writer.write('update_arguments', argument)
+        super().update_arguments(argument)
+
+    def update_tags(self, tag):
+        self.writer.write('update_tags', tag)
+        super().update_tags(tag)
+
+    def begin_metadata(self, name):
+        self.writer.write('begin_metadata', name)
+        super().begin_metadata(name)
+
+    def end_metadata(self, content):
+        self.writer.write('end_metadata', content)
+        super().end_metadata(content)
+
+    def begin_log_message(self, level, timestamp=None):
+        self.writer.write('begin_log_message', level, timestamp)
+        super().begin_log_message(level, timestamp)
+
+    def end_log_message(self, content):
+        self.writer.write('end_log_message', content)
+        super().end_log_message(content)
+
+
+def journal_name(output_file):
+    """File name of the journal of an output file.
+
+    The name includes a hash of the resolved path of the output file so that output files with the
+    same name in different directories do not share a journal.
+    """
+    path = Path(output_file).resolve()
+    path_hash = sha1(str(path).encode('utf-8')).hexdigest()[:12]
+    return f'{path.name}.{path_hash}{JOURNAL_SUFFIX}'
+
+
+class JournalFile:
+    """Event journal that appears under its final name only once the whole test run is written."""
+
+    def __init__(self, journal_file, header=None):
+        self.journal_file = str(journal_file)
+        self._partial_file = self.journal_file + '.part'
+        self._stream = open(self._partial_file, 'wb') # pylint: disable=consider-using-with
+        self.writer = EventWriter(self._stream, header)
+
+    def complete(self):
+        self._stream.flush()
+        os.fsync(self._stream.fileno())
+        self._stream.close()
+        os.replace(self._partial_file, self.journal_file)
+
+    def discard(self):
+        self._stream.close()
+        if os.path.exists(self._partial_file):
+            os.remove(self._partial_file)
+
+
+def replay(events, test_archiver):
+    """Replays the events of one test run into the Archiver.
+
+    Stops at the end_test_run event and leaves ending the test run to the caller. Returns the ingest
+    ledger entry of the source output file if the journal has one.
+    """
+    source = None
+    for event, args in events:
+        if event == 'header':
+            continue
+        if event == 'set_test_type':
+            test_archiver.test_type = args[0]
+        elif event == 'source_file':
+            source = args[0]
+        elif event == 'end_test_run':
+            return source
+        else:
+            getattr(test_archiver, event)(*args)
+    raise EventStreamError('Event stream ended before the end of the test run')
+
+
+def read_header(journal_file):
+    with open(journal_file, 'rb') as stream:
+        for event, args in read_events(stream):
+            if event != 'header':
+                break
+            return args[0]
+    raise EventStreamError(f"'{journal_file}' does not start with an event stream header")
+
+
+def replay_journal(journal_file, connection, config, build_number_cache=None, commit=True):
+    """Archives a test run from an event journal file. Works like parse_xml for output files.
+
+    The ingest ledger entry is made for the output file the journal was written from so that the
+    output file is recognised as archived. Streamed journals without a source file are recorded
+    as they are.
+    """
+    ledger = ingest_ledger.IngestLedger(connection)
+    if not config.force:
+        _check_not_archived(ledger.archived_test_run(journal_file))
+    test_archiver = archiver.Archiver(connection, config, build_number_cache=build_number_cache)
+    with open(journal_file, 'rb') as stream:
+        source = replay(read_events(stream), test_archiver)
+    if source is None:
+        source = ingest_ledger.ledger_entry(journal_file, ingest_ledger.content_hash(journal_file))
+    elif not config.force:
+        # The source is known only at the end of the journal and the replayed run is rolled back
+        _check_not_archived(ledger.archived_test_run_by_hash(source['content_hash']))
+    ledger.record_entry(source, test_archiver.test_run_id, force=config.force)
+    return test_archiver.end_test_run(commit=commit)
+
+
+def _check_not_archived(test_run_id):
+    if test_run_id:
+        raise database.DuplicateResultsError(
+            f'ERROR: the results have already been archived as test run {test_run_id}! '
+            'Use --force to archive them anyway.')
+
+
+def parse_address(address):
+    """'host:port' for TCP and a file system path for a Unix socket."""
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit():
+        return socket.AF_INET, (host or 'localhost', int(port))
+    return socket.AF_UNIX, address
+
+
+class EventStreamClient(EventRecorder):
+    """Streams the Archiver events of a test run to an archiver daemon."""
+
+    ACK_TIMEOUT = 60
+
+    def __init__(self, address, header=None):
+        family, socket_address = parse_address(address)
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        self._socket.connect(socket_address)
+        self._stream = self._socket.makefile('wb', buffering=io.DEFAULT_BUFFER_SIZE * 16)
+        super().__init__(EventWriter(self._stream, header))
+
+    def close(self):
+        """Closes the stream and waits for the daemon to acknowledge that the run was received."""
+        self._stream.flush()
+        self._stream.close()
+        self._socket.shutdown(socket.SHUT_WR)
+        self._socket.settimeout(self.ACK_TIMEOUT)
+        try:
+            acknowledged = self._socket.recv(1) == b'\x01'
+        except socket.timeout:
+            acknowledged = False
+        self._socket.close()
+        if not acknowledged:
+            print("WARNING: The archiver daemon did not acknowledge receiving the test run")
+        return acknowledged
@@ -0,0 +1,72 @@
+import os
+from hashlib import sha1
+
+BLOCK_SIZE = 65536
+
+
+def quick_hash(file_name, file_size):
+    """Hash of the file size and the first and last blocks of the file.
+
+    Cheap to calculate even for very large files and used as a pre-check before hashing the
+    whole content of the file.
+    """
+    content = sha1(str(file_size).encode('utf-8'))
+    with open(file_name, 'rb') as file:
+        content.update(file.read(BLOCK_SIZE))
+        if file_size > BLOCK_SIZE:
+            file.seek(max(file_size - BLOCK_SIZE, BLOCK_SIZE))
+            content.update(file.read(BLOCK_SIZE))
+    return content.hexdigest()
+
+
+def content_hash(file_name):
+    content = sha1()
+    with open(file_name, 'rb') as file:
+        block = file.read(BLOCK_SIZE)
+        while block:
+            content.update(block)
+            block = file.read(BLOCK_SIZE)
+    return content.hexdigest()
+
+
+def ledger_entry(file_name, file_content_hash):
+    file_size = os.path.getsize(file_name)
+    return {'content_hash': file_content_hash,
+            'quick_hash': quick_hash(file_name, file_size),
+            'file_size': file_size,
+            'file_name': os.path.basename(file_name)}
+
+
+class IngestLedger:
+    """Records the archived output files by their content hashes.
+
+    Files that have already been archived can be recognised before parsing them. As the
+    ledger entries are removed together with their test runs, files whose results have been
+    cleaned from the archive can be archived again.
+    """
+
+    def __init__(self, connection):
+        self.db = connection
+
+    def archived_test_run(self, file_name):
+        """Returns the id of the test run the file was archived as or None if not archived."""
+        file_size = os.path.getsize(file_name)
+        candidates = self.db.fetch_one_value('ingest_ledger', 'count(*)',
+                                             {'file_size': file_size,
+                                              'quick_hash': quick_hash(file_name, file_size)})
+        if not candidates:
+            return None
+        return self.archived_test_run_by_hash(content_hash(file_name))
+
+    def archived_test_run_by_hash(self, file_content_hash):
+        return self.db.fetch_one_value('ingest_ledger', 'test_run_id', {'content_hash': file_content_hash})
+
+    def record(self, file_name, file_content_hash, test_run_id, force=False):
+        self.record_entry(ledger_entry(file_name, file_content_hash), test_run_id, force)
+
+    def record_entry(self, entry, test_run_id, force=False):
+        self.db.insert_or_ignore('ingest_ledger', {**entry, 'test_run_id': test_run_id}, ['content_hash'])
+        if force:
+            # Forced re-archiving points the entry to the latest test run
+            self.db.update('ingest_ledger', {'test_run_id': test_run_id},
+                           {'content_hash': entry['content_hash']})
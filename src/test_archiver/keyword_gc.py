@@ -0,0 +1,181 @@
+# pylint: disable=protected-access
+
+import time
+
+DEFAULT_GC_BATCH_SIZE = 10000
+
+MARK_TABLE = 'keyword_tree_gc_mark'
+
+# Taken by archiving transactions in shared mode and by the sweeping transactions in exclusive mode
+ARCHIVING_LOCK_ID = 7263102
+# Seconds to wait before trying again to exclude archiving, doubled on each failed attempt
+EXCLUDE_RETRY_DELAY_MIN = 0.1
+EXCLUDE_RETRY_DELAY_MAX = 10
+
+# Mark states
+PENDING = 0
+EXPANDING = 1
+EXPANDED = 2
+
+ROOT_FINGERPRINTS = (
+    ('test_result', 'setup_fingerprint'),
+    ('test_result', 'execution_fingerprint'),
+    ('test_result', 'teardown_fingerprint'),
+    ('suite_result', 'setup_fingerprint'),
+    ('suite_result', 'teardown_fingerprint'),
+    ('keyword_statistics', 'fingerprint'),
+)
+
+
+class KeywordTreeCollector:
+    """Deletes keyword_tree and tree_hierarchy rows that no archived result refers to anymore.
+
+    Mark: the setup, execution and teardown fingerprints of the remaining results and the keyword
+    statistics are the roots. The trees reachable from them through tree_hierarchy are marked in a
+    temporary table, a batch of marks at a time.
+    Sweep: tree_hierarchy and then keyword_tree are walked in fingerprint order and the unmarked
+    rows are deleted in chunks. Each chunk is swept in a transaction that excludes archiving, and the
+    trees of the test runs archived since the previous chunk are marked in the same transaction. So an
+    archiving transaction never reuses a tree that is deleted before it commits. The sweep does not
+    wait in line for running archiving transactions but backs off and tries again, so archiving is
+    never held up behind it.
+
+    Every batch is committed separately so archiving can continue between the batches.
+    """
+
+    def __init__(self, connection, batch_size=DEFAULT_GC_BATCH_SIZE):
+        self.db = connection
+        self.batch_size = max(batch_size, 1)
+        # Runs with lower ids may commit after higher ones so the marked runs are remembered until
+        # the runs up to _complete_until are known to be committed
+        self._marked_runs = set()
+        self._complete_until = None
+        self._placeholder = connection._value_placeholder()
+
+    def collect(self):
+        started = time.monotonic()
+        self._create_mark_table()
+        try:
+            self._mark_roots()
+            self._expand_marks()
+            print(f"Marked {self._mark_count()} reachable keyword trees "
+                  f"({time.monotonic() - started:.1f} s)")
+            hierarchy_rows = self._sweep('tree_hierarchy')
+            trees = self._sweep('keyword_tree')
+        finally:
+            self.db._execute(f"DROP TABLE IF EXISTS {MARK_TABLE}")
+            self.db.commit()
+        print(f"Deleted {trees} unreachable keyword trees and {hierarchy_rows} tree_hierarchy rows "
+              f"({time.monotonic() - started:.1f} s)")
+        return trees, hierarchy_rows
+
+    def _create_mark_table(self):
+        self.db._execute(f"DROP TABLE IF EXISTS {MARK_TABLE}")
+        self.db._execute(f"CREATE TEMP TABLE {MARK_TABLE} (fingerprint text PRIMARY KEY, state int)")
+        self.db._execute(f"CREATE INDEX {MARK_TABLE}_state_idx ON {MARK_TABLE}(state, fingerprint)")
+        self.db.commit()
+
+    def _mark_count(self):
+        return self.db._execute_and_fetchone(f"SELECT count(*) FROM {MARK_TABLE}")[0]
+
+    def _mark_roots(self, commit=True):
+        """Marks the root fingerprints of the test runs that are not marked yet in batches of test runs.
+
+        Returns the newest test run id or None if there are no test runs to consider.
+        """
+        if self._complete_until is None:
+            rows = self.db._execute_and_fetchall("SELECT id FROM test_run ORDER BY id")
+        else:
+            rows = self.db._execute_and_fetchall(
+                f"SELECT id FROM test_run WHERE id>{self._placeholder} ORDER BY id", [self._complete_until])
+        newest = rows[-1][0] if rows else None
+        run_ids = [run_id for (run_id, ) in rows if run_id not in self._marked_runs]
+        for batch_start in range(0, len(run_ids), self.batch_size):
+            batch = run_ids[batch_start:batch_start + self.batch_size]
+            batch_ids = ', '.join(str(int(run_id)) for run_id in batch)
+            roots = ' UNION '.join(
+                f"SELECT {column} AS fingerprint FROM {table} WHERE test_run_id IN ({batch_ids})"
+                for table, column in ROOT_FINGERPRINTS)
+            self.db._execute(f"""
+                INSERT INTO {MARK_TABLE} (fingerprint, state)
+                SELECT fingerprint, {PENDING} FROM ({roots}) AS roots
+                WHERE fingerprint IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM {MARK_TABLE} AS mark WHERE mark.fingerprint=roots.fingerprint)
+            """)
+            if commit:
+                self.db.commit()
+            self._marked_runs.update(batch)
+        return newest
+
+    def _expand_marks(self, commit=True):
+        """Marks the subtrees of the pending marks until every reachable tree is marked."""
+        while True:
+            chunk_end = self.db._execute_and_fetchone(f"""
+                SELECT max(fingerprint) FROM (
+                    SELECT fingerprint FROM {MARK_TABLE} WHERE state={PENDING}
+                    ORDER BY fingerprint LIMIT {int(self.batch_size)}
+                ) AS chunk
+            """)[0]
+            if chunk_end is None:
+                return
+            # The chunk is set apart first so that the new pending subtrees are not mixed with it
+            self.db._execute(f"UPDATE {MARK_TABLE} SET state={EXPANDING} "
+                             f"WHERE state={PENDING} AND fingerprint<={self._placeholder}", [chunk_end])
+            self.db._execute(f"""
+                INSERT INTO {MARK_TABLE} (fingerprint, state)
+                SELECT DISTINCT tree_hierarchy.subtree, {PENDING}
+                FROM {MARK_TABLE} AS chunk
+                JOIN tree_hierarchy ON tree_hierarchy.fingerprint=chunk.fingerprint
+                WHERE chunk.state={EXPANDING}
+                  AND NOT EXISTS (SELECT 1 FROM {MARK_TABLE} AS mark
+                                  WHERE mark.fingerprint=tree_hierarchy.subtree)
+            """)
+            self.db._execute(f"UPDATE {MARK_TABLE} SET state={EXPANDED} WHERE state={EXPANDING}")
+            if commit:
+                self.db.commit()
+
+    def _mark_new_runs(self):
+        """Marks the trees of the test runs archived since the previous marking without committing.
+
+        Called while archiving is excluded, when every test run is committed and new ones get higher
+        ids, so later markings only need to read the test runs after the newest one.
+        """
+        newest = self._mark_roots(commit=False)
+        self._expand_marks(commit=False)
+        if newest is not None:
+            self._complete_until = newest
+            self._marked_runs = set()
+
+    def _sweep(self, table):
+        """Deletes the unmarked rows of the table in chunks of fingerprints."""
+        print(f"Sweeping unreachable rows from {table}")
+        unmarked = (f"fingerprint>{self._placeholder} AND fingerprint<={self._placeholder} "
+                    f"AND NOT EXISTS (SELECT 1 FROM {MARK_TABLE} AS mark "
+                    f"WHERE mark.fingerprint={table}.fingerprint)")
+        deleted = 0
+        chunk_start = ''
+        while True:
+            chunk_end = self.db._execute_and_fetchone(f"""
+                SELECT max(fingerprint) FROM (
+                    SELECT fingerprint FROM {table} WHERE fingerprint>{self._placeholder}
+                    ORDER BY fingerprint LIMIT {int(self.batch_size)}
+                ) AS chunk
+            """, [chunk_start])[0]
+            if chunk_end is None:
+                return deleted
+            # Archiving waits until the chunk is committed and the runs archived before it are marked
+            self._exclude_archiving()
+            self._mark_new_runs()
+            deleted += self.db._execute_and_fetchone(f"SELECT count(*) FROM {table} WHERE {unmarked}",
+                                                     [chunk_start, chunk_end])[0]
+            self.db.delete(table, [chunk_start, chunk_end], where_query=f"WHERE {unmarked}")
+            self.db.commit()
+            chunk_start = chunk_end
+
+    def _exclude_archiving(self):
+        delay = EXCLUDE_RETRY_DELAY_MIN
+        while not self.db.exclude_archiving():
+            # The transaction is ended so that it holds no locks or snapshot while waiting
+            self.db.commit()
+            time.sleep(delay)
+            delay = min(delay * 2, EXCLUDE_RETRY_DELAY_MAX)
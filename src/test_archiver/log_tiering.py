@@ -0,0 +1,108 @@
+# pylint: disable=protected-access
+
+import gzip
+import json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SEGMENT_VERSION = 1
+# Columns of log_message stored in a segment, the test run is the key of the segment
+SEGMENT_COLUMNS = ('execution_path', 'test_id', 'suite_id', 'timestamp', 'log_level', 'message')
+
+
+def default_compression():
+    return 'zstd' if zstandard else 'gzip'
+
+
+def _compress(data, compression):
+    if compression == 'zstd':
+        _require_zstandard()
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    raise ValueError(f"Unsupported log segment compression '{compression}'")
+
+
+def _decompress(data, compression):
+    if compression == 'zstd':
+        _require_zstandard()
+        return zstandard.ZstdDecompressor().decompress(data)
+    if compression == 'gzip':
+        return gzip.decompress(data)
+    raise ValueError(f"Unsupported log segment compression '{compression}'")
+
+
+def _require_zstandard():
+    if not zstandard:
+        raise RuntimeError("ERROR: zstd compressed log segments require the zstandard module. "
+                           "Try for example: 'pip install zstandard'")
+
+
+def encode_segment(rows, compression):
+    """Packs log message rows with SEGMENT_COLUMNS into a compressed columnar segment.
+
+    The values of each column are stored together as they compress much better that way, e.g. the
+    log levels and suite ids of a run are mostly the same.
+    """
+    columns = [list(column) for column in zip(*rows)] if rows else [[] for _ in SEGMENT_COLUMNS]
+    segment = {'version': SEGMENT_VERSION, 'columns': dict(zip(SEGMENT_COLUMNS, columns))}
+    # Timestamps are stored in their string form as the API serves them
+    return _compress(json.dumps(segment, default=str, separators=(',', ':')).encode('utf-8'), compression)
+
+
+def decode_segment(data, compression):
+    """Unpacks a segment into log message dicts in their original order."""
+    segment = json.loads(_decompress(bytes(data), compression))
+    if segment.get('version') != SEGMENT_VERSION:
+        raise ValueError(f"Unsupported log segment version {segment.get('version')}")
+    columns = segment['columns']
+    names = list(columns)
+    return [dict(zip(names, values)) for values in zip(*(columns[name] for name in names))]
+
+
+class LogTierer:
+    """Moves the log messages of test runs from log_message to compressed segments in log_archive.
+
+    All the log messages of a test run are stored in one segment. A run is moved in a single
+    transaction so its messages are always either in log_message or in its segment.
+    """
+
+    def __init__(self, connection, compression=None):
+        self.db = connection
+        self.compression = compression or default_compression()
+        self._placeholder = connection._value_placeholder()
+        # SQLite log_message has no id column but the rowid tells the insertion order as well
+        self._order_column = 'rowid' if connection._db_engine_identifier() == 'sqlite' else 'id'
+
+    def tier_run(self, test_run_id):
+        """Moves the log messages of the test run to its segment and returns their number.
+
+        The caller commits.
+        """
+        rows = self.db._execute_and_fetchall(f"""
+            SELECT {', '.join(SEGMENT_COLUMNS)} FROM log_message
+            WHERE test_run_id={self._placeholder}
+            ORDER BY timestamp, {self._order_column}
+        """, [test_run_id])
+        if not rows:
+            return 0
+        messages = [tuple(row) for row in rows]
+        # Messages added after an earlier tiering are appended to the existing segment
+        messages = [tuple(message[column] for column in SEGMENT_COLUMNS)
+                    for message in self.archived_messages(test_run_id)] + messages
+        self.db.delete('log_archive', [test_run_id], where_query=f'WHERE test_run_id={self._placeholder}')
+        self.db.insert('log_archive', {'test_run_id': test_run_id,
+                                       'message_count': len(messages),
+                                       'compression': self.compression,
+                                       'segment': encode_segment(messages, self.compression)})
+        self.db.delete('log_message', [test_run_id], where_query=f'WHERE test_run_id={self._placeholder}')
+        return len(rows)
+
+    def archived_messages(self, test_run_id):
+        row = self.db._execute_and_fetchone(
+            f"SELECT segment, compression FROM log_archive WHERE test_run_id={self._placeholder}",
+            [test_run_id])
+        return decode_segment(*row) if row else []
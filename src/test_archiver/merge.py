@@ -0,0 +1,443 @@
+# pylint: disable=protected-access
+
+import ast
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+from . import compaction, configs, database
+
+# Tables read from the source archives in the order they are merged
+SOURCE_TABLES = (
+    'test_run',
+    'test_series',
+    'test_series_mapping',
+    'suite',
+    'test_case',
+    'keyword_tree',
+    'tree_hierarchy',
+    'suite_result',
+    'test_result',
+    'log_message',
+    'suite_metadata',
+    'test_tag',
+    'keyword_statistics',
+    'ingest_ledger',
+    'test_result_daily',
+)
+
+BOOLEAN_COLUMNS = ('rpa', 'dryrun', 'ignored', 'critical')
+
+ID_MAPS = ('merge_run_map', 'merge_suite_map', 'merge_test_map', 'merge_series_map', 'merge_build_map')
+
+STAGING_BATCH_SIZE = 10000
+
+
+class ArchiveMerger:
+    """Merges SQLite test archives produced by the sqlite engine into a target archive.
+
+    The rows are copied with set-wise INSERT ... SELECT statements so no output files are parsed and
+    no fingerprints are calculated. The ids of test runs, suites, test cases and series are remapped,
+    keyword trees are deduplicated by their fingerprints and builds are renumbered after the last
+    build of each series in the target archive. Test runs that are already in the target archive are
+    skipped.
+
+    The daily aggregates of compacted history are added to the aggregates of the same test, series and
+    day in the target archive. Unlike test runs they can't be recognised as already merged, so merging
+    the same compacted source twice counts its aggregates twice.
+    """
+
+    def __init__(self, connection):
+        self.db = connection
+        self._source_prefix = None
+
+    def merge(self, source_file):
+        source = sqlite3.connect(source_file)
+        try:
+            self._check_schema_version(source, source_file)
+            self.db.commit()
+            self._open_source(source_file, source)
+        finally:
+            source.close()
+        try:
+            results = self._merge_from_source()
+            self.db.commit()
+        except BaseException:
+            self.db._connection.rollback()
+            raise
+        finally:
+            self._close_source()
+        return results
+
+    def _check_schema_version(self, source, source_file):
+        (source_version, ) = source.execute("SELECT max(schema_version) FROM schema_updates").fetchone()
+        target_version = self.db._latest_update_applied()
+        if source_version != target_version:
+            raise database.ArchiverSchemaException(
+                f"ERROR: Schema version {source_version} of '{source_file}' does not match the schema "
+                f"version {target_version} of the target archive. Update the schemas with "
+                "testarchive_schematool before merging.")
+        # Log segments refer to the suite and test ids of the source archive
+        if source.execute("SELECT count(*) FROM log_archive").fetchone()[0]:
+            raise database.ArchiverSchemaException(
+                f"ERROR: '{source_file}' has log messages moved to cold storage which can not be merged.")
+
+    def _open_source(self, source_file, source):
+        raise NotImplementedError()
+
+    def _close_source(self):
+        raise NotImplementedError()
+
+    def _update_sequences(self):
+        pass
+
+    def _source(self, table):
+        return self._source_prefix + table
+
+    def _drop_id_maps(self):
+        for id_map in ID_MAPS:
+            self.db._execute(f"DROP TABLE IF EXISTS {id_map}")
+
+    def _merge_from_source(self):
+        self.db.hold_archiving_lock()
+        self._drop_id_maps()
+        runs_in_source = self.db._execute_and_fetchone(f"SELECT count(*) FROM {self._source('test_run')}")[0]
+        self._map_test_runs()
+        runs_to_merge = self.db.get_row_count('merge_run_map')
+        aggregates = self.db._execute_and_fetchone(
+            f"SELECT count(*) FROM {self._source(compaction.AGGREGATE_TABLE)}")[0]
+        if runs_to_merge or aggregates:
+            self._merge_suites_and_test_cases()
+            self._merge_series_and_builds()
+        if runs_to_merge:
+            self._merge_keyword_trees()
+            self._merge_results()
+            self._update_sequences()
+        if aggregates:
+            self._merge_daily_aggregates()
+        self._drop_id_maps()
+        return {'merged': runs_to_merge, 'skipped': runs_in_source - runs_to_merge}
+
+    def _map_test_runs(self):
+        # Runs whose suite results are already archived would violate unique_suite_result_idx
+        offset = self.db.max_value('test_run', 'id') or 0
+        source_max_id = self.db._execute_and_fetchone(f"SELECT max(id) FROM {self._source('test_run')}")[0]
+        # The merged runs get new ids so their result partitions have to exist before copying
+        self.db.create_upcoming_partitions(offset + (source_max_id or 0))
+        self.db._execute(f"""
+            CREATE TEMP TABLE merge_run_map AS
+            SELECT run.id AS source_id, run.id + {int(offset)} AS target_id
+            FROM {self._source('test_run')} AS run
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM {self._source('suite_result')} AS source_result
+                JOIN suite_result ON suite_result.start_time=source_result.start_time
+                                 AND suite_result.fingerprint=source_result.fingerprint
+                WHERE source_result.test_run_id=run.id
+            )
+        """)
+        self.db._execute(f"""
+            INSERT INTO test_run(id, imported_at, archived_using, archiver_version, generator,
+                                 generated, rpa, dryrun, ignored, schema_version)
+            SELECT run_map.target_id, imported_at, archived_using, archiver_version, generator,
+                   generated, rpa, dryrun, ignored, schema_version
+            FROM {self._source('test_run')} AS run
+            JOIN merge_run_map AS run_map ON run_map.source_id=run.id
+        """)
+
+    def _merge_suites_and_test_cases(self):
+        self.db._execute(f"""
+            INSERT INTO suite(name, full_name, repository)
+            SELECT name, full_name, repository
+            FROM {self._source('suite')}
+            WHERE true
+            ON CONFLICT DO NOTHING
+        """)
+        self.db._execute(f"""
+            CREATE TEMP TABLE merge_suite_map AS
+            SELECT source_suite.id AS source_id, suite.id AS target_id
+            FROM {self._source('suite')} AS source_suite
+            JOIN suite ON suite.repository=source_suite.repository
+                      AND suite.full_name=source_suite.full_name
+        """)
+        self.db._execute(f"""
+            INSERT INTO test_case(name, full_name, suite_id)
+            SELECT source_test.name, source_test.full_name, suite_map.target_id
+            FROM {self._source('test_case')} AS source_test
+            JOIN merge_suite_map AS suite_map ON suite_map.source_id=source_test.suite_id
+            WHERE true
+            ON CONFLICT DO NOTHING
+        """)
+        self.db._execute(f"""
+            CREATE TEMP TABLE merge_test_map AS
+            SELECT source_test.id AS source_id, test_case.id AS target_id
+            FROM {self._source('test_case')} AS source_test
+            JOIN merge_suite_map AS suite_map ON suite_map.source_id=source_test.suite_id
+            JOIN test_case ON test_case.suite_id=suite_map.target_id
+                          AND test_case.full_name=source_test.full_name
+        """)
+
+    def _merge_series_and_builds(self):
+        self.db._execute(f"""
+            INSERT INTO test_series(name, team)
+            SELECT name, team
+            FROM {self._source('test_series')}
+            WHERE true
+            ON CONFLICT DO NOTHING
+        """)
+        self.db._execute(f"""
+            CREATE TEMP TABLE merge_series_map AS
+            SELECT source_series.id AS source_id, test_series.id AS target_id
+            FROM {self._source('test_series')} AS source_series
+            JOIN test_series ON test_series.team=source_series.team
+                            AND test_series.name=source_series.name
+        """)
+        self.db._execute("CREATE TEMP TABLE merge_build_map (series int, source_build int, target_build int)")
+        self.db.insert_many('merge_build_map', ('series', 'source_build', 'target_build'),
+                            self._build_numbers())
+        self.db._execute(f"""
+            INSERT INTO test_series_mapping(series, test_run_id, build_number, build_id)
+            SELECT series_map.target_id, run_map.target_id, build_map.target_build, tsm.build_id
+            FROM {self._source('test_series_mapping')} AS tsm
+            JOIN merge_run_map AS run_map ON run_map.source_id=tsm.test_run_id
+            JOIN merge_series_map AS series_map ON series_map.source_id=tsm.series
+            JOIN merge_build_map AS build_map ON build_map.series=series_map.target_id
+                                             AND build_map.source_build=tsm.build_number
+        """)
+
+    def _build_numbers(self):
+        # Builds with a build id already in the target series are joined to that build,
+        # other builds without a numeric build id are numbered after the last build of the series.
+        source_builds = self.db._execute_and_fetchall(f"""
+            SELECT series_map.target_id, tsm.build_number, max(tsm.build_id)
+            FROM {self._source('test_series_mapping')} AS tsm
+            JOIN merge_run_map AS run_map ON run_map.source_id=tsm.test_run_id
+            JOIN merge_series_map AS series_map ON series_map.source_id=tsm.series
+            GROUP BY series_map.target_id, tsm.build_number
+            ORDER BY series_map.target_id, tsm.build_number
+        """)
+        last_builds = dict(self.db._execute_and_fetchall("""
+            SELECT series, max(build_number)
+            FROM test_series_mapping
+            WHERE series IN (SELECT target_id FROM merge_series_map)
+            GROUP BY series
+        """))
+        builds_by_id = {(series, build_id): build_number for series, build_id, build_number
+                        in self.db._execute_and_fetchall("""
+            SELECT series, build_id, max(build_number)
+            FROM test_series_mapping
+            WHERE build_id IS NOT NULL
+              AND series IN (SELECT target_id FROM merge_series_map)
+            GROUP BY series, build_id
+        """)}
+        build_numbers = []
+        for series, source_build, build_id in source_builds:
+            target_build = builds_by_id.get((series, build_id)) if build_id else None
+            if not target_build and build_id:
+                # Numeric build ids are used as build numbers as in Archiver.report_series()
+                try:
+                    target_build = int(build_id)
+                except ValueError:
+                    pass
+            if not target_build:
+                target_build = last_builds.get(series, 0) + 1
+                last_builds[series] = target_build
+                if build_id:
+                    builds_by_id[(series, build_id)] = target_build
+            build_numbers.append((series, source_build, target_build))
+        return build_numbers
+
+    def _merge_keyword_trees(self):
+        # Keyword trees are content addressed so the fingerprint is enough for deduplication
+        self.db._execute(f"""
+            INSERT INTO keyword_tree(fingerprint, keyword, library, status, arguments)
+            SELECT fingerprint, keyword, library, status, arguments
+            FROM {self._source('keyword_tree')}
+            WHERE true
+            ON CONFLICT DO NOTHING
+        """)
+        self.db._execute(f"""
+            INSERT INTO tree_hierarchy(fingerprint, subtree, call_index)
+            SELECT fingerprint, subtree, call_index
+            FROM {self._source('tree_hierarchy')}
+            WHERE true
+            ON CONFLICT DO NOTHING
+        """)
+
+    def _merge_results(self):
+        result_columns = ('status', 'setup_status', 'execution_status', 'teardown_status', 'start_time',
+                          'elapsed', 'setup_elapsed', 'execution_elapsed', 'teardown_elapsed',
+                          'fingerprint', 'setup_fingerprint', 'execution_fingerprint',
+                          'teardown_fingerprint', 'execution_path')
+        columns = ', '.join(result_columns)
+        source_columns = ', '.join(f'result.{column}' for column in result_columns)
+        self.db._execute(f"""
+            INSERT INTO suite_result(suite_id, test_run_id, {columns})
+            SELECT suite_map.target_id, run_map.target_id, {source_columns}
+            FROM {self._source('suite_result')} AS result
+            JOIN merge_run_map AS run_map ON run_map.source_id=result.test_run_id
+            JOIN merge_suite_map AS suite_map ON suite_map.source_id=result.suite_id
+        """)
+        self.db._execute(f"""
+            INSERT INTO test_result(test_id, test_run_id, critical, {columns})
+            SELECT test_map.target_id, run_map.target_id, result.critical, {source_columns}
+            FROM {self._source('test_result')} AS result
+            JOIN merge_run_map AS run_map ON run_map.source_id=result.test_run_id
+            JOIN merge_test_map AS test_map ON test_map.source_id=result.test_id
+        """)
+        self.db._execute(f"""
+            INSERT INTO log_message(execution_path, test_run_id, test_id, suite_id,
+                                    timestamp, log_level, message)
+            SELECT message.execution_path, run_map.target_id, test_map.target_id, suite_map.target_id,
+                   message.timestamp, message.log_level, message.message
+            FROM {self._source('log_message')} AS message
+            JOIN merge_run_map AS run_map ON run_map.source_id=message.test_run_id
+            JOIN merge_suite_map AS suite_map ON suite_map.source_id=message.suite_id
+            LEFT OUTER JOIN merge_test_map AS test_map ON test_map.source_id=message.test_id
+        """)
+        self.db._execute(f"""
+            INSERT INTO suite_metadata(suite_id, test_run_id, name, value)
+            SELECT suite_map.target_id, run_map.target_id, metadata.name, metadata.value
+            FROM {self._source('suite_metadata')} AS metadata
+            JOIN merge_run_map AS run_map ON run_map.source_id=metadata.test_run_id
+            JOIN merge_suite_map AS suite_map ON suite_map.source_id=metadata.suite_id
+        """)
+        self.db._execute(f"""
+            INSERT INTO test_tag(test_id, test_run_id, tag)
+            SELECT test_map.target_id, run_map.target_id, tag.tag
+            FROM {self._source('test_tag')} AS tag
+            JOIN merge_run_map AS run_map ON run_map.source_id=tag.test_run_id
+            JOIN merge_test_map AS test_map ON test_map.source_id=tag.test_id
+        """)
+        self.db._execute(f"""
+            INSERT INTO keyword_statistics(test_run_id, fingerprint, calls, max_execution_time,
+                                           min_execution_time, cumulative_execution_time, max_call_depth)
+            SELECT run_map.target_id, stats.fingerprint, stats.calls, stats.max_execution_time,
+                   stats.min_execution_time, stats.cumulative_execution_time, stats.max_call_depth
+            FROM {self._source('keyword_statistics')} AS stats
+            JOIN merge_run_map AS run_map ON run_map.source_id=stats.test_run_id
+        """)
+        self.db._execute(f"""
+            INSERT INTO ingest_ledger(content_hash, quick_hash, file_size, file_name, test_run_id,
+                                      archived_at)
+            SELECT ledger.content_hash, ledger.quick_hash, ledger.file_size, ledger.file_name,
+                   run_map.target_id, ledger.archived_at
+            FROM {self._source('ingest_ledger')} AS ledger
+            JOIN merge_run_map AS run_map ON run_map.source_id=ledger.test_run_id
+            WHERE true
+            ON CONFLICT DO NOTHING
+        """)
+
+    def _merge_daily_aggregates(self):
+        # The history of compacted test runs exists only in the aggregates
+        self.db._execute(f"""
+            INSERT INTO {compaction.AGGREGATE_TABLE}(series, test_id, day, runs, passes, fails, skips,
+                                                     elapsed_count, min_elapsed, avg_elapsed, max_elapsed,
+                                                     p95_elapsed)
+            SELECT series_map.target_id, test_map.target_id, daily.day, daily.runs, daily.passes,
+                   daily.fails, daily.skips, daily.elapsed_count, daily.min_elapsed, daily.avg_elapsed,
+                   daily.max_elapsed, daily.p95_elapsed
+            FROM {self._source(compaction.AGGREGATE_TABLE)} AS daily
+            JOIN merge_series_map AS series_map ON series_map.source_id=daily.series
+            JOIN merge_test_map AS test_map ON test_map.source_id=daily.test_id
+            WHERE true
+            ON CONFLICT (series, test_id, day) DO UPDATE SET {compaction.combined_aggregates(self.db)}
+        """)
+
+
+class SQLiteArchiveMerger(ArchiveMerger):
+    """Attaches the source archive to the target SQLite archive and copies the data directly."""
+
+    def _open_source(self, source_file, source):
+        self.db._execute("ATTACH DATABASE ? AS merge_source", [str(source_file)])
+        self._source_prefix = 'merge_source.'
+
+    def _close_source(self):
+        self.db.commit()
+        self.db._execute("DETACH DATABASE merge_source")
+
+
+class PostgresqlArchiveMerger(ArchiveMerger):
+    """Copies the source archive into temporary staging tables that are then merged set-wise."""
+
+    def _open_source(self, source_file, source):
+        self._source_prefix = 'merge_source_'
+        for table in SOURCE_TABLES:
+            columns = [row[1] for row in source.execute(f"PRAGMA table_info({table})")]
+            staging_table = self._source(table)
+            self.db._execute(f"DROP TABLE IF EXISTS {staging_table}")
+            self.db._execute(f"CREATE TEMP TABLE {staging_table} AS "
+                             f"SELECT {', '.join(columns)} FROM {table} WITH NO DATA")
+            cursor = source.execute(f"SELECT {', '.join(columns)} FROM {table}")
+            rows = cursor.fetchmany(STAGING_BATCH_SIZE)
+            while rows:
+                self.db.insert_many(staging_table, columns, [_staging_row(columns, row) for row in rows])
+                rows = cursor.fetchmany(STAGING_BATCH_SIZE)
+
+    def _close_source(self):
+        for table in SOURCE_TABLES:
+            self.db._execute(f"DROP TABLE IF EXISTS {self._source(table)}")
+        self.db.commit()
+
+    def _update_sequences(self):
+        # Test run ids were given explicitly so the sequence has to be moved past them
+        self.db._execute_and_fetchone("SELECT setval(pg_get_serial_sequence('test_run', 'id'), "
+                                      "(SELECT max(id) FROM test_run))")
+
+
+def _staging_row(columns, row):
+    # SQLite stores booleans as integers and argument lists as their string representation
+    values = []
+    for column, value in zip(columns, row):
+        if value is not None and column in BOOLEAN_COLUMNS:
+            value = bool(value)
+        elif value is not None and column == 'arguments':
+            value = ast.literal_eval(value)
+        values.append(value)
+    return values
+
+
+def archive_merger(connection):
+    if isinstance(connection, database.PostgresqlDatabase):
+        return PostgresqlArchiveMerger(connection)
+    if isinstance(connection, database.SQLiteDatabase):
+        return SQLiteArchiveMerger(connection)
+    raise ValueError(f"Merging is not supported for '{connection.__class__.__name__}'")
+
+
+def argument_parser():
+    parser = configs.base_argument_parser('Merge SQLite test archives into a target test archive.')
+    parser.add_argument('source_archives', nargs='+',
+                        help='SQLite test archives to merge into the target archive. Can be glob patterns')
+    return parser
+
+
+def main():
+    config, args = configs.configuration(argument_parser)
+    connection = database.get_connection_and_check_schema(config)
+    merger = archive_merger(connection)
+
+    total = {'merged': 0, 'skipped': 0}
+    for source_file in [item for pattern in args.source_archives for item in Path().glob(pattern)]:
+        if Path(source_file).resolve() == Path(config.database).resolve():
+            print(f"Skipping the target archive: '{source_file}'")
+            continue
+        print(f"Merging: '{source_file}'")
+        start = time.perf_counter()
+        try:
+            results = merger.merge(source_file)
+        except database.ArchiverSchemaException as exception:
+            sys.exit(str(exception))
+        print(f"Merged {results['merged']} test runs and skipped {results['skipped']} already archived "
+              f"test runs in {time.perf_counter() - start:.2f} seconds")
+        for key, value in results.items():
+            total[key] += value
+    print(f"Total: merged {total['merged']} and skipped {total['skipped']} test runs")
+
+    database.run_history_cleaning(connection, config)
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,15 @@
 # pylint: disable=R0912,R0915
 
+import codecs
 import datetime
 import os.path
 import sys
+import time
 import xml.sax
+from hashlib import sha1
 from pathlib import Path
 
-from . import archiver, configs, database
+from . import archiver, configs, database, event_stream, ingest_ledger
 
 DEFAULT_SUITE_NAME = 'Unnamed suite'
 
@@ -834,29 +837,137 @@ SUPPORTED_OUTPUT_FORMATS = {
 }
 
 
-def parse_xml(xml_file, output_format, connection, config, build_number_cache=None):
+def parse_xml(xml_file, output_format, connection, config, build_number_cache=None, commit=True,
+              journal_file=None):
+    """Archives the output file. Optionally writes an event journal of the parsed test run that can be
+    archived again later with replay_journal without parsing the output file."""
+    # pylint: disable=too-many-locals
     if build_number_cache is None:
         build_number_cache = {}
     output_format = output_format.lower()
     if not os.path.exists(xml_file):
         sys.exit('Could not find input file: ' + xml_file)
-    buffer_size = 65536
-    test_archiver = archiver.Archiver(connection, config, build_number_cache=build_number_cache)
-    if output_format in SUPPORTED_OUTPUT_FORMATS:
-        handler = SUPPORTED_OUTPUT_FORMATS[output_format](test_archiver)
-    else:
+    ledger = ingest_ledger.IngestLedger(connection)
+    if not config.force:
+        test_run_id = ledger.archived_test_run(xml_file)
+        if test_run_id:
+            raise database.DuplicateResultsError(
+                f'ERROR: the file has already been archived as test run {test_run_id}! '
+                'Use --force to archive it anyway.')
+    if output_format not in SUPPORTED_OUTPUT_FORMATS:
         raise ValueError(f"Unsupported report format '{output_format}'")
-    parser = xml.sax.make_parser()
-    parser.setContentHandler(handler)
-    with open(xml_file, encoding="UTF-8") as file:
-        buffer = file.read(buffer_size)
-        while buffer:
-            parser.feed(buffer)
-            buffer = file.read(buffer_size)
-    if len(test_archiver.stack) != 1:
-        raise RuntimeError('File parse error. Please check you used proper output format '
-                           '(default: robotframework).')
-    return test_archiver.end_test_run()
+    journal = None
+    if journal_file:
+        journal = event_stream.JournalFile(journal_file, {'format': output_format,
+                                                          'source': os.path.basename(xml_file)})
+        test_archiver = event_stream.JournalingArchiver(connection, config, journal.writer,
+                                                        build_number_cache=build_number_cache)
+    else:
+        test_archiver = archiver.Archiver(connection, config, build_number_cache=build_number_cache)
+    completed = False
+    try:
+        parser = xml.sax.make_parser()
+        parser.setContentHandler(SUPPORTED_OUTPUT_FORMATS[output_format](test_archiver))
+        # The file is hashed for the ingest ledger while it is read for parsing
+        content_hash = sha1()
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        with open(xml_file, 'rb') as file:
+            block = file.read(ingest_ledger.BLOCK_SIZE)
+            while block:
+                content_hash.update(block)
+                parser.feed(decoder.decode(block))
+                block = file.read(ingest_ledger.BLOCK_SIZE)
+            parser.feed(decoder.decode(b'', final=True))
+        if len(test_archiver.stack) != 1:
+            raise RuntimeError('File parse error. Please check you used proper output format '
+                               '(default: robotframework).')
+        entry = ingest_ledger.ledger_entry(xml_file, content_hash.hexdigest())
+        if journal:
+            test_archiver.source_file(entry)
+        ledger.record_entry(entry, test_archiver.test_run_id, force=config.force)
+        build_number_cache = test_archiver.end_test_run(commit=commit)
+        completed = True
+    finally:
+        if journal and completed:
+            journal.complete()
+        elif journal:
+            journal.discard()
+    return build_number_cache
+
+
+def check_ledger(connection, output_files):
+    """Reports which of the files are already archived. Returns the number of files not archived."""
+    ledger = ingest_ledger.IngestLedger(connection)
+    not_archived = 0
+    for output_file in output_files:
+        test_run_id = ledger.archived_test_run(output_file)
+        if test_run_id:
+            print(f"Archived as test run {test_run_id}: '{output_file}'")
+        else:
+            print(f"Not archived: '{output_file}'")
+            not_archived += 1
+    return not_archived
+
+
+class IngestBatch:
+    """Archives multiple output files in grouped transactions.
+
+    Each file is archived inside its own savepoint so that a file that fails or has already been
+    archived is rolled back alone and the rest of the batch continues. The transaction is committed
+    after every commit_every_files files or when commit_every_secs seconds have passed since the
+    previous commit.
+    """
+
+    SAVEPOINT = 'archived_file'
+
+    def __init__(self, connection, commit_every_files=1, commit_every_secs=0):
+        self.db = connection
+        self.commit_every_files = max(commit_every_files, 1)
+        self.commit_every_secs = commit_every_secs
+        self.ingested = []
+        self.skipped = []
+        self.failed = []
+        self._uncommitted_files = 0
+        self._last_commit = time.monotonic()
+
+    def archive(self, output_file, archive_function, *args, **kwargs):
+        result = None
+        self.db.savepoint(self.SAVEPOINT)
+        try:
+            result = archive_function(*args, **kwargs)
+            self.db.release_savepoint(self.SAVEPOINT)
+        except database.DuplicateResultsError as error:
+            self.db.rollback_to_savepoint(self.SAVEPOINT)
+            print(f"Skipped '{output_file}': {error}")
+            self.skipped.append(output_file)
+        except Exception as error: # pylint: disable=broad-except
+            self.db.rollback_to_savepoint(self.SAVEPOINT)
+            print(f"ERROR: Failed to archive '{output_file}': {error}")
+            self.failed.append(output_file)
+        else:
+            self.ingested.append(output_file)
+        self._uncommitted_files += 1
+        if self._commit_due():
+            self.commit()
+        return result
+
+    def _commit_due(self):
+        if self._uncommitted_files >= self.commit_every_files:
+            return True
+        return bool(self.commit_every_secs) and time.monotonic() - self._last_commit >= self.commit_every_secs
+
+    def commit(self):
+        self.db.commit()
+        self._uncommitted_files = 0
+        self._last_commit = time.monotonic()
+
+    def finish(self):
+        if self._uncommitted_files:
+            self.commit()
+        print(f"Archived {len(self.ingested)} files, skipped {len(self.skipped)} already archived files "
+              f"and failed to archive {len(self.failed)} files")
+        for output_file in self.failed:
+            print(f"Failed: '{output_file}'")
 
 
 def argument_parser():
@@ -892,6 +1003,33 @@ Json file which contains information from the changed files for each repo. The f
     parser.add_argument('--metadata', action='append', metavar='NAME:VALUE',
                         help="Adds given metadata to the test run. Expected format: 'NAME:VALUE'")
 
+    group = parser.add_argument_group('Ingest ledger')
+    group.add_argument('--force', action='store_true', default=None,
+                       help=('Archive the output files even if the ingest ledger already records them as '
+                             'archived.'))
+    group.add_argument('--ledger-only', action='store_true', default=None,
+                       help=('Only check from the ingest ledger which of the output files are already '
+                             'archived without archiving anything. Exits with non-zero status if any of '
+                             'the files is not archived.'))
+
+    group = parser.add_argument_group('Event journal')
+    group.add_argument('--journal-dir', default=None,
+                       help=('Write an event journal of each parsed output file into given directory. The '
+                             'journals can be archived again with --from-journal without parsing the '
+                             'output files.'))
+    group.add_argument('--from-journal', action='store_true', default=None,
+                       help=('The given files are event journals written with --journal-dir or received by '
+                             'testarchive_daemon and they are replayed into the archive.'))
+
+    group = parser.add_argument_group('Transactions')
+    group.add_argument('--commit-every-files', default=None,
+                       help=('Commit the archived results after every given number of output files '
+                             '(default: 1). Each file is still archived in its own savepoint so a failing '
+                             'or already archived file is rolled back alone.'))
+    group.add_argument('--commit-every-secs', default=None,
+                       help=('Commit the archived results also when given number of seconds has passed '
+                             'since the previous commit. By default commits only by the number of files.'))
+
     group = parser.add_argument_group('ChangeEngine')
     group.add_argument('--change-engine-url', default=None,
                        help="Starts a listener that feeds results to ChangeEngine")
@@ -914,12 +1052,36 @@ def main():
     config, args = configs.configuration(argument_parser)
     connection = archiver.database_connection(config)
 
+    output_files = [item for pattern in args.output_files for item in Path().glob(pattern)]
+    if config.ledger_only:
+        not_archived = check_ledger(connection, output_files)
+        connection.close()
+        sys.exit(1 if not_archived else 0)
+
+    batch = IngestBatch(connection, config.commit_every_files, config.commit_every_secs)
     build_number_cache = {}
-    for output_file in [item for pattern in args.output_files for item in Path().glob(pattern)]:
-        print(f"Parsing: '{output_file}'")
-        build_number_cache = parse_xml(output_file, args.format, connection, config, build_number_cache)
+    if config.journal_dir:
+        os.makedirs(config.journal_dir, exist_ok=True)
+    for output_file in output_files:
+        # The cache is copied so that build numbers of a rolled back file are not reused
+        if config.from_journal:
+            print(f"Replaying: '{output_file}'")
+            result = batch.archive(output_file, event_stream.replay_journal, str(output_file), connection,
+                                   config, dict(build_number_cache), commit=False)
+        else:
+            print(f"Parsing: '{output_file}'")
+            journal_file = (os.path.join(config.journal_dir, event_stream.journal_name(output_file))
+                            if config.journal_dir else None)
+            result = batch.archive(output_file, parse_xml, output_file, args.format, connection, config,
+                                   dict(build_number_cache), commit=False, journal_file=journal_file)
+        if result is not None:
+            build_number_cache = result
+    batch.finish()
 
     database.run_history_cleaning(connection, config)
+    connection.close()
+    if batch.failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,254 @@
+# pylint: disable=protected-access
+
+DEFAULT_PARTITION_SIZE = 1000
+# Number of empty partitions kept ready after the partition of the newest test run
+PARTITIONS_AHEAD = 2
+
+PARTITION_TABLE = 'test_run_partition'
+PARTITIONED_TABLES = ('log_message', 'test_result', 'suite_result', 'keyword_statistics')
+
+# Primary keys and unique indexes of a partitioned table must include the partition key so
+# log_message is keyed by (test_run_id, id) and the uniqueness of suite results, that detects
+# already archived results, is kept in the unpartitioned suite_result_key table instead.
+TABLE_CONSTRAINTS = {
+    'log_message': (
+        "ALTER TABLE log_message ADD PRIMARY KEY (test_run_id, id)",
+        "ALTER TABLE log_message ADD FOREIGN KEY (test_run_id) REFERENCES test_run(id) ON DELETE CASCADE",
+        "ALTER TABLE log_message ADD FOREIGN KEY (test_id) REFERENCES test_case(id) ON DELETE CASCADE",
+        "ALTER TABLE log_message ADD FOREIGN KEY (suite_id) REFERENCES suite(id) ON DELETE CASCADE",
+        "CREATE INDEX test_log_message_index ON log_message(test_run_id, suite_id, test_id)",
+    ),
+    'test_result': (
+        "ALTER TABLE test_result ADD PRIMARY KEY (test_run_id, test_id)",
+        "ALTER TABLE test_result ADD FOREIGN KEY (test_id) REFERENCES test_case(id) ON DELETE CASCADE",
+        "ALTER TABLE test_result ADD FOREIGN KEY (test_run_id) REFERENCES test_run(id) ON DELETE CASCADE",
+        "CREATE INDEX test_result_test_index ON test_result(test_id)",
+    ),
+    'suite_result': (
+        "ALTER TABLE suite_result ADD PRIMARY KEY (test_run_id, suite_id)",
+        "ALTER TABLE suite_result ADD FOREIGN KEY (suite_id) REFERENCES suite(id) ON DELETE CASCADE",
+        "ALTER TABLE suite_result ADD FOREIGN KEY (test_run_id) REFERENCES test_run(id) ON DELETE CASCADE",
+        "CREATE INDEX suite_result_suite_index ON suite_result(suite_id)",
+    ),
+    'keyword_statistics': (
+        "ALTER TABLE keyword_statistics ADD PRIMARY KEY (test_run_id, fingerprint)",
+        ("ALTER TABLE keyword_statistics ADD FOREIGN KEY (test_run_id) REFERENCES test_run(id) "
+         "ON DELETE CASCADE"),
+        "ALTER TABLE keyword_statistics ADD FOREIGN KEY (fingerprint) REFERENCES keyword_tree(fingerprint)",
+        "CREATE INDEX keyword_statistics_fingerprint_index ON keyword_statistics(fingerprint)",
+    ),
+}
+
+SUITE_RESULT_KEY = (
+    """CREATE TABLE suite_result_key (
+        start_time timestamp,
+        fingerprint text,
+        test_run_id int REFERENCES test_run(id) ON DELETE CASCADE NOT NULL
+    )""",
+    "INSERT INTO suite_result_key SELECT start_time, fingerprint, test_run_id FROM suite_result",
+    "CREATE UNIQUE INDEX unique_suite_result_idx ON suite_result_key(start_time, fingerprint)",
+    "CREATE INDEX suite_result_key_test_run_idx ON suite_result_key(test_run_id)",
+    """CREATE FUNCTION insert_suite_result_key() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO suite_result_key(start_time, fingerprint, test_run_id)
+        VALUES (NEW.start_time, NEW.fingerprint, NEW.test_run_id);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql""",
+    """CREATE TRIGGER suite_result_key_trigger AFTER INSERT ON suite_result
+    FOR EACH ROW EXECUTE FUNCTION insert_suite_result_key()""",
+)
+
+# The newest test run id that has been or may have been handed out
+NEWEST_TEST_RUN_QUERY = """
+    SELECT greatest(
+        coalesce(pg_sequence_last_value(pg_get_serial_sequence('test_run', 'id')::regclass), 0),
+        coalesce((SELECT max(id) FROM test_run), 0)
+    )
+"""
+
+# Partitions whose test runs have all been queued for deleting and where no new test runs can end up
+CLEANED_PARTITIONS_QUERY = f"""
+    SELECT range_start, range_end
+    FROM {PARTITION_TABLE} AS part
+    WHERE range_end <= ({NEWEST_TEST_RUN_QUERY}) + 1
+      AND EXISTS (SELECT 1 FROM history_cleaning_queue AS queue
+                  WHERE queue.test_run_id>=part.range_start AND queue.test_run_id<part.range_end)
+      AND NOT EXISTS (SELECT 1 FROM test_run
+                      WHERE test_run.id>=part.range_start AND test_run.id<part.range_end
+                        AND NOT EXISTS (SELECT 1 FROM history_cleaning_queue AS queue
+                                        WHERE queue.test_run_id=test_run.id))
+    ORDER BY range_start
+"""
+
+# Serialises the creation of partitions between concurrent sessions
+PARTITION_LOCK_ID = 7263101
+
+
+def partition_name(table, range_start):
+    return f'{table}_p{range_start}'
+
+
+def default_partition_name(table):
+    return f'{table}_default'
+
+
+class TablePartitioner:
+    """Range partitions the result tables of a PostgreSQL archive by test_run_id.
+
+    Every partition holds the results of a range of partition_size consecutive test runs in each of
+    the PARTITIONED_TABLES. Partitions are created ahead of the archived test runs and the partitions
+    of fully cleaned ranges of test runs are dropped instead of deleting their rows. Results of test
+    runs that got ahead of the created partitions go to a default partition and they are moved to
+    their own partition when it is created.
+
+    Creating and dropping partitions locks the result tables briefly so it is done in separate short
+    transactions and never inside an archiving transaction.
+    """
+
+    def __init__(self, connection):
+        self.db = connection
+
+    def is_partitioned(self):
+        return self.db._execute_and_fetchone(f"SELECT to_regclass('{PARTITION_TABLE}')")[0] is not None
+
+    def partition_tables(self, partition_size=DEFAULT_PARTITION_SIZE):
+        """Converts the result tables to partitioned tables in one transaction.
+
+        All the results are copied so the result tables are locked for the duration.
+        """
+        if self.is_partitioned():
+            print('Result tables are already partitioned')
+            return
+        partition_size = max(int(partition_size), 1)
+        print(f'Partitioning result tables by {partition_size} test runs')
+        self.db._execute(f"""
+            CREATE TABLE {PARTITION_TABLE} (
+                range_start int PRIMARY KEY,
+                range_end int NOT NULL,
+                created_at timestamp DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        # The id sequence is kept for the new log_message table
+        self.db._execute("ALTER SEQUENCE log_message_id_seq OWNED BY NONE")
+        for table in PARTITIONED_TABLES:
+            self.db._execute(f"ALTER TABLE {table} RENAME TO {table}_unpartitioned")
+            self.db._execute(f"CREATE TABLE {table} (LIKE {table}_unpartitioned INCLUDING DEFAULTS) "
+                             "PARTITION BY RANGE (test_run_id)")
+        self._create_default_partitions()
+        newest = self.db._execute_and_fetchone(NEWEST_TEST_RUN_QUERY)[0]
+        self._create_partitions(0, partition_size, newest)
+        for table in PARTITIONED_TABLES:
+            print(f' - Copying {table}')
+            self.db._execute(f"INSERT INTO {table} SELECT * FROM {table}_unpartitioned")
+            self.db._execute(f"DROP TABLE {table}_unpartitioned")
+            for statement in TABLE_CONSTRAINTS[table]:
+                self.db._execute(statement)
+        self.db._execute("ALTER SEQUENCE log_message_id_seq OWNED BY log_message.id")
+        for statement in SUITE_RESULT_KEY:
+            self.db._execute(statement)
+        self.db.commit()
+        print(f'Partitioned {", ".join(PARTITIONED_TABLES)}')
+
+    def create_upcoming_partitions(self, newest_test_run_id=None):
+        """Creates the partitions up to PARTITIONS_AHEAD partitions after the newest test run.
+
+        Returns the number of created partition ranges.
+        """
+        if not self.is_partitioned():
+            return 0
+        self.db._execute_and_fetchone("SELECT pg_advisory_xact_lock(%s)", [PARTITION_LOCK_ID])
+        # Archives partitioned before there were default partitions get them here
+        self._create_default_partitions()
+        newest = self.db._execute_and_fetchone(NEWEST_TEST_RUN_QUERY)[0]
+        if newest_test_run_id is not None:
+            newest = max(newest, newest_test_run_id)
+        range_start, range_end = self.db._execute_and_fetchone(
+            f"SELECT range_start, range_end FROM {PARTITION_TABLE} ORDER BY range_start DESC LIMIT 1")
+        created = self._create_partitions(range_end, range_end - range_start, newest)
+        self.db.commit()
+        return created
+
+    def concurrent_index_statements(self, index, table, columns):
+        """Statements that build an index of a partitioned table without blocking writes.
+
+        A partitioned table can't be indexed concurrently so the index is created on the parent table
+        only, each partition is indexed concurrently and the partition indexes are attached to it.
+        The statements must be run outside a transaction.
+        """
+        statements = [f"CREATE INDEX IF NOT EXISTS {index} ON ONLY {table}({columns})"]
+        # Partitions attached after the parent index was created already have their index
+        # The default partition is the one without a range_start
+        unindexed = self.db._execute_and_fetchall(f"""
+            SELECT range_start FROM (
+                SELECT range_start, format('%%s_p%%s', %s::text, range_start) AS name FROM {PARTITION_TABLE}
+                UNION ALL
+                SELECT NULL, %s::text || '_default' WHERE to_regclass(%s::text || '_default') IS NOT NULL
+            ) AS partitions
+            WHERE NOT EXISTS (SELECT 1 FROM pg_inherits
+                              JOIN pg_index ON pg_index.indexrelid=pg_inherits.inhrelid
+                              WHERE pg_inherits.inhparent=to_regclass(%s)
+                                AND pg_index.indrelid=to_regclass(partitions.name))
+            ORDER BY range_start
+        """, [table, table, table, index])
+        for (range_start, ) in unindexed:
+            if range_start is None:
+                partition_index = f'{index}_default'
+                partition = default_partition_name(table)
+            else:
+                partition_index = f'{index}_p{range_start}'
+                partition = partition_name(table, range_start)
+            statements.append(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {partition_index} "
+                              f"ON {partition}({columns})")
+            statements.append(f"ALTER INDEX {index} ATTACH PARTITION {partition_index}")
+        return statements
+
+    def drop_cleaned_partitions(self):
+        """Drops the partitions whose test runs are all in the history cleaning queue.
+
+        Each partition is dropped and committed separately. The test runs themselves are still
+        deleted from the queue normally but their results are already gone.
+        Returns the number of dropped partitions.
+        """
+        dropped = 0
+        for range_start, range_end in self.db._execute_and_fetchall(CLEANED_PARTITIONS_QUERY):
+            for table in PARTITIONED_TABLES:
+                self.db._execute(f"DROP TABLE IF EXISTS {partition_name(table, range_start)}")
+            self.db.delete(PARTITION_TABLE, [range_start], where_query='WHERE range_start=%s')
+            self.db.commit()
+            dropped += 1
+            print(f" - Dropped the partitions of test runs {range_start}-{range_end - 1}")
+        return dropped
+
+    def _create_default_partitions(self):
+        for table in PARTITIONED_TABLES:
+            self.db._execute(f"CREATE TABLE IF NOT EXISTS {default_partition_name(table)} "
+                             f"PARTITION OF {table} DEFAULT")
+
+    def _create_partitions(self, range_start, partition_size, newest_test_run_id):
+        target_end = (newest_test_run_id // partition_size + 1 + PARTITIONS_AHEAD) * partition_size
+        if range_start < target_end:
+            # Keeps new results out of the default partitions while their rows are being moved.
+            # Archivers lock only the partitions they write to, so this waits only for those that
+            # got ahead of the partitions.
+            for table in PARTITIONED_TABLES:
+                self.db._execute(f"LOCK TABLE {default_partition_name(table)} IN EXCLUSIVE MODE")
+        created = 0
+        while range_start < target_end:
+            range_end = range_start + partition_size
+            for table in PARTITIONED_TABLES:
+                # Attaching a separately created table does not block the readers of the parent table
+                name = partition_name(table, range_start)
+                self.db._execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS)")
+                self.db._execute(f"""
+                    WITH moved AS (DELETE FROM {default_partition_name(table)}
+                                   WHERE test_run_id>={range_start} AND test_run_id<{range_end}
+                                   RETURNING *)
+                    INSERT INTO {name} SELECT * FROM moved
+                """)
+                self.db._execute(f"ALTER TABLE {table} ATTACH PARTITION {name} "
+                                 f"FOR VALUES FROM ({range_start}) TO ({range_end})")
+            self.db.insert(PARTITION_TABLE, {'range_start': range_start, 'range_end': range_end})
+            range_start = range_end
+            created += 1
+        return created
@@ -0,0 +1,13 @@
+-- Adds ingest ledger that records the archived output files by their content hashes
+CREATE TABLE ingest_ledger (
+    content_hash text PRIMARY KEY,
+    quick_hash text NOT NULL,
+    file_size bigint NOT NULL,
+    file_name text,
+    test_run_id int REFERENCES test_run(id) ON DELETE CASCADE NOT NULL,
+    archived_at timestamp DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX ingest_ledger_quick_hash_idx ON ingest_ledger(file_size, quick_hash);
+
+INSERT INTO schema_updates (schema_version, applied_by)
+VALUES (4, '{applied_by}');
@@ -0,0 +1,5 @@
+-- Adds index for paging the builds of a series by build number
+CREATE INDEX series_build_index ON test_series_mapping(series, build_number DESC);
+
+INSERT INTO schema_updates (schema_version, applied_by)
+VALUES (8, '{applied_by}');
@@ -0,0 +1,10 @@
+-- Adds indexes for the lookups of the archive API server queries that the primary keys don't cover.
+-- The indexes are built concurrently so that the archive stays writable while they are built.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS test_result_test_index ON test_result(test_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS suite_result_suite_index ON suite_result(suite_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS test_series_mapping_test_run_index ON test_series_mapping(test_run_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS keyword_statistics_fingerprint_index ON keyword_statistics(fingerprint);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS tree_hierarchy_subtree_index ON tree_hierarchy(subtree);
+
+INSERT INTO schema_updates (schema_version, applied_by)
+VALUES (9, '{applied_by}');
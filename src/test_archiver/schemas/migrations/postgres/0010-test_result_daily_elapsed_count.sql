@@ -0,0 +1,8 @@
+-- Adds the number of results with an elapsed time to the daily aggregates so that the averages of a day
+-- compacted in several batches are weighted by it. Earlier aggregates are assumed to have elapsed times
+-- for all of their results.
+ALTER TABLE test_result_daily ADD COLUMN elapsed_count int NOT NULL DEFAULT 0;
+UPDATE test_result_daily SET elapsed_count=runs WHERE avg_elapsed IS NOT NULL;
+
+INSERT INTO schema_updates (schema_version, applied_by)
+VALUES (10, '{applied_by}');
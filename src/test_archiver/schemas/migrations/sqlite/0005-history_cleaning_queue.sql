@@ -0,0 +1,8 @@
+-- Adds queue of the test runs to delete that lets an interrupted history cleaning continue
+CREATE TABLE history_cleaning_queue (
+    test_run_id int PRIMARY KEY,
+    queued_at timestamp DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO schema_updates (schema_version, applied_by)
+VALUES (5, '{applied_by}');
@@ -0,0 +1,11 @@
+-- Adds table for the compressed log message segments of test runs moved to cold storage
+CREATE TABLE log_archive (
+    test_run_id int PRIMARY KEY REFERENCES test_run(id) ON DELETE CASCADE,
+    message_count int NOT NULL,
+    compression text NOT NULL,
+    segment blob NOT NULL,
+    archived_at timestamp DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO schema_updates (schema_version, applied_by)
+VALUES (6, '{applied_by}');
@@ -0,0 +1,18 @@
+-- Adds table for the daily aggregates of test results compacted from deleted history
+CREATE TABLE test_result_daily (
+    series int REFERENCES test_series(id) ON DELETE CASCADE NOT NULL,
+    test_id int REFERENCES test_case(id) ON DELETE CASCADE NOT NULL,
+    day date NOT NULL,
+    runs int NOT NULL,
+    passes int NOT NULL,
+    fails int NOT NULL,
+    skips int NOT NULL,
+    min_elapsed int,
+    avg_elapsed real,
+    max_elapsed int,
+    p95_elapsed int,
+    PRIMARY KEY (series, test_id, day)
+);
+
+INSERT INTO schema_updates (schema_version, applied_by)
+VALUES (7, '{applied_by}');
@@ -6,7 +6,7 @@ CREATE TABLE schema_updates (
     applied_by text
 );
 INSERT INTO schema_updates(schema_version, initial_update, applied_by)
-VALUES (3, true, '{applied_by}');
+VALUES (10, true, '{applied_by}');
 
 CREATE TABLE test_series (
     id serial PRIMARY KEY,
@@ -35,6 +35,8 @@ CREATE TABLE test_series_mapping (
     build_id text,
     PRIMARY KEY (series, test_run_id, build_number)
 );
+CREATE INDEX series_build_index ON test_series_mapping(series, build_number DESC);
+CREATE INDEX test_series_mapping_test_run_index ON test_series_mapping(test_run_id);
 
 CREATE TABLE suite (
     id serial PRIMARY KEY,
@@ -64,6 +66,7 @@ CREATE TABLE suite_result (
     PRIMARY KEY (test_run_id, suite_id)
 );
 CREATE UNIQUE INDEX unique_suite_result_idx ON suite_result(start_time, fingerprint);
+CREATE INDEX suite_result_suite_index ON suite_result(suite_id);
 
 CREATE TABLE test_case (
     id serial PRIMARY KEY,
@@ -94,6 +97,7 @@ CREATE TABLE test_result (
     execution_path text,
     PRIMARY KEY (test_run_id, test_id)
 );
+CREATE INDEX test_result_test_index ON test_result(test_id);
 
 CREATE TABLE log_message (
     id serial PRIMARY KEY,
@@ -136,6 +140,7 @@ CREATE TABLE tree_hierarchy (
     call_index int,
     PRIMARY KEY (fingerprint, subtree, call_index)
 );
+CREATE INDEX tree_hierarchy_subtree_index ON tree_hierarchy(subtree);
 
 CREATE TABLE keyword_statistics (
     test_run_id int REFERENCES test_run(id) ON DELETE CASCADE NOT NULL,
@@ -147,3 +152,43 @@ CREATE TABLE keyword_statistics (
     max_call_depth int,
     PRIMARY KEY (test_run_id, fingerprint)
 );
+CREATE INDEX keyword_statistics_fingerprint_index ON keyword_statistics(fingerprint);
+
+CREATE TABLE ingest_ledger (
+    content_hash text PRIMARY KEY,
+    quick_hash text NOT NULL,
+    file_size bigint NOT NULL,
+    file_name text,
+    test_run_id int REFERENCES test_run(id) ON DELETE CASCADE NOT NULL,
+    archived_at timestamp DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX ingest_ledger_quick_hash_idx ON ingest_ledger(file_size, quick_hash);
+
+CREATE TABLE history_cleaning_queue (
+    test_run_id int PRIMARY KEY,
+    queued_at timestamp DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE log_archive (
+    test_run_id int PRIMARY KEY REFERENCES test_run(id) ON DELETE CASCADE,
+    message_count int NOT NULL,
+    compression text NOT NULL,
+    segment bytea NOT NULL,
+    archived_at timestamp DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE test_result_daily (
+    series int REFERENCES test_series(id) ON DELETE CASCADE NOT NULL,
+    test_id int REFERENCES test_case(id) ON DELETE CASCADE NOT NULL,
+    day date NOT NULL,
+    runs int NOT NULL,
+    passes int NOT NULL,
+    fails int NOT NULL,
+    skips int NOT NULL,
+    elapsed_count int NOT NULL DEFAULT 0,
+    min_elapsed int,
+    avg_elapsed double precision,
+    max_elapsed int,
+    p95_elapsed int,
+    PRIMARY KEY (series, test_id, day)
+);
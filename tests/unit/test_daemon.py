@@ -0,0 +1,169 @@
+import json
+
+import pytest
+
+from test_archiver import configs, daemon, database, event_stream, output_parser
+
+JUNIT_OUTPUT = """<?xml version="1.0" encoding="UTF-8"?>
+<testsuite name="Suite" tests="1" timestamp="2024-01-01T00:00:{second:02}" time="1.0">
+  <testcase classname="Suite" name="Test" time="0.5"/>
+</testsuite>
+"""
+
+
+@pytest.fixture
+def config(tmp_path):
+    config = configs.Config()
+    config.resolve(file_config={'database': str(tmp_path / 'archive.db'), 'team': 'Default team',
+                                'sqlite_busy_timeout': 10000})
+    return config
+
+
+@pytest.fixture
+def spool_dir(tmp_path):
+    spool = tmp_path / 'spool'
+    spool.mkdir()
+    return spool
+
+
+def drop_result(spool_dir, name, content, sidecar):
+    (spool_dir / name).write_text(content, encoding='utf-8')
+    if sidecar is not None:
+        (spool_dir / (name + '.json')).write_text(json.dumps(sidecar), encoding='utf-8')
+
+
+def test_file_config_applies_sidecar_metadata(config):
+    archive_config = daemon.file_config(config, {'team': 'Team A', 'series': 'Nightly#12',
+                                                 'metadata': {'branch': 'main'}})
+    assert archive_config.team == 'Team A'
+    assert archive_config.series == ['Nightly#12']
+    assert archive_config.metadata == {'branch': 'main'}
+    assert archive_config.repository == config.repository
+    assert config.team == 'Default team'
+
+
+def test_files_without_sidecar_are_not_picked_up(config, spool_dir):
+    drop_result(spool_dir, 'ready.xml', JUNIT_OUTPUT.format(second=1), {'format': 'junit'})
+    drop_result(spool_dir, 'incomplete.xml', JUNIT_OUTPUT.format(second=2), None)
+    ingest_daemon = daemon.IngestDaemon(config, spool_dir)
+    assert ingest_daemon.pending_files() == [spool_dir / 'ready.xml']
+
+
+def test_run_once_archives_spooled_files(config, spool_dir):
+    drop_result(spool_dir, 'first.xml', JUNIT_OUTPUT.format(second=1),
+                {'format': 'junit', 'team': 'Team A', 'series': 'Nightly'})
+    drop_result(spool_dir, 'second.xml', JUNIT_OUTPUT.format(second=2), {'format': 'junit'})
+    drop_result(spool_dir, 'broken.xml', '<testsuite', {'format': 'junit'})
+    drop_result(spool_dir, 'bad_sidecar.xml', JUNIT_OUTPUT.format(second=3), ['not', 'an', 'object'])
+
+    ingest_daemon = daemon.IngestDaemon(config, spool_dir, workers=2)
+    ingest_daemon.run_once()
+
+    assert (ingest_daemon.archived, ingest_daemon.failed) == (2, 2)
+    assert sorted(path.name for path in (spool_dir / 'done').iterdir()) == [
+        'first.xml', 'first.xml.json', 'second.xml', 'second.xml.json']
+    assert sorted(path.name for path in (spool_dir / 'failed').iterdir()) == [
+        'bad_sidecar.xml', 'bad_sidecar.xml.json', 'broken.xml', 'broken.xml.json']
+    assert ingest_daemon.pending_files() == []
+
+    connection = database.get_connection(config)
+    try:
+        assert connection.get_row_count('test_run') == 2
+        teams = connection._execute_and_fetchall("SELECT DISTINCT team FROM test_series ORDER BY team")
+        assert teams == [('Default team', ), ('Team A', )]
+    finally:
+        connection.close()
+
+
+def test_same_file_name_is_not_overwritten(config, spool_dir):
+    ingest_daemon = daemon.IngestDaemon(config, spool_dir)
+    for second in (1, 2):
+        drop_result(spool_dir, 'output.xml', JUNIT_OUTPUT.format(second=second), {'format': 'junit'})
+        ingest_daemon.run_once()
+
+    assert sorted(path.name for path in (spool_dir / 'done').iterdir()) == [
+        'output.1.xml', 'output.1.xml.json', 'output.xml', 'output.xml.json']
+
+
+def test_interrupted_file_is_archived_from_its_journal(config, spool_dir, monkeypatch):
+    drop_result(spool_dir, 'output.xml', JUNIT_OUTPUT.format(second=1), {'format': 'junit'})
+    (spool_dir / '.journal').mkdir()
+    journal = spool_dir / '.journal' / event_stream.journal_name(spool_dir / 'output.xml')
+    # Parsed and journaled but never committed
+    connection = database.get_connection_and_check_schema(config)
+    output_parser.parse_xml(str(spool_dir / 'output.xml'), 'junit', connection, config, commit=False,
+                            journal_file=str(journal))
+    connection.close()
+
+    def no_parsing(*args, **kwargs):
+        raise AssertionError('The output file was parsed again')
+    monkeypatch.setattr(output_parser, 'parse_xml', no_parsing)
+    ingest_daemon = daemon.IngestDaemon(config, spool_dir)
+    ingest_daemon.run_once()
+
+    assert (ingest_daemon.archived, ingest_daemon.failed) == (1, 0)
+    assert not journal.exists()
+    connection = database.get_connection(config)
+    try:
+        assert connection.get_row_count('test_run') == 1
+    finally:
+        connection.close()
+
+
+def test_worker_reconnects_after_losing_its_connection(config, spool_dir, monkeypatch):
+    drop_result(spool_dir, 'first.xml', JUNIT_OUTPUT.format(second=1), {'format': 'junit'})
+    drop_result(spool_dir, 'second.xml', JUNIT_OUTPUT.format(second=2), {'format': 'junit'})
+    parse_xml = output_parser.parse_xml
+    broken = []
+
+    def break_connection_once(output_file, output_format, connection, *args, **kwargs):
+        if not broken:
+            broken.append(output_file)
+            connection.close()
+        return parse_xml(output_file, output_format, connection, *args, **kwargs)
+    monkeypatch.setattr(output_parser, 'parse_xml', break_connection_once)
+    monkeypatch.setattr(daemon, 'RECONNECT_DELAY_MIN', 0.01)
+    ingest_daemon = daemon.IngestDaemon(config, spool_dir)
+    ingest_daemon.run_once()
+
+    # The same worker archives the second file and the first one is left in the spool directory
+    assert (ingest_daemon.archived, ingest_daemon.failed) == (1, 0)
+    assert ingest_daemon.pending_files() == [spool_dir / 'first.xml']
+    assert not ingest_daemon._in_progress
+    assert not list((spool_dir / 'failed').iterdir())
+
+    ingest_daemon = daemon.IngestDaemon(config, spool_dir)
+    ingest_daemon.run_once()
+    assert (ingest_daemon.archived, ingest_daemon.failed) == (1, 0)
+    assert not ingest_daemon.pending_files()
+    connection = database.get_connection(config)
+    try:
+        assert connection.get_row_count('test_run') == 2
+    finally:
+        connection.close()
+
+
+def test_worker_survives_failing_commit(config, spool_dir, monkeypatch):
+    drop_result(spool_dir, 'first.xml', JUNIT_OUTPUT.format(second=1), {'format': 'junit'})
+    drop_result(spool_dir, 'second.xml', JUNIT_OUTPUT.format(second=2), {'format': 'junit'})
+    commit = output_parser.IngestBatch.commit
+    failed = []
+
+    def fail_once(batch):
+        if not failed:
+            failed.append(batch)
+            raise database.IntegrityError()
+        commit(batch)
+    monkeypatch.setattr(output_parser.IngestBatch, 'commit', fail_once)
+    ingest_daemon = daemon.IngestDaemon(config, spool_dir)
+    ingest_daemon.run_once()
+
+    assert (ingest_daemon.archived, ingest_daemon.failed) == (1, 1)
+    assert not ingest_daemon.pending_files()
+    assert not ingest_daemon._in_progress
+    assert sorted(path.name for path in (spool_dir / 'failed').iterdir()) == ['first.xml', 'first.xml.json']
+    connection = database.get_connection(config)
+    try:
+        assert connection.get_row_count('test_run') == 1
+    finally:
+        connection.close()
@@ -4,9 +4,9 @@
 import os
 import shutil
 import unittest
-from unittest.mock import Mock
+from unittest.mock import MagicMock, Mock, patch
 
-from test_archiver import database, configs
+from test_archiver import database, compaction, configs, log_tiering, partitioning
 
 
 class TestSchemaCheckingAndUpdatesWithMockDatabase(unittest.TestCase):
@@ -89,6 +89,194 @@ class TestSchemaCheckingAndUpdatesWithMockDatabase(unittest.TestCase):
         mock_db._run_script.assert_not_called()
 
 
+class TestPostgresqlPipelineDatabaseWithMockDriver(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_psycopg = MagicMock()
+        patcher = patch.object(database, 'psycopg', self.mock_psycopg)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        config = configs.Config()
+        config.resolve(file_config={'db_engine': 'postgres-pipeline'})
+        self.database = database.get_connection(config)
+        self.connection = self.mock_psycopg.connect.return_value
+        self.pipeline = self.connection.pipeline.return_value.__enter__.return_value
+
+    def test_get_connection_returns_pipeline_database(self):
+        self.assertIsInstance(self.database, database.PostgresqlPipelineDatabase)
+
+    def test_connecting_fails_without_psycopg(self):
+        config = configs.Config()
+        config.resolve(file_config={'db_engine': 'postgres-pipeline'})
+        with patch.object(database, 'psycopg', None):
+            with self.assertRaises(RuntimeError):
+                database.get_connection(config)
+
+    def test_inserts_are_not_synced(self):
+        self.database.insert('test_tag', {'tag': 'foo', 'test_id': 1, 'test_run_id': 1})
+        self.database.insert_or_ignore('keyword_tree', {'fingerprint': 'abc'}, ['fingerprint'])
+        self.database.update('test_run', {'dryrun': False}, {'id': 1})
+        self.assertEqual(self.connection.execute.call_count, 3)
+        self.pipeline.sync.assert_not_called()
+        self.connection.execute.return_value.fetchone.assert_not_called()
+
+    def test_fetching_id_fetches_result(self):
+        self.connection.execute.return_value.fetchone.return_value = (42, )
+        row_id = self.database.insert_and_return_id('test_run', {'archived_using': 'unittests'})
+        self.assertEqual(row_id, 42)
+        self.connection.execute.return_value.fetchone.assert_called_once()
+
+    def test_commit_syncs_pipeline(self):
+        self.database.insert('test_tag', {'tag': 'foo', 'test_id': 1, 'test_run_id': 1})
+        self.database.commit()
+        self.pipeline.sync.assert_called_once()
+        self.connection.commit.assert_called_once()
+
+    def test_integrity_errors_are_raised_on_sync(self):
+        class MockIntegrityError(Exception):
+            pass
+        self.database.IntegrityErrors = (MockIntegrityError, )
+        self.pipeline.sync.side_effect = MockIntegrityError()
+        self.database.insert('test_tag', {'tag': 'foo', 'test_id': 1, 'test_run_id': 1})
+        with self.assertRaises(database.IntegrityError):
+            self.database.commit()
+
+    def test_synced_insert_raises_integrity_errors(self):
+        class MockIntegrityError(Exception):
+            pass
+        self.database.IntegrityErrors = (MockIntegrityError, )
+        self.pipeline.sync.side_effect = MockIntegrityError()
+        with self.assertRaises(database.IntegrityError):
+            self.database.insert('suite_result', {'suite_id': 1, 'test_run_id': 1}, sync=True)
+        self.connection.commit.assert_not_called()
+
+
+class TestPostgresqlConcurrentIndexUpdate(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(database, 'psycopg2', MagicMock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        config = configs.Config()
+        config.resolve(file_config={'db_engine': 'postgresql'})
+        self.database = database.get_connection(config)
+        self.database._execute = Mock()
+        self.database._execute_and_fetchone = Mock()
+        self.database._execute_and_fetchall = Mock()
+        self.script = os.path.join(os.path.dirname(database.__file__),
+                                   'schemas/migrations/postgres/0009-api_query_indexes.sql')
+
+    def executed(self):
+        return [call.args[0] for call in self.database._execute.call_args_list]
+
+    def test_indexes_are_built_outside_transaction(self):
+        autocommit = []
+        self.database._execute.side_effect = lambda *_: autocommit.append(
+            self.database._connection.autocommit)
+        # Not partitioned and no invalid indexes
+        self.database._execute_and_fetchone.return_value = (None, )
+        self.database._run_script(self.script)
+        executed = self.executed()
+        self.assertEqual(len(executed), 6)
+        self.assertEqual(executed[0],
+                         "CREATE INDEX CONCURRENTLY IF NOT EXISTS test_result_test_index ON test_result(test_id)")
+        self.assertTrue(executed[-1].startswith('INSERT INTO schema_updates'))
+        self.assertEqual(autocommit, [True] * 6)
+        self.assertFalse(self.database._connection.autocommit)
+
+    def test_partitioned_tables_are_indexed_partition_by_partition(self):
+        self.database._execute_and_fetchone.side_effect = lambda sql, values=None: (
+            ('test_run_partition', ) if 'to_regclass' in sql and not values else None)
+        self.database._execute_and_fetchall.return_value = [(0, ), (1000, ), (None, )]
+        self.database._run_script(self.script)
+        executed = self.executed()
+        self.assertIn("CREATE INDEX IF NOT EXISTS test_result_test_index ON ONLY test_result(test_id)",
+                      executed)
+        self.assertIn("CREATE INDEX CONCURRENTLY IF NOT EXISTS test_result_test_index_default "
+                      "ON test_result_default(test_id)", executed)
+        self.assertIn("CREATE INDEX CONCURRENTLY IF NOT EXISTS test_result_test_index_p1000 "
+                      "ON test_result_p1000(test_id)", executed)
+        self.assertIn("ALTER INDEX test_result_test_index ATTACH PARTITION test_result_test_index_p1000",
+                      executed)
+        self.assertIn("CREATE INDEX CONCURRENTLY IF NOT EXISTS tree_hierarchy_subtree_index "
+                      "ON tree_hierarchy(subtree)", executed)
+
+    def test_invalid_indexes_are_rebuilt(self):
+        self.database._execute_and_fetchone.side_effect = lambda sql, values=None: (
+            (True, ) if values == ['suite_result_suite_index'] else (None, ))
+        self.database._run_script(self.script)
+        executed = self.executed()
+        drop = executed.index("DROP INDEX CONCURRENTLY IF EXISTS suite_result_suite_index")
+        self.assertTrue(executed[drop + 1].startswith(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS suite_result_suite_index"))
+        self.assertEqual(len(executed), 7)
+
+
+class TestTablePartitioningWithMockDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Mock()
+        self.partitioner = partitioning.TablePartitioner(self.db)
+
+    def executed(self):
+        return [call.args[0] for call in self.db._execute.call_args_list]
+
+    def test_upcoming_partitions_are_created_ahead_of_newest_test_run(self):
+        # to_regclass, advisory lock, newest test run and the last partition
+        self.db._execute_and_fetchone.side_effect = [('test_run_partition', ), (None, ), (2500, ),
+                                                     (2000, 3000)]
+        self.assertEqual(self.partitioner.create_upcoming_partitions(), 2)
+        executed = self.executed()
+        self.assertIn("ALTER TABLE log_message ATTACH PARTITION log_message_p3000 "
+                      "FOR VALUES FROM (3000) TO (4000)", executed)
+        self.assertIn("ALTER TABLE keyword_statistics ATTACH PARTITION keyword_statistics_p4000 "
+                      "FOR VALUES FROM (4000) TO (5000)", executed)
+        # Default partitions, their locks and three statements per created partition
+        self.assertEqual(len(executed), (2 + 2 * 3) * len(partitioning.PARTITIONED_TABLES))
+        self.db.insert.assert_called_with('test_run_partition', {'range_start': 4000, 'range_end': 5000})
+        self.db.commit.assert_called_once()
+
+    def test_results_ahead_of_partitions_are_moved_from_default_partition(self):
+        self.db._execute_and_fetchone.side_effect = [('test_run_partition', ), (None, ), (2500, ),
+                                                     (2000, 3000)]
+        self.partitioner.create_upcoming_partitions()
+        executed = [' '.join(sql.split()) for sql in self.executed()]
+        self.assertEqual(executed[0],
+                         "CREATE TABLE IF NOT EXISTS log_message_default PARTITION OF log_message DEFAULT")
+        self.assertIn("LOCK TABLE test_result_default IN EXCLUSIVE MODE", executed)
+        move = ("WITH moved AS (DELETE FROM test_result_default WHERE test_run_id>=3000 AND test_run_id<4000 "
+                "RETURNING *) INSERT INTO test_result_p3000 SELECT * FROM moved")
+        attach = "ALTER TABLE test_result ATTACH PARTITION test_result_p3000 FOR VALUES FROM (3000) TO (4000)"
+        self.assertLess(executed.index(move), executed.index(attach))
+
+    def test_merged_test_runs_get_partitions(self):
+        self.db._execute_and_fetchone.side_effect = [('test_run_partition', ), (None, ), (10, ),
+                                                     (0, 1000)]
+        self.assertEqual(self.partitioner.create_upcoming_partitions(newest_test_run_id=1500), 3)
+
+    def test_nothing_is_created_without_partitioning(self):
+        self.db._execute_and_fetchone.return_value = (None, )
+        self.assertEqual(self.partitioner.create_upcoming_partitions(), 0)
+        self.db._execute.assert_not_called()
+
+    def test_cleaned_partitions_are_dropped(self):
+        self.db._execute_and_fetchall.return_value = [(0, 1000), (1000, 2000)]
+        self.assertEqual(self.partitioner.drop_cleaned_partitions(), 2)
+        self.assertIn("DROP TABLE IF EXISTS test_result_p1000", self.executed())
+        self.assertEqual(self.db.commit.call_count, 2)
+
+    def test_partitioning_is_not_supported_on_sqlite(self):
+        config = configs.Config()
+        config.resolve(file_config={'database': ':memory:'})
+        connection = database.SQLiteDatabase(config)
+        try:
+            with self.assertRaises(database.ArchiverSchemaException):
+                connection.partition_tables(100)
+            self.assertEqual(connection.create_upcoming_partitions(), 0)
+        finally:
+            connection.close()
+
+
 class TestSqliteDatabaseTemplate(unittest.TestCase):
 
     @classmethod
@@ -179,6 +367,18 @@ class TestSqliteDatabaseMethods(TestSqliteDatabaseTemplate):
         row_count = self.database.fetch_one_value('keyword_tree', 'count(*)')
         self.assertEqual(row_count, 2)
 
+    def test_rollback_to_savepoint(self):
+        self.database.insert('keyword_tree', {'fingerprint': '1234567890123456789012345678901234567890'})
+        self.database.savepoint('test_savepoint')
+        self.database.insert('keyword_tree', {'fingerprint': '0987654321098765432109876543210987654321'})
+        self.database.rollback_to_savepoint('test_savepoint')
+        self.database.savepoint('test_savepoint')
+        self.database.insert('keyword_tree', {'fingerprint': '1111111111111111111111111111111111111111'})
+        self.database.release_savepoint('test_savepoint')
+        self.database.commit()
+        row_count = self.database.fetch_one_value('keyword_tree', 'count(*)')
+        self.assertEqual(row_count, 2)
+
     def test_applying_schema_updates(self):
         latest_update = self.database._latest_update_applied()
         self.assertTrue(latest_update < 10001)
@@ -230,6 +430,165 @@ class TestSqliteDatabaseMethods(TestSqliteDatabaseTemplate):
         self.assertEqual(row_count, 0)
 
 
+class TestSqliteQueryPlans(TestSqliteDatabaseTemplate):
+    """The lookups of the archive API server queries must not scan the result tables."""
+
+    def assert_uses_index(self, sql, index):
+        plan = ' | '.join(row[-1] for row in self.database._execute_and_fetchall(
+            f"EXPLAIN QUERY PLAN {sql}", [1]))
+        self.assertIn(f'USING INDEX {index}', plan)
+        self.assertNotIn('SCAN', plan)
+
+    def test_test_history_uses_index(self):
+        self.assert_uses_index("""
+            SELECT build_number, status FROM test_result
+            JOIN test_series_mapping as tsm ON tsm.test_run_id=test_result.test_run_id
+            WHERE test_result.test_id=?
+        """, 'test_result_test_index')
+
+    def test_suite_history_uses_index(self):
+        self.assert_uses_index("SELECT test_run_id, status FROM suite_result WHERE suite_id=?",
+                               'suite_result_suite_index')
+
+    def test_series_of_test_run_uses_index(self):
+        self.assert_uses_index("SELECT series, build_number FROM test_series_mapping WHERE test_run_id=?",
+                               'test_series_mapping_test_run_index')
+
+    def test_keyword_measures_use_index(self):
+        self.assert_uses_index("""
+            SELECT keyword, sum(calls) FROM keyword_statistics as stats
+            JOIN keyword_tree as kw ON kw.fingerprint=stats.fingerprint
+            WHERE stats.fingerprint=?
+            GROUP BY keyword
+        """, 'keyword_statistics_fingerprint_index')
+
+    def test_keyword_parents_use_index(self):
+        self.assert_uses_index("SELECT fingerprint FROM tree_hierarchy WHERE subtree=?",
+                               'tree_hierarchy_subtree_index')
+
+    def test_indexes_are_added_by_schema_update(self):
+        for index in ('test_result_test_index', 'suite_result_suite_index',
+                      'test_series_mapping_test_run_index', 'keyword_statistics_fingerprint_index',
+                      'tree_hierarchy_subtree_index'):
+            self.database._execute(f"DROP INDEX {index}")
+        self.database._execute("ALTER TABLE test_result_daily DROP COLUMN elapsed_count")
+        self.database.update('schema_updates', {'schema_version': 8}, {'schema_version': 10})
+        self.database.commit()
+        self.database.allow_minor_schema_updates = True
+        self.database.check_and_update_schema()
+        self.assertEqual(self.database._latest_update_applied(), 10)
+        self.test_test_history_uses_index()
+        self.test_keyword_parents_use_index()
+
+
+class TestSqliteIngestProfile(TestSqliteDatabaseTemplate):
+
+    def setUp(self):
+        temp_db = '{}.{}.db'.format(self.__class__.__name__, self._testMethodName)
+        full_path = os.path.join(self.__class__.dir_path, temp_db)
+        config = configs.Config()
+        config.resolve(file_config={'database': full_path, 'sqlite_profile': 'ingest',
+                                    'sqlite_busy_timeout': 5000, 'sqlite_defer_foreign_keys': True})
+        self.database = database.SQLiteDatabase(config)
+        self.assertTrue(self.database._initialize_schema())
+
+    def _pragma_value(self, pragma):
+        return self.database._execute_and_fetchone(f"PRAGMA {pragma}")[0]
+
+    def test_profile_pragmas_are_set(self):
+        self.assertEqual(self._pragma_value('journal_mode'), 'wal')
+        self.assertEqual(self._pragma_value('synchronous'), 1)
+        self.assertEqual(self._pragma_value('cache_size'), -65536)
+        self.assertEqual(self._pragma_value('temp_store'), 2)
+        self.assertEqual(self._pragma_value('busy_timeout'), 5000)
+        self.assertEqual(self._pragma_value('foreign_keys'), 0)
+
+    def test_unsupported_profile(self):
+        config = configs.Config()
+        config.resolve(file_config={'database': ':memory:', 'sqlite_profile': 'foobar'})
+        with self.assertRaises(ValueError):
+            database.SQLiteDatabase(config)
+
+    def test_foreign_keys_are_checked_on_commit(self):
+        test_run_id = self.database.insert_and_return_id(
+            'test_run', {'archived_using': 'unittests',
+                         'schema_version': self.database.current_schema_version()})
+        self.database.insert('test_tag', {'test_run_id': test_run_id, 'test_id': 1234, 'tag': 'orphan'})
+        with self.assertRaises(database.IntegrityError):
+            self.database.commit()
+        self.assertEqual(self.database.get_row_count('test_run'), 0)
+        self.assertEqual(self.database.get_row_count('test_tag'), 0)
+
+    def test_foreign_keys_are_checked_on_savepoint_release(self):
+        test_run_id = self.database.insert_and_return_id(
+            'test_run', {'archived_using': 'unittests',
+                         'schema_version': self.database.current_schema_version()})
+        self.database.savepoint('test_savepoint')
+        self.database.insert('test_tag', {'test_run_id': test_run_id, 'test_id': 1234, 'tag': 'orphan'})
+        with self.assertRaises(database.IntegrityError):
+            self.database.release_savepoint('test_savepoint')
+        self.database.rollback_to_savepoint('test_savepoint')
+        self.database.commit()
+        self.assertEqual(self.database.get_row_count('test_run'), 1)
+        self.assertEqual(self.database.get_row_count('test_tag'), 0)
+
+    def test_deleting_enables_foreign_keys_for_cascades(self):
+        test_run_id = self.database.insert_and_return_id(
+            'test_run', {'archived_using': 'unittests',
+                         'schema_version': self.database.current_schema_version()})
+        suite_id = self.database.insert_and_return_id(
+            'suite', {'full_name': 'Mock suite', 'name': 'Mock suite', 'repository': 'mock repo'})
+        self.database.insert('suite_result', {'suite_id': suite_id, 'test_run_id': test_run_id})
+        self.database.delete('test_run')
+        self.database.commit()
+        self.assertEqual(self._pragma_value('foreign_keys'), 1)
+        self.assertEqual(self.database.get_row_count('suite_result'), 0)
+
+
+class TestSqliteInMemoryArchive(TestSqliteDatabaseTemplate):
+
+    def setUp(self):
+        super().setUp()
+        self.database.insert('test_series', {'name': 'Existing series', 'team': 'Team'})
+        self.database.commit()
+        self.database.close()
+        self.database_file = self.database.database
+        config = configs.Config()
+        config.resolve(file_config={'database': self.database_file, 'sqlite_in_memory': True})
+        self.database = database.SQLiteDatabase(config)
+
+    def tearDown(self):
+        pass
+
+    def _rows_in_file(self, table):
+        connection = database.sqlite3.connect(self.database_file)
+        try:
+            return connection.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+        finally:
+            connection.close()
+
+    def test_existing_archive_is_loaded_to_memory(self):
+        self.assertEqual(self.database.get_row_count('test_series'), 1)
+
+    def test_archive_file_is_replaced_only_when_closed(self):
+        self.database.insert('test_series', {'name': 'New series', 'team': 'Team'})
+        self.database.commit()
+        self.assertEqual(self._rows_in_file('test_series'), 1)
+        self.database.close()
+        self.assertEqual(self._rows_in_file('test_series'), 2)
+        temp_files = [name for name in os.listdir(self.dir_path) if name.endswith('.tmp')]
+        self.assertEqual(temp_files, [])
+
+    def test_new_archive_is_created(self):
+        config = configs.Config()
+        new_file = os.path.join(self.dir_path, 'new_in_memory_archive.db')
+        config.resolve(file_config={'database': new_file, 'sqlite_in_memory': True})
+        in_memory = database.get_connection_and_check_schema(config)
+        self.assertFalse(os.path.exists(new_file))
+        in_memory.close()
+        self.assertTrue(os.path.exists(new_file))
+
+
 class TestSqliteDatabaseCleaning(TestSqliteDatabaseTemplate):
 
     def _generate_simple_archive(self):
@@ -346,6 +705,135 @@ class TestSqliteDatabaseCleaning(TestSqliteDatabaseTemplate):
         self.assert_number_of_rows('test_result', 4)
         self.assert_number_of_rows('keyword_statistics', 0)
 
+    def test_delete_history_in_batches(self):
+        self._generate_simple_archive()
+        self.database.delete_history(None, None, None, '2222-01-01', None, None, None, batch_size=1)
+        self.assert_number_of_rows('test_run', 0)
+        self.assert_number_of_rows('log_message', 0)
+        self.assert_number_of_rows('test_series', 0)
+        self.assert_number_of_rows('history_cleaning_queue', 0)
+
+    def test_delete_history_resumes_interrupted_cleaning(self):
+        self._generate_simple_archive()
+        # Left in the queue by an interrupted cleaning that kept only the last build
+        self.database.insert('history_cleaning_queue', {'test_run_id': 1})
+        self.database.commit()
+        self.database.delete_history(None, 3, None, None, None, None, None, batch_size=2)
+        self.assert_number_of_rows('test_run', 3)
+        self.assert_number_of_rows('test_result', 3)
+        self.assert_number_of_rows('history_cleaning_queue', 0)
+
+    def test_logs_are_cleaned_in_batches(self):
+        self._generate_simple_archive()
+        self.database.delete_history(None, None, None, None, True, None, None, batch_size=3)
+        self.assert_number_of_rows('test_run', 4)
+        self.assert_number_of_rows('log_message', 0)
+
+    def test_delete_history_compacts_results_into_daily_aggregates(self):
+        self._generate_simple_archive()
+        self.database.delete_history(None, 1, None, None, None, None, None, compact=True)
+        self.assert_number_of_rows('test_run', 2)
+        self.assert_number_of_rows('test_result', 2)
+        aggregates = self.database._execute_and_fetchall(
+            "SELECT name, runs FROM test_result_daily JOIN test_series ON test_series.id=series ORDER BY name")
+        self.assertEqual(aggregates, [('Series with all test runs', 2)])
+
+        self.database.delete_history(None, None, None, '2222-01-01', None, None, None, batch_size=1,
+                                     compact=True)
+        self.assert_number_of_rows('test_run', 0)
+        aggregates = self.database._execute_and_fetchall(
+            "SELECT name, runs FROM test_result_daily JOIN test_series ON test_series.id=series ORDER BY name")
+        self.assertEqual(aggregates, [('Series with all test runs', 4), ('Series with only first run', 1)])
+        # Series that have only aggregates left are kept
+        self.assert_number_of_rows('test_series', 2)
+
+    def test_compacted_averages_are_weighted_by_elapsed_times(self):
+        self._generate_simple_archive()
+        series, test_id = self.database._execute_and_fetchone(
+            "SELECT series, test_id FROM test_series_mapping JOIN test_result USING (test_run_id)")
+        compactor = compaction.ResultCompactor(self.database)
+        day = {'series': series, 'test_id': test_id, 'day': '2024-01-01', 'passes': 3, 'fails': 0, 'skips': 0}
+        compactor._upsert(dict(day, runs=3, elapsed_count=1, min_elapsed=100, avg_elapsed=100.0,
+                               max_elapsed=100, p95_elapsed=100))
+        compactor._upsert(dict(day, runs=3, elapsed_count=3, min_elapsed=300, avg_elapsed=400.0,
+                               max_elapsed=500, p95_elapsed=500))
+        compactor._upsert(dict(day, runs=2, elapsed_count=0, min_elapsed=None, avg_elapsed=None,
+                               max_elapsed=None, p95_elapsed=None))
+        self.assertEqual(self.database._execute_and_fetchone(
+            "SELECT runs, elapsed_count, min_elapsed, avg_elapsed, max_elapsed FROM test_result_daily"),
+            (8, 4, 100, 325.0, 500))
+
+    def test_compacting_requires_runs_to_keep(self):
+        self._generate_simple_archive()
+        with self.assertRaises(ValueError):
+            self.database.delete_history(None, None, None, None, None, None, None, compact=True)
+        with self.assertRaises(ValueError):
+            self.database.delete_history(None, 1, None, None, True, None, None, compact=True)
+        self.assert_number_of_rows('test_run', 4)
+        self.assert_number_of_rows('log_message', 8)
+
+    def test_daily_aggregates(self):
+        rows = [(1, 10, '20240101 12:00:00.000', 'PASS', 100),
+                (1, 10, '2024-01-01 18:00:00', 'FAIL', 300),
+                (1, 10, '2024-01-01 19:00:00', 'SKIP', None),
+                (1, 10, '2024-01-02 12:00:00', 'PASS', 200),
+                (1, 10, '2024-01-02 13:00:00', 'SKIPPED', None)]
+        self.assertEqual(compaction.daily_aggregates(rows), [
+            {'series': 1, 'test_id': 10, 'day': '2024-01-01', 'runs': 3, 'passes': 1, 'fails': 1, 'skips': 1,
+             'elapsed_count': 2, 'min_elapsed': 100, 'avg_elapsed': 200.0, 'max_elapsed': 300,
+             'p95_elapsed': 300},
+            {'series': 1, 'test_id': 10, 'day': '2024-01-02', 'runs': 2, 'passes': 1, 'fails': 0, 'skips': 1,
+             'elapsed_count': 1, 'min_elapsed': 200, 'avg_elapsed': 200.0, 'max_elapsed': 200,
+             'p95_elapsed': 200},
+        ])
+
+    def test_logs_are_moved_to_cold_storage(self):
+        self._generate_simple_archive()
+        live_messages = self.database._execute_and_fetchall(
+            "SELECT test_run_id, message FROM log_message ORDER BY test_run_id, rowid")
+        self.database.delete_history(None, 1, None, None, None, None, None, batch_size=3, tier_logs=True)
+        self.assert_number_of_rows('test_run', 4)
+        self.assert_number_of_rows('log_message', 4)
+        self.assert_number_of_rows('log_archive', 2)
+
+        tierer = log_tiering.LogTierer(self.database)
+        tiered_run, message_count = self.database._execute_and_fetchone(
+            "SELECT test_run_id, message_count FROM log_archive ORDER BY test_run_id")
+        archived = tierer.archived_messages(tiered_run)
+        self.assertEqual(len(archived), message_count)
+        self.assertEqual([message['message'] for message in archived],
+                         [message for run, message in live_messages if run == tiered_run])
+
+        self.database.delete_history(None, None, None, None, True, None, None)
+        self.assert_number_of_rows('log_message', 0)
+        self.assert_number_of_rows('log_archive', 0)
+
+    def test_log_segments_round_trip(self):
+        rows = [('s1-t1', 1, 1, '2024-01-01 12:00:00.100000', 'INFO', 'Hello'),
+                ('s1-t1', 1, 1, None, 'WARN', 'ä' * 100)]
+        for compression in ('gzip', log_tiering.default_compression()):
+            segment = log_tiering.encode_segment(rows, compression)
+            self.assertEqual([tuple(message.values()) for message in
+                              log_tiering.decode_segment(segment, compression)], rows)
+
+    def test_new_archive_uses_incremental_vacuum(self):
+        auto_vacuum = self.database._execute_and_fetchone("PRAGMA auto_vacuum")[0]
+        self.assertEqual(auto_vacuum, database.SQLITE_INCREMENTAL_VACUUM)
+
+
+class TestCleanBatchSize(unittest.TestCase):
+
+    def test_fixed_batch_size(self):
+        self.assertEqual(database.next_clean_batch_size(100, 60.0, 0), 100)
+
+    def test_batch_size_follows_target_duration(self):
+        self.assertEqual(database.next_clean_batch_size(100, 1.0, 10.0), 200)
+        self.assertEqual(database.next_clean_batch_size(100, 7.0, 10.0), 100)
+        self.assertEqual(database.next_clean_batch_size(100, 40.0, 10.0), 25)
+        self.assertEqual(database.next_clean_batch_size(1, 40.0, 10.0), 1)
+        self.assertEqual(database.next_clean_batch_size(database.MAX_CLEAN_BATCH_SIZE, 1.0, 10.0),
+                         database.MAX_CLEAN_BATCH_SIZE)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,236 @@
+import io
+import json
+
+import pytest
+
+from test_archiver import archiver, configs, daemon, database, event_stream, ingest_ledger
+from test_archiver.output_parser import parse_xml
+from test_archiver.ArchiverStreamListener import ArchiverStreamListener
+
+
+@pytest.fixture
+def config(tmp_path):
+    config = configs.Config()
+    config.resolve(file_config={'database': str(tmp_path / 'archive.db'), 'team': 'Default team'})
+    return config
+
+
+def record_test_run(recorder, keywords=1):
+    recorder.test_type = 'Robot Framework'
+    recorder.begin_test_run('ArchiverListener', None, 'Robot 7.0', False, False)
+    recorder.begin_suite('Suite')
+    recorder.begin_test('Test')
+    for _ in range(keywords):
+        recorder.begin_keyword('Log', 'BuiltIn', 'KEYWORD', ['Hello'])
+        recorder.begin_log_message('INFO', '20240101 12:00:00.100')
+        recorder.end_log_message('Hello')
+        recorder.end_keyword({'status': 'PASS', 'starttime': '20240101 12:00:00.000',
+                              'endtime': '20240101 12:00:00.200', 'args': ['Hello'], 'doc': 'Logs'})
+    recorder.end_test({'status': 'PASS', 'starttime': '20240101 12:00:00.000',
+                       'endtime': '20240101 12:00:01.000', 'tags': ['smoke'], 'longname': 'Suite.Test'})
+    recorder.end_suite({'status': 'PASS', 'starttime': '20240101 12:00:00.000',
+                        'endtime': '20240101 12:00:01.000', 'metadata': {'series': 'Nightly#3'}})
+    recorder.end_test_run()
+
+
+def test_values_round_trip():
+    values = [None, True, False, 0, 1, -1, 300, -2**40, 1.5, '', 'text', 'ä' * 200,
+              ['a', ['b', 2]], {'key': 'value', 'nested': {'n': -5}}]
+    stream = io.BytesIO()
+    writer = event_stream.EventWriter(stream, {'team': 'Team A'})
+    writer.write('begin_keyword', *values)
+    stream.seek(0)
+    events = list(event_stream.read_events(stream))
+    assert events == [('header', [{'version': event_stream.STREAM_VERSION, 'team': 'Team A'}]),
+                      ('begin_keyword', values)]
+
+
+def test_repeated_strings_are_sent_once():
+    stream = io.BytesIO()
+    writer = event_stream.EventWriter(stream)
+    writer.write('begin_keyword', 'A rather long keyword name', 'SomeLibrary', 'KEYWORD', [])
+    first = stream.tell()
+    writer.write('begin_keyword', 'A rather long keyword name', 'SomeLibrary', 'KEYWORD', [])
+    assert stream.tell() - first < 12
+    stream.seek(0)
+    events = list(event_stream.read_events(stream))
+    assert events[1] == events[2]
+
+
+def test_truncated_stream_is_an_error():
+    stream = io.BytesIO()
+    event_stream.EventWriter(stream).write('end_log_message', 'message')
+    with pytest.raises(event_stream.EventStreamError):
+        list(event_stream.read_events(io.BytesIO(stream.getvalue()[:-3])))
+
+
+def test_recorder_streams_only_the_used_attributes():
+    stream = io.BytesIO()
+    recorder = event_stream.EventRecorder(event_stream.EventWriter(stream))
+    record_test_run(recorder)
+    stream.seek(0)
+    events = dict(event_stream.read_events(stream))
+    assert events['end_keyword'] == [{'status': 'PASS', 'starttime': '20240101 12:00:00.000',
+                                      'endtime': '20240101 12:00:00.200'}]
+    assert 'longname' not in events['end_test'][0]
+
+
+def test_replayed_journal_is_archived(config, tmp_path):
+    journal = tmp_path / 'run.events'
+    with open(journal, 'wb') as stream:
+        record_test_run(event_stream.EventRecorder(event_stream.EventWriter(stream)), keywords=3)
+
+    connection = database.get_connection_and_check_schema(config)
+    try:
+        event_stream.replay_journal(str(journal), connection, config)
+        assert connection.get_row_count('test_run') == 1
+        assert connection.get_row_count('test_result') == 1
+        assert connection.get_row_count('log_message') == 3
+        assert connection._execute_and_fetchall(
+            "SELECT name, build_number FROM test_series JOIN test_series_mapping "
+            "ON test_series.id = test_series_mapping.series ORDER BY name") == [
+                ('All builds', 1), ('Nightly', 3)]
+        with pytest.raises(database.DuplicateResultsError):
+            event_stream.replay_journal(str(journal), connection, config)
+    finally:
+        connection.close()
+
+
+def test_listener_streams_to_daemon(config, tmp_path):
+    spool_dir = tmp_path / 'spool'
+    spool_dir.mkdir()
+    ingest_daemon = daemon.IngestDaemon(config, spool_dir)
+    ingest_daemon.failed_dir.mkdir()
+    receiver = daemon.EventStreamReceiver(ingest_daemon, str(tmp_path / 'archiver.sock'))
+    receiver.start()
+    try:
+        listener = ArchiverStreamListener(str(tmp_path / 'archiver.sock'), team='Team A')
+        listener.start_suite('Suite', {})
+        listener.start_test('Test', {})
+        listener.end_test('Test', {'status': 'FAIL', 'starttime': '20240101 12:00:00.000',
+                                   'endtime': '20240101 12:00:01.000', 'tags': []})
+        listener.end_suite('Suite', {'status': 'FAIL', 'starttime': '20240101 12:00:00.000',
+                                     'endtime': '20240101 12:00:01.000', 'metadata': {}})
+        listener.close()
+    finally:
+        receiver.stop()
+
+    [events_file] = ingest_daemon.pending_files()
+    sidecar = json.loads(events_file.with_name(events_file.name + '.json').read_text(encoding='utf-8'))
+    assert sidecar == {'format': 'events', 'team': 'Team A'}
+
+    ingest_daemon.run_once()
+    assert (ingest_daemon.archived, ingest_daemon.failed) == (1, 0)
+    connection = database.get_connection(config)
+    try:
+        assert connection._execute_and_fetchall("SELECT team FROM test_series WHERE name = 'All builds'") == [
+            ('Team A', )]
+        assert connection._execute_and_fetchall("SELECT status FROM test_result") == [('FAIL', )]
+    finally:
+        connection.close()
+
+
+def test_incomplete_stream_is_moved_to_failed(config, tmp_path):
+    spool_dir = tmp_path / 'spool'
+    spool_dir.mkdir()
+    ingest_daemon = daemon.IngestDaemon(config, spool_dir)
+    ingest_daemon.failed_dir.mkdir()
+    receiver = daemon.EventStreamReceiver(ingest_daemon, str(tmp_path / 'archiver.sock'))
+    stream = io.BytesIO()
+    recorder = event_stream.EventRecorder(event_stream.EventWriter(stream))
+    recorder.begin_test_run('ArchiverListener', None, None, False, False)
+    stream.seek(0)
+    response = io.BytesIO()
+    receiver.receive(stream, response)
+    receiver.server.server_close()
+
+    assert response.getvalue() == b''
+    assert ingest_daemon.pending_files() == []
+    assert [path.suffix for path in ingest_daemon.failed_dir.iterdir()] == ['.events']
+
+
+ROBOT_OUTPUT = """<?xml version="1.0" encoding="UTF-8"?>
+<robot generator="Robot 4.1 (Python 3.9)" generated="20240101 12:00:00.000" rpa="false" schemaversion="2">
+<suite id="s1" name="Suite" source="/tmp/suite.robot">
+<kw name="Prepare" library="Resource" type="SETUP">
+<msg timestamp="20240101 12:00:00.010" level="INFO">Setting up</msg>
+<status status="PASS" starttime="20240101 12:00:00.000" endtime="20240101 12:00:00.100"/>
+</kw>
+<test id="s1-t1" name="Test">
+<kw name="Log" library="BuiltIn">
+<arg>Hello</arg>
+<msg timestamp="20240101 12:00:00.200" level="INFO">Hello</msg>
+<status status="PASS" starttime="20240101 12:00:00.150" endtime="20240101 12:00:00.250"/>
+</kw>
+<tag>smoke</tag>
+<status status="PASS" starttime="20240101 12:00:00.100" endtime="20240101 12:00:00.300"/>
+</test>
+<meta name="Version">1.0</meta>
+<status status="PASS" starttime="20240101 12:00:00.000" endtime="20240101 12:00:00.400"/>
+</suite>
+<statistics></statistics>
+<errors></errors>
+</robot>
+"""
+
+ARCHIVED_RESULTS = (
+    "SELECT status, elapsed, setup_fingerprint, execution_fingerprint, fingerprint, execution_path "
+    "FROM suite_result",
+    "SELECT status, elapsed, execution_fingerprint, fingerprint, execution_path FROM test_result",
+    "SELECT fingerprint, keyword, library, status, arguments FROM keyword_tree ORDER BY fingerprint",
+    "SELECT fingerprint, subtree, call_index FROM tree_hierarchy ORDER BY fingerprint, call_index",
+    "SELECT message, execution_path FROM log_message ORDER BY timestamp",
+    "SELECT name, value FROM suite_metadata",
+    "SELECT fingerprint, calls, cumulative_execution_time FROM keyword_statistics ORDER BY fingerprint",
+)
+
+
+def archived_results(connection):
+    return [connection._execute_and_fetchall(query) for query in ARCHIVED_RESULTS]
+
+
+def test_journal_replays_parsed_results_without_hashing(config, tmp_path, monkeypatch):
+    output_file = tmp_path / 'output.xml'
+    output_file.write_text(ROBOT_OUTPUT, encoding='utf-8')
+    journal = tmp_path / 'output.xml.events'
+    parsed = database.get_connection_and_check_schema(config)
+    config.resolve(file_config={'database': str(tmp_path / 'second.db')})
+    replayed = database.get_connection_and_check_schema(config)
+    try:
+        parse_xml(str(output_file), 'robot', parsed, config, journal_file=str(journal))
+        assert journal.exists() and not (tmp_path / 'output.xml.events.part').exists()
+
+        def no_hashing(item):
+            raise AssertionError(f"Fingerprints of '{item.name}' were calculated again")
+        monkeypatch.setattr(archiver.FingerprintedItem, 'calculate_fingerprints', no_hashing)
+        event_stream.replay_journal(str(journal), replayed, config)
+
+        assert all(archived_results(parsed))
+        assert archived_results(replayed) == archived_results(parsed)
+        assert ingest_ledger.IngestLedger(replayed).archived_test_run(str(output_file)) == 1
+        with pytest.raises(database.DuplicateResultsError):
+            event_stream.replay_journal(str(journal), replayed, config)
+    finally:
+        parsed.close()
+        replayed.close()
+
+
+def test_output_files_with_same_name_get_own_journals(tmp_path):
+    first = event_stream.journal_name(tmp_path / 'a' / 'output.xml')
+    second = event_stream.journal_name(tmp_path / 'b' / 'output.xml')
+    assert first != second
+    assert first.startswith('output.xml.') and first.endswith(event_stream.JOURNAL_SUFFIX)
+    assert event_stream.journal_name(tmp_path / 'a' / '..' / 'a' / 'output.xml') == first
+
+
+def test_failed_parse_leaves_no_journal(config, tmp_path):
+    output_file = tmp_path / 'output.xml'
+    output_file.write_text(ROBOT_OUTPUT[:600], encoding='utf-8')
+    connection = database.get_connection_and_check_schema(config)
+    try:
+        with pytest.raises(Exception):
+            parse_xml(str(output_file), 'robot', connection, config,
+                      journal_file=str(tmp_path / 'output.xml.events'))
+    finally:
+        connection.close()
+    assert list(tmp_path.glob('output.xml.events*')) == []
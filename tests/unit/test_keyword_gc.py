@@ -0,0 +1,190 @@
+import threading
+import time
+
+import pytest
+
+from test_archiver import configs, database, keyword_gc
+from test_archiver.output_parser import parse_xml
+
+ROBOT_OUTPUT = """<?xml version="1.0" encoding="UTF-8"?>
+<robot generator="Robot 4.1 (Python 3.9)" generated="20240101 12:00:0{second}.000" rpa="false" schemaversion="2">
+<suite id="s1" name="Suite" source="/tmp/suite.robot">
+<test id="s1-t1" name="Test">
+<kw name="{keyword}" library="Resource">
+<kw name="Log" library="BuiltIn">
+<arg>{message}</arg>
+<status status="PASS" starttime="20240101 12:00:0{second}.150" endtime="20240101 12:00:0{second}.250"/>
+</kw>
+<status status="PASS" starttime="20240101 12:00:0{second}.100" endtime="20240101 12:00:0{second}.300"/>
+</kw>
+<status status="PASS" starttime="20240101 12:00:0{second}.100" endtime="20240101 12:00:0{second}.300"/>
+</test>
+<status status="PASS" starttime="20240101 12:00:0{second}.000" endtime="20240101 12:00:0{second}.400"/>
+</suite>
+<statistics></statistics>
+<errors></errors>
+</robot>
+"""
+
+
+@pytest.fixture
+def archive(tmp_path):
+    config = configs.Config()
+    config.resolve(file_config={'database': str(tmp_path / 'archive.db')})
+    connection = database.get_connection_and_check_schema(config)
+    yield connection, config
+    connection.close()
+
+
+def archive_run(tmp_path, connection, config, second, keyword, message):
+    output_file = tmp_path / f'output{second}.xml'
+    output_file.write_text(ROBOT_OUTPUT.format(second=second, keyword=keyword, message=message),
+                           encoding='utf-8')
+    parse_xml(str(output_file), 'robot', connection, config)
+
+
+def keywords(connection):
+    rows = connection._execute_and_fetchall("SELECT keyword FROM keyword_tree WHERE keyword IS NOT NULL")
+    return sorted(keyword for keyword, in rows)
+
+
+def assert_trees_are_complete(connection):
+    dangling = connection._execute_and_fetchone("""
+        SELECT count(*) FROM tree_hierarchy
+        WHERE NOT EXISTS (SELECT 1 FROM keyword_tree WHERE keyword_tree.fingerprint=tree_hierarchy.subtree)
+           OR NOT EXISTS (SELECT 1 FROM keyword_tree WHERE keyword_tree.fingerprint=tree_hierarchy.fingerprint)
+    """)[0]
+    assert dangling == 0
+
+
+def delete_first_run(connection):
+    connection.delete_history(None, 1, None, None, None, None, None)
+
+
+def test_unreachable_trees_are_collected(tmp_path, archive):
+    connection, config = archive
+    archive_run(tmp_path, connection, config, 1, 'Old Keyword', 'Old message')
+    archive_run(tmp_path, connection, config, 2, 'New Keyword', 'New message')
+    delete_first_run(connection)
+
+    trees, hierarchy_rows = keyword_gc.KeywordTreeCollector(connection, batch_size=1).collect()
+
+    assert (trees, hierarchy_rows) == (3, 2)
+    assert keywords(connection) == ['Log', 'New Keyword']
+    assert_trees_are_complete(connection)
+
+
+def test_nothing_is_collected_when_all_trees_are_reachable(tmp_path, archive):
+    connection, config = archive
+    archive_run(tmp_path, connection, config, 1, 'Keyword', 'Message')
+    tree_count = connection.get_row_count('keyword_tree')
+    assert keyword_gc.KeywordTreeCollector(connection).collect() == (0, 0)
+    assert connection.get_row_count('keyword_tree') == tree_count
+
+
+def test_trees_of_runs_archived_while_collecting_are_kept(tmp_path, archive):
+    connection, config = archive
+    archive_run(tmp_path, connection, config, 1, 'Old Keyword', 'Old message')
+    archive_run(tmp_path, connection, config, 2, 'New Keyword', 'New message')
+    delete_first_run(connection)
+
+    class ArchivingCollector(keyword_gc.KeywordTreeCollector):
+        def _expand_marks(self, commit=True):
+            super()._expand_marks(commit)
+            if not getattr(self, 'archived', False):
+                # Archived after the marking reuses the trees of the deleted run
+                self.archived = True
+                archive_run(tmp_path, connection, config, 3, 'Old Keyword', 'Old message')
+
+    ArchivingCollector(connection, batch_size=1).collect()
+
+    assert keywords(connection) == ['Log', 'Log', 'New Keyword', 'Old Keyword']
+    assert_trees_are_complete(connection)
+
+
+def test_trees_reused_by_an_uncommitted_run_are_kept(tmp_path, archive):
+    connection, config = archive
+    archive_run(tmp_path, connection, config, 1, 'Old Keyword', 'Old message')
+    archive_run(tmp_path, connection, config, 2, 'New Keyword', 'New message')
+    delete_first_run(connection)
+    (fingerprint, ) = connection._execute_and_fetchone(
+        "SELECT fingerprint FROM keyword_tree WHERE keyword='Old Keyword'")
+
+    config.resolve(file_config={'database': str(tmp_path / 'archive.db'), 'sqlite_busy_timeout': 10000})
+    # An archiving transaction reuses a tree of the deleted run and stays open while collecting starts
+    connection.close()
+    connection = database.get_connection_and_check_schema(config)
+    connection.hold_archiving_lock()
+    test_run_id = connection.insert_and_return_id(
+        'test_run', {'archived_using': 'unittests', 'schema_version': connection.current_schema_version()})
+    connection.insert_or_ignore('keyword_tree', {'fingerprint': fingerprint}, ['fingerprint'])
+    connection.insert('keyword_statistics', {'test_run_id': test_run_id, 'fingerprint': fingerprint})
+
+    sweeping = threading.Event()
+    results = []
+
+    def collect():
+        collector_connection = database.get_connection_and_check_schema(config)
+        exclude_archiving = collector_connection.exclude_archiving
+
+        def signalling_exclude_archiving():
+            sweeping.set()
+            return exclude_archiving()
+        collector_connection.exclude_archiving = signalling_exclude_archiving
+        try:
+            results.append(keyword_gc.KeywordTreeCollector(collector_connection).collect())
+        finally:
+            collector_connection.close()
+
+    collector = threading.Thread(target=collect)
+    collector.start()
+    assert sweeping.wait(10)
+    time.sleep(0.2)
+    connection.commit()
+    collector.join(10)
+
+    assert results
+    assert keywords(connection) == ['Log', 'Log', 'New Keyword', 'Old Keyword']
+    assert_trees_are_complete(connection)
+    connection.close()
+
+
+def test_sweep_backs_off_while_archiving_runs(tmp_path, archive, monkeypatch):
+    connection, config = archive
+    archive_run(tmp_path, connection, config, 1, 'Old Keyword', 'Old message')
+    archive_run(tmp_path, connection, config, 2, 'New Keyword', 'New message')
+    delete_first_run(connection)
+    monkeypatch.setattr(keyword_gc, 'EXCLUDE_RETRY_DELAY_MIN', 0.01)
+    exclude_archiving = connection.exclude_archiving
+    attempts = []
+
+    def busy_archiving():
+        attempts.append(True)
+        # Archiving transactions are running on the first two attempts
+        return exclude_archiving() if len(attempts) > 2 else False
+    connection.exclude_archiving = busy_archiving
+    keyword_gc.KeywordTreeCollector(connection).collect()
+
+    assert len(attempts) > 2
+    assert keywords(connection) == ['Log', 'New Keyword']
+    assert_trees_are_complete(connection)
+
+
+def test_only_runs_after_the_marked_ones_are_read_again(tmp_path, archive):
+    connection, config = archive
+    archive_run(tmp_path, connection, config, 1, 'Old Keyword', 'Old message')
+    archive_run(tmp_path, connection, config, 2, 'New Keyword', 'New message')
+    execute_and_fetchall = connection._execute_and_fetchall
+    run_queries = []
+
+    def recording(sql, values=None):
+        if sql.startswith('SELECT id FROM test_run'):
+            run_queries.append((sql, values))
+        return execute_and_fetchall(sql, values)
+    connection._execute_and_fetchall = recording
+    keyword_gc.KeywordTreeCollector(connection, batch_size=1).collect()
+
+    # The first marking and the first sweep chunk read all the runs and the later chunks only the new ones
+    assert [values for _, values in run_queries[:2]] == [None, None]
+    assert len(run_queries) > 2
+    assert all(values == [2] for _, values in run_queries[2:])
@@ -0,0 +1,169 @@
+import os
+import shutil
+import unittest
+
+from test_archiver import archiver, configs, database, merge
+
+
+def archive_run(connection, series, run_index, suites=('Suite A', 'Suite B')):
+    config = configs.Config()
+    config.resolve(file_config={'series': [series], 'team': 'Merge team'})
+    test_archiver = archiver.Archiver(connection, config)
+    test_archiver.begin_test_run('unit test', None, 'unit test', False, False)
+    test_archiver.begin_suite('Top')
+    for suite in suites:
+        test_archiver.begin_suite(suite)
+        test_archiver.begin_status('PASS', f'2024-01-01 00:00:{run_index:02}.000')
+        test_archiver.metadata('run', str(run_index))
+        test_archiver.begin_test('Test')
+        test_archiver.update_tags('merged')
+        test_archiver.begin_keyword('Log', 'BuiltIn', 'kw', ['message'])
+        test_archiver.log_message('INFO', f'Message from run {run_index}', '2024-01-01 00:00:00.000')
+        test_archiver.update_status('PASS')
+        test_archiver.end_keyword()
+        test_archiver.end_test()
+        test_archiver.end_suite()
+    test_archiver.end_suite()
+    test_archiver.end_test_run()
+    connection.commit()
+
+
+class TestMergeSqliteArchives(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir_path = os.path.join(os.path.dirname(__file__), 'temp_merge_dbs')
+        try:
+            shutil.rmtree(cls.dir_path)
+        except FileNotFoundError:
+            pass
+        os.mkdir(cls.dir_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir_path)
+
+    def setUp(self):
+        self.target = self._archive('target')
+        self.merger = merge.archive_merger(self.target)
+
+    def tearDown(self):
+        self.target.close()
+
+    def _archive(self, name):
+        temp_db = '{}.{}.db'.format(self._testMethodName, name)
+        config = configs.Config()
+        config.resolve(file_config={'database': os.path.join(self.dir_path, temp_db)})
+        return database.get_connection_and_check_schema(config)
+
+    def _source(self, name, runs):
+        source = self._archive(name)
+        for series, run_index in runs:
+            archive_run(source, series, run_index)
+        source.close()
+        return source.database
+
+    def test_merging_sources_combines_runs(self):
+        first = self._source('first', [('Series', 1), ('Series', 2)])
+        second = self._source('second', [('Series', 3)])
+
+        self.assertEqual(self.merger.merge(first), {'merged': 2, 'skipped': 0})
+        self.assertEqual(self.merger.merge(second), {'merged': 1, 'skipped': 0})
+
+        self.assertEqual(self.target.get_row_count('test_run'), 3)
+        self.assertEqual(self.target.get_row_count('suite'), 3)
+        self.assertEqual(self.target.get_row_count('test_case'), 2)
+        self.assertEqual(self.target.get_row_count('suite_result'), 9)
+        self.assertEqual(self.target.get_row_count('test_result'), 6)
+        self.assertEqual(self.target.get_row_count('log_message'), 6)
+        self.assertEqual(self.target.get_row_count('test_tag'), 6)
+        self.assertEqual(self.target.get_row_count('suite_metadata'), 6)
+
+    def test_builds_are_renumbered_per_series(self):
+        first = self._source('first', [('Series', 1), ('Series', 2)])
+        second = self._source('second', [('Series', 3), ('Series', 4)])
+        self.merger.merge(first)
+        self.merger.merge(second)
+
+        builds = self.target._execute_and_fetchall(
+            "SELECT build_number FROM test_series_mapping "
+            "WHERE series=(SELECT id FROM test_series WHERE name='Series') ORDER BY test_run_id")
+        self.assertEqual([build for (build, ) in builds], [1, 2, 3, 4])
+
+    def test_named_builds_are_joined_to_existing_builds(self):
+        first = self._source('first', [('Series#release', 1)])
+        second = self._source('second', [('Series#release', 2), ('Series#42', 3)])
+        self.merger.merge(first)
+        self.merger.merge(second)
+
+        builds = self.target._execute_and_fetchall(
+            "SELECT build_id, build_number FROM test_series_mapping "
+            "WHERE series=(SELECT id FROM test_series WHERE name='Series') ORDER BY test_run_id")
+        self.assertEqual(builds, [('release', 1), ('release', 1), ('42', 42)])
+
+    def test_keyword_trees_are_deduplicated(self):
+        first = self._source('first', [('Series', 1)])
+        second = self._source('second', [('Series', 2)])
+        self.merger.merge(first)
+        keyword_trees = self.target.get_row_count('keyword_tree')
+        self.merger.merge(second)
+
+        self.assertEqual(self.target.get_row_count('keyword_tree'), keyword_trees)
+        self.assertEqual(self.target.get_row_count('keyword_statistics'), 2)
+
+    def test_already_merged_runs_are_skipped(self):
+        first = self._source('first', [('Series', 1), ('Series', 2)])
+        self.merger.merge(first)
+
+        self.assertEqual(self.merger.merge(first), {'merged': 0, 'skipped': 2})
+        self.assertEqual(self.target.get_row_count('test_run'), 2)
+
+    def test_merge_after_runs_archived_into_target(self):
+        archive_run(self.target, 'Series', 1)
+        first = self._source('first', [('Series', 1), ('Series', 2)])
+
+        self.assertEqual(self.merger.merge(first), {'merged': 1, 'skipped': 1})
+        self.assertEqual(self.target.get_row_count('test_run'), 2)
+        self.assertEqual(self.target.max_value('test_series_mapping', 'build_number'), 2)
+
+    def _compacted_source(self, name, runs, keep_builds):
+        source = self._archive(name)
+        for series, run_index in runs:
+            archive_run(source, series, run_index)
+        if keep_builds:
+            source.delete_history(None, keep_builds, None, None, None, None, None, compact=True)
+        else:
+            source.delete_history(None, None, None, '2222-01-01', None, None, None, compact=True)
+        source.close()
+        return source.database
+
+    def _daily_runs(self):
+        return self.target._execute_and_fetchall(
+            "SELECT test_case.full_name, runs FROM test_result_daily "
+            "JOIN test_case ON test_case.id=test_id JOIN test_series ON test_series.id=series "
+            "WHERE test_series.name='Series' ORDER BY test_case.full_name")
+
+    def test_daily_aggregates_are_merged(self):
+        first = self._compacted_source('first', [('Series', 1), ('Series', 2)], keep_builds=1)
+        self.assertEqual(self.merger.merge(first), {'merged': 1, 'skipped': 0})
+        self.assertEqual(self._daily_runs(), [('Top.Suite A.Test', 1), ('Top.Suite B.Test', 1)])
+
+        # A source without any test runs left has only its aggregates to merge
+        second = self._compacted_source('second', [('Series', 3), ('Series', 4)], keep_builds=None)
+        self.assertEqual(self.merger.merge(second), {'merged': 0, 'skipped': 0})
+        self.assertEqual(self._daily_runs(), [('Top.Suite A.Test', 3), ('Top.Suite B.Test', 3)])
+        self.assertEqual(self.target.get_row_count('test_run'), 1)
+        self.assertEqual(self.target.get_row_count('test_series'), 2)
+
+    def test_merging_source_with_different_schema_version_fails(self):
+        first = self._source('first', [('Series', 1)])
+        self.target._execute("INSERT INTO schema_updates(schema_version, applied_by) VALUES (10000, 'test')")
+        self.target.commit()
+
+        with self.assertRaises(database.ArchiverSchemaException):
+            self.merger.merge(first)
+        self.assertEqual(self.target.get_row_count('test_run'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
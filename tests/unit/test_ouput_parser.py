@@ -1,8 +1,11 @@
 import pytest
 from unittest.mock import Mock
 
-from test_archiver import configs, archiver
+from test_archiver import configs, archiver, database, ingest_ledger
 from test_archiver.output_parser import (
+    IngestBatch,
+    check_ledger,
+    parse_xml,
     XUnitOutputParser,
     JUnitOutputParser,
     MochaJUnitOutputParser,
@@ -60,3 +63,120 @@ def test_pytest_junit_has_test_type(pytest_junit):
 
 def test_mstest_has_test_type(mstest):
     assert mstest.archiver.test_type == "mstest"
+
+
+JUNIT_OUTPUT = """<?xml version="1.0" encoding="UTF-8"?>
+<testsuite name="Suite" tests="1" timestamp="2024-01-01T00:00:{second:02}" time="1.0">
+  <testcase classname="Suite" name="Test" time="0.5"/>
+</testsuite>
+"""
+
+
+@pytest.fixture
+def sqlite_archive(tmp_path):
+    config = configs.Config()
+    config.resolve(file_config={'database': str(tmp_path / 'archive.db')})
+    connection = database.get_connection_and_check_schema(config)
+    yield connection, config
+    connection.close()
+
+
+def junit_output(tmp_path, name, second):
+    output_file = tmp_path / name
+    output_file.write_text(JUNIT_OUTPUT.format(second=second), encoding='utf-8')
+    return str(output_file)
+
+
+def archive_files(batch, connection, config, output_files):
+    for output_file in output_files:
+        batch.archive(output_file, parse_xml, output_file, 'junit', connection, config, commit=False)
+    batch.finish()
+
+
+def test_ingest_batch_skips_duplicate_and_failing_files(tmp_path, sqlite_archive):
+    connection, config = sqlite_archive
+    first = junit_output(tmp_path, 'first.xml', 1)
+    second = junit_output(tmp_path, 'second.xml', 2)
+    broken = tmp_path / 'broken.xml'
+    broken.write_text('<testsuite', encoding='utf-8')
+
+    batch = IngestBatch(connection, commit_every_files=10)
+    archive_files(batch, connection, config, [first, str(broken), first, second])
+
+    assert batch.ingested == [first, second]
+    assert batch.skipped == [first]
+    assert batch.failed == [str(broken)]
+    assert connection.get_row_count('test_run') == 2
+    assert connection.get_row_count('test_result') == 2
+
+
+def test_ingest_batch_commits_every_n_files(tmp_path, sqlite_archive):
+    connection, config = sqlite_archive
+    output_files = [junit_output(tmp_path, f'output{i}.xml', i) for i in range(5)]
+    connection.commit = Mock(wraps=connection.commit)
+
+    batch = IngestBatch(connection, commit_every_files=2)
+    archive_files(batch, connection, config, output_files)
+
+    assert len(batch.ingested) == 5
+    assert connection.commit.call_count == 3
+
+
+def test_ingest_batch_commits_by_time(tmp_path, sqlite_archive):
+    connection, config = sqlite_archive
+    output_files = [junit_output(tmp_path, f'output{i}.xml', i) for i in range(3)]
+    connection.commit = Mock(wraps=connection.commit)
+
+    batch = IngestBatch(connection, commit_every_files=100, commit_every_secs=0.000001)
+    archive_files(batch, connection, config, output_files)
+
+    assert connection.commit.call_count == 3
+
+
+def test_archived_file_is_skipped_by_ingest_ledger(tmp_path, sqlite_archive):
+    connection, config = sqlite_archive
+    output_file = junit_output(tmp_path, 'output.xml', 1)
+    parse_xml(output_file, 'junit', connection, config)
+
+    ledger = ingest_ledger.IngestLedger(connection)
+    test_run_id = connection.max_value('test_run', 'id')
+    assert ledger.archived_test_run(output_file) == test_run_id
+    assert ledger.archived_test_run(junit_output(tmp_path, 'other.xml', 2)) is None
+
+    copy = tmp_path / 'copy.xml'
+    copy.write_bytes((tmp_path / 'output.xml').read_bytes())
+    with pytest.raises(database.DuplicateResultsError):
+        parse_xml(str(copy), 'junit', connection, config)
+
+
+def test_check_ledger_reports_files_not_archived(tmp_path, sqlite_archive):
+    connection, config = sqlite_archive
+    archived = junit_output(tmp_path, 'archived.xml', 1)
+    parse_xml(archived, 'junit', connection, config)
+
+    assert check_ledger(connection, [archived]) == 0
+    assert check_ledger(connection, [archived, junit_output(tmp_path, 'new.xml', 2)]) == 1
+
+
+def test_ledger_entries_are_deleted_with_test_runs(tmp_path, sqlite_archive):
+    connection, config = sqlite_archive
+    output_file = junit_output(tmp_path, 'output.xml', 1)
+    parse_xml(output_file, 'junit', connection, config)
+    connection.delete('test_run')
+    connection.commit()
+
+    assert connection.get_row_count('ingest_ledger') == 0
+    parse_xml(output_file, 'junit', connection, config)
+    assert connection.get_row_count('test_run') == 1
+
+
+def test_quick_hash_of_large_file_uses_first_and_last_blocks(tmp_path):
+    first = tmp_path / 'first.xml'
+    second = tmp_path / 'second.xml'
+    content = b'a' * ingest_ledger.BLOCK_SIZE * 3
+    first.write_bytes(content)
+    second.write_bytes(content[:-1] + b'b')
+
+    size = len(content)
+    assert ingest_ledger.quick_hash(first, size) != ingest_ledger.quick_hash(second, size)
+    assert ingest_ledger.content_hash(first) != ingest_ledger.content_hash(second)